@@ -1,4 +1,8 @@
-from storehouse import app
+from scripts import data_cli
+from storehouse import create_app
+
+app = create_app()
+app.cli.add_command(data_cli)
 
 if __name__ == '__main__':
     app.run(load_dotenv=True)
@@ -0,0 +1,66 @@
+"""
+Compare two benchmark reports scenario by scenario.
+
+    python -m benchmarks.compare baseline.json results.json --threshold 10 --fail
+"""
+import argparse
+import json
+import sys
+
+
+METRICS = ('p50', 'p95')
+
+
+def change(before: float, after: float):
+    return (after - before) / before * 100 if before else 0.0
+
+
+def compare(baseline: dict, results: dict, threshold: float):
+    rows, regressions = [], []
+    for name, after in results['results'].items():
+        before = baseline['results'].get(name)
+        if before is None:
+            rows.append((name, None))
+            continue
+        deltas = {metric: change(before[metric], after[metric]) for metric in METRICS}
+        rows.append((name, {metric: (before[metric], after[metric], deltas[metric]) for metric in METRICS}))
+        if any(delta > threshold for delta in deltas.values()):
+            regressions.append(name)
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline')
+    parser.add_argument('results')
+    parser.add_argument('--threshold', type=float, default=10, help='percent slower that counts as a regression')
+    parser.add_argument('--fail', action='store_true', help='exit with status 1 on regressions')
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.results) as f:
+        results = json.load(f)
+    for key in ('transport', 'concurrency'):
+        if baseline['meta'].get(key) != results['meta'].get(key):
+            print(f'Warning: {key} differs, {baseline["meta"].get(key)} vs {results["meta"].get(key)}', file=sys.stderr)
+    if baseline.get('dataset') != results.get('dataset'):
+        print('Warning: the reports were run on different datasets', file=sys.stderr)
+
+    rows, regressions = compare(baseline, results, args.threshold)
+    for name, metrics in rows:
+        if metrics is None:
+            print(f'{name:28} new')
+            continue
+        cells = '  '.join(
+            f'{metric} {before:8.2f} -> {after:8.2f} ms {delta:+6.1f}%' for metric, (before, after, delta) in metrics.items()
+        )
+        print(f'{name:28} {cells}{"  REGRESSION" if name in regressions else ""}')
+    if regressions:
+        print(f'{len(regressions)} scenarios over {args.threshold:g}% slower: {", ".join(regressions)}')
+        if args.fail:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+"""
+Synthetic dataset for the benchmarks, generated from a fixed random seed so every
+run of the same scale produces the same rows.
+"""
+import json
+import os
+import random
+from datetime import date, datetime, timedelta
+from flask import current_app
+from werkzeug.security import generate_password_hash
+
+from storehouse import db
+from storehouse.media import create_part, media_path
+from storehouse.models import (
+    Franchise, Upload, TranscodeJob, User, Video, Watchlist, WatchProgress, chunked,
+)
+
+
+PASSWORD = 'benchmark'
+# reserve covers the writes of a run with the default --requests and --warmup, and a few more
+SCALES = {
+    'tiny': {'users': 50, 'franchises': 10, 'movies': 100, 'series': 20, 'episodes': 12, 'watchlists': 2000,
+             'reserve': 300},
+    'small': {'users': 2000, 'franchises': 200, 'movies': 5000, 'series': 500, 'episodes': 24, 'watchlists': 200000,
+              'reserve': 1000},
+    'large': {'users': 50000, 'franchises': 5000, 'movies': 50000, 'series': 5000, 'episodes': 100,
+              'watchlists': 3000000, 'reserve': 2000},
+}
+MEDIA_SIZE = 1024 * 1024
+
+
+def email(user_id: int):
+    return f'user{user_id}@example.com'
+
+
+def insert(model, rows: list, batch_size: int = 10000):
+    for chunk in chunked(rows, batch_size):
+        db.session.execute(model.__table__.insert(), chunk)
+
+
+def write_media(relative: str, size: int, sparse: bool = False):
+    # Sparse files take no disk space, for files that are moved around but never read
+    path = media_path(relative)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        if sparse:
+            f.truncate(size)
+        else:
+            f.write(os.urandom(size))
+
+
+def seed(scale: dict, reserve: int = None, seed: int = 0, media: bool = True):
+    """
+    Recreate every table and fill it, ids are sequential from 1 so scenarios can pick
+    them from the returned counts. The last `reserve` rows of each reserved model are
+    left for the scenarios that delete or finish them, the scale's reserve by default.
+    media=False leaves out the files in MEDIA_ROOT and the rows pointing at them:
+    the video file, the finished transcode job and the uploads.
+    """
+    reserve = scale['reserve'] if reserve is None else reserve
+    rng = random.Random(seed)
+    db.drop_all()
+    db.create_all()
+    today = date.today()
+
+    users = scale['users'] + reserve
+    password = generate_password_hash(
+        PASSWORD, current_app.config['PASSWORD_HASH_METHOD'], current_app.config['PASSWORD_SALT_LENGTH'],
+    )
+    insert(User, [
+        {'id': i, 'name': f'user{i}', 'email': email(i), 'password': password} for i in range(1, users + 1)
+    ])
+
+    franchises = scale['franchises'] + reserve
+    insert(Franchise, [{'id': i, 'name': f'franchise {i}'} for i in range(1, franchises + 1)])
+
+    # Series first, each in a franchise, then movies, some of them sequels in a franchise
+    videos, order = [], {}
+    for i in range(scale['series'] + scale['movies']):
+        series = i < scale['series']
+        franchise_id = rng.randint(1, scale['franchises']) if series or rng.random() < 0.3 else None
+        if franchise_id:
+            order[franchise_id] = order.get(franchise_id, 0) + 1
+        videos.append({
+            'id': i + 1,
+            'owner_id': rng.randint(1, scale['users']),
+            'franchise_id': franchise_id,
+            'order_number': order.get(franchise_id) if franchise_id else None,
+            'title': f'{"series" if series else "movie"} {i + 1} {rng.choice(("red", "blue", "night", "sea", "iron"))}',
+            'episodes': rng.randint(1, scale['episodes']) if series else 1,
+            'is_series': series,
+            'upload_date': today - timedelta(days=rng.randint(0, 3650)),
+            'score': 0,
+            'rating_count': 0,
+            'rating_sum': 0,
+            'duration': rng.uniform(20, 180),
+        })
+    titles = len(videos)
+    videos += [
+        {'id': titles + i, 'owner_id': 1, 'franchise_id': None, 'order_number': None, 'title': f'reserved {i}',
+         'episodes': 1, 'is_series': False, 'upload_date': today, 'score': 0, 'rating_count': 0, 'rating_sum': 0,
+         'duration': 1.0}
+        for i in range(1, reserve + 1)
+    ]
+    episodes = {video['id']: video['episodes'] for video in videos}
+    for video in videos:
+        video['file_path'] = 'videos/benchmark.mp4' if media and video['id'] == 1 else None
+    insert(Video, videos)
+
+    watchlists = scale['watchlists'] + reserve
+    rows = []
+    for i in range(1, watchlists + 1):
+        target_id = rng.randint(1, titles)
+        rows.append({
+            'id': i,
+            'user_id': rng.randint(1, scale['users']),
+            'target_id': target_id,
+            'target_type': 'video',
+            'score': round(rng.uniform(0, 10), 1) if rng.random() < 0.8 else None,
+            'episodes': rng.randint(1, episodes[target_id]),
+            'rewatches': rng.choice((0, 0, 0, 1, 2)),
+        })
+        if len(rows) == 50000:
+            insert(Watchlist, rows)
+            rows = []
+    insert(Watchlist, rows)
+
+    insert(WatchProgress, [
+        {'user_id': 1, 'video_id': i, 'episode': 1, 'position': rng.uniform(0, 1000), 'updated': datetime.utcnow()}
+        for i in range(1, min(titles, 50) + 1)
+    ])
+
+    if media:
+        seed_media(reserve)
+    db.session.commit()
+
+    counts = {
+        'users': scale['users'], 'franchises': scale['franchises'], 'videos': titles,
+        'watchlists': scale['watchlists'], 'reserve': reserve,
+        # (franchise_id, video_id) of ordered franchise titles
+        'franchise_titles': [(video['franchise_id'], video['id']) for video in videos if video['franchise_id']][:1000],
+    }
+    return counts
+
+
+def seed_media(reserve: int):
+    """Files of video 1, its finished transcode job and 2 * reserve uploads, half of them complete"""
+    write_media('videos/benchmark.mp4', MEDIA_SIZE)
+
+    # Video 1 has finished transcoding, see /video/1/renditions and /video/1/hls
+    renditions = [{'name': '360p', 'width': 640, 'height': 360, 'video': 800, 'audio': 96}]
+    insert(TranscodeJob, [{
+        'video_id': 1, 'status': 'done', 'progress': 1, 'renditions': json.dumps(renditions),
+        'created': datetime.utcnow(), 'updated': datetime.utcnow(), 'finished': datetime.utcnow(),
+    }])
+    write_media('renditions/1/360p/segment_00000.ts', 188 * 1024)
+    with open(media_path('renditions/1/360p/index.m3u8'), 'w') as f:
+        f.write('#EXTM3U\n#EXT-X-TARGETDURATION:6\n#EXTINF:6.0,\nsegment_00000.ts\n#EXT-X-ENDLIST\n')
+    with open(media_path('renditions/1/master.m3u8'), 'w') as f:
+        f.write('#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=896000,RESOLUTION=640x360\n360p/index.m3u8\n')
+
+    # Empty uploads for chunk writes, then complete ones for finalize
+    # duration is given, so finalize does not depend on ffprobe
+    fields = json.dumps({'title': 'benchmark upload', 'owner_id': 1, 'episodes': 1, 'is_series': False, 'duration': 1.0})
+    uploads = [f'{i:032x}' for i in range(1, 2 * reserve + 1)]
+    insert(Upload, [
+        {'id': upload_id, 'owner_id': 1, 'filename': 'upload.mp4', 'size': MEDIA_SIZE,
+         'offset': MEDIA_SIZE if i >= reserve else 0, 'fields': fields, 'created': datetime.utcnow()}
+        for i, upload_id in enumerate(uploads)
+    ])
+    db.session.commit()
+    for i, upload_id in enumerate(uploads):
+        create_part(upload_id)
+        if i >= reserve:
+            write_media(os.path.join('uploads', upload_id + '.part'), MEDIA_SIZE, sparse=True)
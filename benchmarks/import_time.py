@@ -0,0 +1,77 @@
+"""
+Cold start benchmark: time `import storehouse` and `create_app()` in fresh interpreters.
+
+    python benchmarks/import_time.py --runs 10 --top 15
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SNIPPET = """
+import json, time
+start = time.perf_counter()
+import storehouse
+imported = time.perf_counter()
+storehouse.create_app()
+created = time.perf_counter()
+print(json.dumps({'import': imported - start, 'create_app': created - imported}))
+"""
+
+
+def measure(runs: int):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', SNIPPET], env=env, cwd=ROOT, check=True, capture_output=True, text=True,
+        ).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    return samples
+
+
+def heaviest_imports(top: int):
+    # -X importtime reports cumulative microseconds per module on stderr
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import storehouse; storehouse.create_app()'],
+        env=env, cwd=ROOT, check=True, capture_output=True, text=True,
+    ).stderr
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # A package costs what its first imported module pulled in, dependencies included
+        package = name.strip().split('.')[0]
+        packages[package] = max(packages.get(package, 0), int(cumulative) / 1e6)
+    return sorted(((seconds, name) for name, seconds in packages.items()), reverse=True)[:top]
+
+
+def summary(values: list):
+    return {'median': statistics.median(values), 'min': min(values), 'max': max(values)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10, help='fresh interpreters to time')
+    parser.add_argument('--top', type=int, default=10, help='heaviest packages to list')
+    args = parser.parse_args()
+
+    samples = measure(args.runs)
+    result = {
+        'runs': args.runs,
+        'import': summary([s['import'] for s in samples]),
+        'create_app': summary([s['create_app'] for s in samples]),
+        'total': summary([s['import'] + s['create_app'] for s in samples]),
+        'heaviest_imports': [{'package': name, 'seconds': seconds} for seconds, name in heaviest_imports(args.top)],
+    }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
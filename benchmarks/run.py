@@ -0,0 +1,320 @@
+"""
+Seed a synthetic dataset and measure every endpoint.
+
+    python -m benchmarks.run seed --scale small
+    python -m benchmarks.run run --transport server --concurrency 8 --output results.json
+    python -m benchmarks.compare baseline.json results.json
+
+`seed` writes a template database under --workdir, `run` copies it first so each run
+starts from the same rows. Latencies are in milliseconds.
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from storehouse import create_app, db
+
+from benchmarks import dataset
+from benchmarks.scenarios import SCENARIOS, Context, uncovered
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_WORKDIR = os.path.join(ROOT, 'instance', 'benchmark')
+
+
+def paths(workdir: str):
+    return {
+        'template': os.path.join(workdir, 'template.db'),
+        'template_media': os.path.join(workdir, 'template-media'),
+        'database': os.path.join(workdir, 'run.db'),
+        'media': os.path.join(workdir, 'run-media'),
+        'counts': os.path.join(workdir, 'counts.json'),
+    }
+
+
+def make_app(database: str, media: str):
+    return create_app({
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{database}',
+        'SQLALCHEMY_BINDS': {'read': f'sqlite:///{database}'},
+        'MEDIA_ROOT': media,
+        'SECRET_KEY': 'benchmark',
+        # Measures the endpoints, not how soon a single client gets throttled
+        'RATE_LIMIT_ENABLED': False,
+    })
+
+
+def seed_command(args):
+    files = paths(args.workdir)
+    os.makedirs(args.workdir, exist_ok=True)
+    for name in ('template', 'counts'):
+        if os.path.exists(files[name]):
+            os.remove(files[name])
+    shutil.rmtree(files['template_media'], ignore_errors=True)
+
+    app = make_app(files['template'], files['template_media'])
+    started = time.perf_counter()
+    with app.app_context():
+        counts = dataset.seed(dataset.SCALES[args.scale], args.reserve, args.seed)
+        # Aggregates the write paths keep up to date
+        runner = app.test_cli_runner()
+        for command in (['scores', 'rebuild'], ['leaderboard', 'rebuild']):
+            result = runner.invoke(args=command)
+            if result.exit_code:
+                raise SystemExit(result.output)
+        db.session.execute(db.text('PRAGMA wal_checkpoint(TRUNCATE)'))
+        db.session.commit()
+        db.engine.dispose()
+    counts.update(scale=args.scale, seed=args.seed)
+    with open(files['counts'], 'w') as f:
+        json.dump(counts, f)
+    summary = {name: value for name, value in counts.items() if not isinstance(value, list)}
+    print(f'Seeded {summary} in {time.perf_counter() - started:.1f}s')
+
+
+class ClientTransport:
+    """Flask test client, measures the app without any network or server overhead"""
+    name = 'client'
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def send(self, request):
+        response = self.client.open(request.url, method=request.method, headers=request.headers, data=request.body)
+        response.get_data()
+        return response.status_code
+
+    def close(self):
+        pass
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class ServerTransport:
+    """Threaded werkzeug server on localhost, one keep-alive connection per client thread"""
+    name = 'server'
+
+    def __init__(self, app):
+        self.server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.local = threading.local()
+
+    def connection(self):
+        if getattr(self.local, 'connection', None) is None:
+            self.local.connection = http.client.HTTPConnection('127.0.0.1', self.server.server_port, timeout=60)
+        return self.local.connection
+
+    def send(self, request):
+        body = request.body.encode() if isinstance(request.body, str) else request.body
+        connection = self.connection()
+        try:
+            connection.request(request.method, request.url, body=body, headers=request.headers)
+            response = connection.getresponse()
+            response.read()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            self.local.connection = None
+            raise
+        if response.getheader('Connection', '').lower() == 'close':
+            connection.close()
+            self.local.connection = None
+        return response.status
+
+    def close(self):
+        self.server.shutdown()
+
+
+def link_media(source: str, destination: str):
+    # The app only reads, renames and deletes media files, except empty upload parts that
+    # chunks are written into, so only those are copied
+    if os.path.getsize(source) == 0:
+        return shutil.copy2(source, destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+    return destination
+
+
+def percentile(values: list, fraction: float):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+def measure(transport, scenario, ctx, requests: int, warmup: int, concurrency: int):
+    # Requests are built up front so building them is not timed and stays deterministic
+    built = []
+    for _ in range(warmup + requests):
+        request = scenario.build(ctx)
+        if request is None:
+            break
+        built.append(request)
+    for request in built[:warmup]:
+        transport.send(request)
+    timed = built[warmup:]
+    if not timed:
+        return None
+
+    def send(request):
+        started = time.perf_counter()
+        try:
+            status = transport.send(request)
+        except Exception:
+            status = None
+        return (time.perf_counter() - started) * 1000, status
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(concurrency) as pool:
+            samples = list(pool.map(send, timed))
+    else:
+        samples = [send(request) for request in timed]
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency for latency, _ in samples]
+    statuses = {}
+    for _, status in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'endpoint': scenario.endpoint,
+        'method': timed[0].method,
+        'requests': len(timed),
+        'errors': sum(1 for _, status in samples if status not in scenario.expect),
+        'statuses': statuses,
+        'throughput': len(timed) / elapsed,
+        'mean': statistics.fmean(latencies),
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'max': max(latencies),
+    }
+
+
+def login(app):
+    body = {'email': dataset.email(1), 'password': dataset.PASSWORD}
+    return app.test_client().post('/users/login', json=body).get_json()['token']
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_command(args):
+    files = paths(args.workdir)
+    if not os.path.exists(files['counts']):
+        raise SystemExit(f'No dataset in {args.workdir}, run `python -m benchmarks.run seed` first')
+    with open(files['counts']) as f:
+        counts = json.load(f)
+
+    # Every run starts from a copy of the seeded template
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(files['database'] + suffix):
+            os.remove(files['database'] + suffix)
+    shutil.copyfile(files['template'], files['database'])
+    shutil.rmtree(files['media'], ignore_errors=True)
+    shutil.copytree(files['template_media'], files['media'], copy_function=link_media)
+
+    app = make_app(files['database'], files['media'])
+    pattern = re.compile(args.only) if args.only else None
+    scenarios = [
+        scenario for scenario in SCENARIOS
+        if (not pattern or pattern.search(scenario.name)) and (args.writes or not scenario.writes)
+    ]
+    ctx = Context(counts, args.seed)
+    transport = (ServerTransport if args.transport == 'server' else ClientTransport)(app)
+    results = {}
+    try:
+        ctx.token = login(app)
+        for scenario in scenarios:
+            result = measure(transport, scenario, ctx, args.requests, args.warmup, args.concurrency)
+            if result is None:
+                print(f'{scenario.name:28} skipped, reserved rows ran out', file=sys.stderr)
+                continue
+            results[scenario.name] = result
+            print(
+                f'{scenario.name:28} {result["throughput"]:9.1f} req/s  p50 {result["p50"]:8.2f}  '
+                f'p95 {result["p95"]:8.2f}  p99 {result["p99"]:8.2f} ms  errors {result["errors"]}',
+                file=sys.stderr,
+            )
+    finally:
+        transport.close()
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'started': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'transport': args.transport,
+            'concurrency': args.concurrency,
+            'requests': args.requests,
+            'warmup': args.warmup,
+            'seed': args.seed,
+        },
+        'dataset': counts,
+        'uncovered': uncovered(app),
+        'results': results,
+    }
+    if report['uncovered']:
+        print(f'Endpoints without a scenario: {", ".join(report["uncovered"])}', file=sys.stderr)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workdir', default=DEFAULT_WORKDIR, help='where the template and run databases live')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    seed = commands.add_parser('seed', help='create the template dataset')
+    seed.add_argument('--scale', choices=sorted(dataset.SCALES), default='small')
+    seed.add_argument('--reserve', type=int, help='rows per model left for delete and upload scenarios, '
+                                                  'defaults to the reserve of the scale')
+    seed.add_argument('--seed', type=int, default=0)
+    seed.set_defaults(handler=seed_command)
+
+    run = commands.add_parser('run', help='measure every scenario')
+    run.add_argument('--transport', choices=('client', 'server'), default='client')
+    run.add_argument('--concurrency', type=int, default=1, help='client threads, server transport only')
+    run.add_argument('--requests', type=int, default=200, help='timed requests per scenario')
+    run.add_argument('--warmup', type=int, default=20, help='untimed requests per scenario')
+    run.add_argument('--only', help='regular expression on scenario names')
+    run.add_argument('--no-writes', dest='writes', action='store_false', help='skip scenarios that change data')
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--output', help='write the JSON report here instead of stdout')
+    run.set_defaults(handler=run_command)
+
+    args = parser.parse_args()
+    if args.command == 'run' and args.transport == 'client':
+        args.concurrency = 1
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""
+One scenario per kind of request, every endpoint in app.url_map should have at least one.
+A scenario builds (method, url, headers, body) for each request from the seeded counts.
+"""
+import json
+import random
+from collections import namedtuple
+from hashlib import sha256
+from types import SimpleNamespace
+
+from storehouse.utils import encode_cursor
+
+from benchmarks.dataset import PASSWORD, email
+
+
+Request = namedtuple('Request', 'method url headers body')
+Scenario = namedtuple('Scenario', 'name endpoint build expect writes')
+# Flask's own static route, the app does not serve static files
+IGNORED_ENDPOINTS = {'static'}
+WORDS = ('red', 'blue', 'night', 'sea', 'iron', 'series', 'movie', 'fran')
+CHUNK = 64 * 1024
+
+
+class Context:
+    """Seeded ids and the auth token shared by the scenarios of one run"""
+    def __init__(self, counts: dict, seed: int = 0):
+        self.counts = counts
+        self.rng = random.Random(seed)
+        self.token = None
+        self.created = 0
+        reserve = counts['reserve']
+        self._reserved = {
+            name: iter(range(counts[name] + 1, counts[name] + reserve + 1))
+            for name in ('users', 'franchises', 'videos', 'watchlists')
+        }
+        self._reserved['uploads'] = iter(f'{i:032x}' for i in range(1, reserve + 1))
+        self._reserved['complete_uploads'] = iter(f'{i:032x}' for i in range(reserve + 1, 2 * reserve + 1))
+
+    def pick(self, name: str):
+        return self.rng.randint(1, self.counts[name])
+
+    def sample(self, name: str, count: int):
+        # Distinct ids, bulk updates reject an id listed twice
+        return self.rng.sample(range(1, self.counts[name] + 1), min(count, self.counts[name]))
+
+    def take(self, name: str, count: int = None):
+        """Reserved ids nobody else touches, None once they run out"""
+        ids = [next(self._reserved[name], None) for _ in range(count or 1)]
+        if None in ids:
+            return None
+        return ids if count else ids[0]
+
+    def unique(self):
+        self.created += 1
+        return f'{self.created}-{self.rng.getrandbits(32):x}'
+
+    def request(self, method: str, url: str, body=None, headers: dict = None):
+        return Request(method, url, dict(headers or {}, **{'x-access-token': self.token}), body)
+
+
+def get(url):
+    return lambda ctx: ctx.request('GET', url(ctx) if callable(url) else url)
+
+
+def send(method, url, body):
+    def build(ctx):
+        payload = body(ctx)
+        if payload is None:
+            return None
+        headers = {'Content-Type': 'application/json'}
+        return ctx.request(method, url(ctx) if callable(url) else url, json.dumps(payload), headers)
+    return build
+
+
+def taken(method, name, url):
+    def build(ctx):
+        model_id = ctx.take(name)
+        return None if model_id is None else ctx.request(method, url.format(model_id))
+    return build
+
+
+def video(ctx):
+    return {
+        'title': f'bench {ctx.unique()}', 'owner_id': ctx.pick('users'), 'episodes': 1,
+        'is_series': False, 'duration': 90.0,
+    }
+
+
+def watchlist(ctx):
+    return {
+        'user_id': ctx.pick('users'), 'target_id': ctx.pick('videos'), 'target_type': 'video',
+        'score': round(ctx.rng.uniform(0, 10), 1), 'episodes': 1, 'rewatches': 0,
+    }
+
+
+def upload_chunk(ctx):
+    upload_id = ctx.take('uploads')
+    if upload_id is None:
+        return None
+    body = ctx.rng.randbytes(CHUNK)
+    headers = {'Upload-Offset': '0', 'X-Chunk-SHA256': sha256(body).hexdigest(), 'Content-Type': 'application/offset+octet-stream'}
+    return ctx.request('PATCH', f'/upload/{upload_id}', body, headers)
+
+
+def login(ctx):
+    body = json.dumps({'email': email(ctx.pick('users')), 'password': PASSWORD})
+    return Request('POST', '/users/login', {'Content-Type': 'application/json'}, body)
+
+
+def signup(ctx):
+    body = json.dumps({'name': 'bench', 'email': f'signup-{ctx.unique()}@example.com', 'password': PASSWORD})
+    return Request('POST', '/users/signup', {'Content-Type': 'application/json'}, body)
+
+
+def cursor(name):
+    return lambda ctx: encode_cursor(SimpleNamespace(id=ctx.pick(name)))
+
+
+SCENARIOS = [
+    # Reads
+    Scenario('users.list', 'usersendpoints', get('/users'), {200}, False),
+    Scenario('users.list.after', 'usersendpoints', get(lambda c: f'/users?after={cursor("users")(c)}'), {200}, False),
+    Scenario('user.get', 'userendpoints', get(lambda c: f'/user/{c.pick("users")}'), {200}, False),
+    Scenario('user.get.expand', 'userendpoints', get(lambda c: f'/user/{c.pick("users")}?expand=watchlist.target'), {200}, False),
+    Scenario('videos.list', 'videosendpoints', get('/videos'), {200}, False),
+    Scenario('videos.filtered', 'videosendpoints',
+             get(lambda c: f'/videos?franchise_id={c.pick("franchises")}&sort=-score&limit=20'), {200}, False),
+    Scenario('videos.ndjson', 'videosendpoints', get(lambda c: f'/videos?format=ndjson&owner_id={c.pick("users")}'), {200}, False),
+    Scenario('videos.top', 'leaderboardendpoints', get('/videos/top?limit=20'), {200}, False),
+    Scenario('videos.trending', 'leaderboardendpoints', get('/videos/trending?limit=20'), {200}, False),
+    Scenario('video.get', 'videoendpoints', get(lambda c: f'/video/{c.pick("videos")}'), {200}, False),
+    Scenario('video.get.expand', 'videoendpoints', get(lambda c: f'/video/{c.pick("videos")}?expand=histogram'), {200}, False),
+    Scenario('video.stream.range', 'videostreamendpoints',
+             lambda c: c.request('GET', '/video/1/stream?download=1', headers={'Range': 'bytes=0-65535'}), {206}, False),
+    Scenario('video.renditions', 'videorenditionsendpoints', get('/video/1/renditions'), {200}, False),
+    Scenario('video.hls.master', 'videohlsendpoints', get('/video/1/hls/master.m3u8'), {200}, False),
+    Scenario('video.hls.segment', 'videohlsendpoints', get('/video/1/hls/360p/segment_00000.ts'), {200}, False),
+    Scenario('watchlists.by_user', 'watchlistsendpoints', get(lambda c: f'/watchlists?user_id={c.pick("users")}'), {200}, False),
+    Scenario('watchlists.by_score', 'watchlistsendpoints', get('/watchlists?score_min=9&limit=100'), {200}, False),
+    Scenario('watchlist.get.expand', 'watchlistendpoints',
+             get(lambda c: f'/watchlist/{c.pick("watchlists")}?expand=target'), {200}, False),
+    Scenario('franchises.list', 'franchisesendpoints', get('/franchises'), {200}, False),
+    Scenario('franchise.get.expand', 'franchiseendpoints',
+             get(lambda c: f'/franchise/{c.pick("franchises")}?expand=titles'), {200}, False),
+    Scenario('franchise.titles', 'franchisetitlesendpoints',
+             get(lambda c: f'/franchise/{c.pick("franchises")}/titles?limit=20'), {200}, False),
+    Scenario('franchise.titles.neighbours', 'franchisetitlesendpoints',
+             get(lambda c: '/franchise/{}/titles?video_id={}'.format(*c.rng.choice(c.counts['franchise_titles']))),
+             {200}, False),
+    Scenario('search', 'searchendpoints', get(lambda c: f'/search?q={c.rng.choice(WORDS)}&limit=20'), {200}, False),
+    Scenario('progress.get', 'progressendpoints', get('/progress'), {200}, False),
+    Scenario('feed', 'feedendpoints', get('/feed'), {200}, False),
+    Scenario('upload.get', 'uploadendpoints', get(f'/upload/{1:032x}'), {200}, False),
+    # Writes
+    Scenario('auth.login', 'auth.login', login, {201}, True),
+    Scenario('auth.signup', 'auth.signup', signup, {201}, True),
+    # Refused, users are created through /users/signup
+    Scenario('users.create', 'usersendpoints',
+             send('POST', '/users', lambda c: {'name': 'bench', 'email': f'{c.unique()}@example.com', 'password': PASSWORD}),
+             {400}, True),
+    Scenario('user.patch', 'userendpoints',
+             send('PATCH', lambda c: f'/user/{c.pick("users")}', lambda c: {'name': f'user {c.unique()}'[:20]}), {200}, True),
+    Scenario('user.put', 'userendpoints',
+             send('PUT', lambda c: f'/user/{c.pick("users")}',
+                  lambda c: {'name': 'bench', 'email': f'put-{c.unique()}@example.com', 'password': PASSWORD}),
+             {201}, True),
+    Scenario('user.delete', 'userendpoints', taken('DELETE', 'users', '/user/{}'), {204}, True),
+    Scenario('videos.create', 'videosendpoints', send('POST', '/videos', video), {201}, True),
+    # Retries with the same Idempotency-Key, all but the first are replayed
+    Scenario('videos.create.replayed', 'videosendpoints',
+             lambda c: c.request('POST', '/videos', json.dumps({'title': 'replayed', 'owner_id': 1, 'duration': 90.0}),
+                                 {'Content-Type': 'application/json', 'Idempotency-Key': 'benchmark'}), {201}, True),
+    Scenario('videos.create.bulk', 'videosendpoints', send('POST', '/videos', lambda c: [video(c) for _ in range(20)]), {201}, True),
+    Scenario('videos.patch.bulk', 'videosendpoints',
+             send('PATCH', '/videos', lambda c: [{'id': i, 'duration': 100.0} for i in c.sample('videos', 20)]), {200}, True),
+    Scenario('videos.delete.bulk', 'videosendpoints', send('DELETE', '/videos', lambda c: c.take('videos', 5)), {200}, True),
+    Scenario('video.patch', 'videoendpoints',
+             send('PATCH', lambda c: f'/video/{c.pick("videos")}', lambda c: {'duration': 95.0}), {200}, True),
+    Scenario('video.put', 'videoendpoints', send('PUT', lambda c: f'/video/{c.pick("videos")}', video), {201}, True),
+    Scenario('video.delete', 'videoendpoints', taken('DELETE', 'videos', '/video/{}'), {204}, True),
+    Scenario('watchlists.create', 'watchlistsendpoints', send('POST', '/watchlists', watchlist), {201}, True),
+    Scenario('watchlists.create.bulk', 'watchlistsendpoints',
+             send('POST', '/watchlists', lambda c: [watchlist(c) for _ in range(50)]), {201}, True),
+    Scenario('watchlists.patch.bulk', 'watchlistsendpoints',
+             send('PATCH', '/watchlists', lambda c: [{'id': i, 'episodes': 1} for i in c.sample('watchlists', 50)]), {200}, True),
+    Scenario('watchlists.delete.bulk', 'watchlistsendpoints', send('DELETE', '/watchlists', lambda c: c.take('watchlists', 5)), {200}, True),
+    Scenario('watchlist.patch', 'watchlistendpoints',
+             send('PATCH', lambda c: f'/watchlist/{c.pick("watchlists")}', lambda c: {'score': 7.5}), {200}, True),
+    Scenario('watchlist.put', 'watchlistendpoints',
+             send('PUT', lambda c: f'/watchlist/{c.pick("watchlists")}', watchlist), {201}, True),
+    Scenario('watchlist.delete', 'watchlistendpoints', taken('DELETE', 'watchlists', '/watchlist/{}'), {204}, True),
+    Scenario('franchises.create', 'franchisesendpoints', send('POST', '/franchises', lambda c: {'name': f'f {c.unique()}'[:30]}), {201}, True),
+    Scenario('franchises.patch.bulk', 'franchisesendpoints',
+             send('PATCH', '/franchises', lambda c: [{'id': i, 'name': 'renamed'} for i in c.sample('franchises', 20)]), {200}, True),
+    Scenario('franchises.delete.bulk', 'franchisesendpoints', send('DELETE', '/franchises', lambda c: c.take('franchises', 5)), {200}, True),
+    Scenario('franchise.patch', 'franchiseendpoints',
+             send('PATCH', lambda c: f'/franchise/{c.pick("franchises")}', lambda c: {'name': 'renamed'}), {200}, True),
+    Scenario('franchise.put', 'franchiseendpoints',
+             send('PUT', lambda c: f'/franchise/{c.pick("franchises")}', lambda c: {'name': 'replaced'}), {201}, True),
+    Scenario('franchise.delete', 'franchiseendpoints', taken('DELETE', 'franchises', '/franchise/{}'), {204}, True),
+    Scenario('progress.post', 'progressendpoints',
+             send('POST', '/progress', lambda c: {'video_id': c.pick('videos'), 'episode': 1, 'position': c.rng.uniform(0, 3000)}),
+             {202}, True),
+    Scenario('uploads.create', 'uploadsendpoints',
+             send('POST', '/uploads', lambda c: dict(video(c), size=CHUNK, filename='bench.mp4')), {201}, True),
+    Scenario('upload.patch', 'uploadendpoints', upload_chunk, {200}, True),
+    Scenario('upload.finalize', 'uploadfinalizeendpoints',
+             taken('POST', 'complete_uploads', '/upload/{}/finalize'), {201}, True),
+]
+
+
+def uncovered(app):
+    """Endpoints registered on the app that no scenario exercises"""
+    endpoints = {rule.endpoint for rule in app.url_map.iter_rules()} - IGNORED_ENDPOINTS
+    return sorted(endpoints - {scenario.endpoint for scenario in SCENARIOS})
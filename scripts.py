@@ -1,14 +1,238 @@
+import base64
+import click
+import csv
+import gzip
+import os
+import time
+from contextlib import contextmanager
+from datetime import date, datetime
+from flask.cli import AppGroup
+from sqlalchemy import func, inspect, select, text
+
 from storehouse import db
+from storehouse.models import TableVersion
+from storehouse.serializers import dumps, loads
 
 
-def clear_data(session):
-    # Maybe use
-    # db.drop_all()
-    # db.create_all()
-    # db.session.commit()
-
-    meta = db.metadata
-    for table in reversed(meta.sorted_tables):
-        print('Clear table %s' % table)
-        session.execute(table.delete())
+data_cli = AppGroup('data', help='Reset, seed, dump and load the whole database.')
+# Not data: versions are bumped after every reset, idempotency keys expire and feeds are rebuilt anyway
+SKIPPED_TABLES = ('table_version', 'idempotency_key', 'feed')
+FORMATS = {'ndjson': '.ndjson.gz', 'csv': '.csv.gz'}
+# Stands for NULL in CSV files, an empty field is an empty string
+CSV_NULL = r'\N'
+
+
+@contextmanager
+def unchecked_connection():
+    """Connection with SQLite foreign key checks off, they are back on before it returns to the pool"""
+    with db.engine.connect() as connection:
+        sqlite = connection.dialect.name == 'sqlite'
+        if sqlite:
+            connection.exec_driver_sql('PRAGMA foreign_keys=OFF')
+        try:
+            yield connection
+        finally:
+            if sqlite:
+                connection.exec_driver_sql('PRAGMA foreign_keys=ON')
+
+
+def data_tables():
+    return [table for table in db.metadata.sorted_tables if table.name not in SKIPPED_TABLES]
+
+
+def bump_versions(connection, versions: dict):
+    """Write every table version one past `versions`, so ETags handed out before a reset do not match again"""
+    table = TableVersion.__table__
+    connection.execute(table.delete())
+    connection.execute(table.insert(), [
+        {'name': name, 'version': versions.get(name, 0) + 1} for name in db.metadata.tables
+    ])
+
+
+def table_versions(session):
+    if not inspect(db.engine).has_table(TableVersion.__tablename__):
+        return {}
+    versions = dict(session.query(TableVersion.name, TableVersion.version))
     session.commit()
+    return versions
+
+
+def clear_data(session):
+    """Empty every table: TRUNCATE on Postgres, dropping and recreating the tables on SQLite"""
+    versions = table_versions(session)
+    with unchecked_connection() as connection:
+        with connection.begin():
+            if connection.dialect.name == 'postgresql':
+                names = ', '.join(f'"{table.name}"' for table in db.metadata.sorted_tables)
+                connection.execute(text(f'TRUNCATE {names} RESTART IDENTITY CASCADE'))
+            else:
+                db.metadata.drop_all(connection)
+                db.metadata.create_all(connection)
+            bump_versions(connection, versions)
+
+
+def encoder(column):
+    python_type = column.type.python_type
+    if python_type in (date, datetime):
+        return lambda value: value.isoformat()
+    if python_type is bytes:
+        return lambda value: base64.b64encode(value).decode()
+    return None
+
+
+def decoder(column, from_csv: bool):
+    python_type = column.type.python_type
+    if python_type is date:
+        return date.fromisoformat
+    if python_type is datetime:
+        return datetime.fromisoformat
+    if python_type is bytes:
+        return base64.b64decode
+    if not from_csv:
+        # JSON already has the other types
+        return None
+    if python_type is bool:
+        return lambda value: value in ('1', 'true', 'True')
+    return python_type
+
+
+def dump_table(connection, table, path: str, csv_format: bool, batch_size: int):
+    names = [column.name for column in table.columns]
+    encoders = [encoder(column) for column in table.columns]
+    query = select(table).order_by(*table.primary_key.columns)
+    result = connection.execution_options(stream_results=True, yield_per=batch_size).execute(query)
+    count = 0
+    with gzip.open(path, 'wt', compresslevel=5, newline='') as f:
+        writer = csv.writer(f) if csv_format else None
+        if writer:
+            writer.writerow(names)
+        for rows in result.partitions(batch_size):
+            for row in rows:
+                values = [value if value is None or encode is None else encode(value) for encode, value in zip(encoders, row)]
+                if writer:
+                    writer.writerow([CSV_NULL if value is None else int(value) if isinstance(value, bool) else value
+                                     for value in values])
+                else:
+                    f.write(dumps(dict(zip(names, values))) + '\n')
+            count += len(rows)
+    return count
+
+
+def read_rows(table, path: str):
+    csv_format = path.endswith(FORMATS['csv'])
+    columns = {column.name: column for column in table.columns}
+    with gzip.open(path, 'rt', newline='') as f:
+        if csv_format:
+            reader = csv.reader(f)
+            names = next(reader)
+            decoders = [decoder(columns[name], True) for name in names]
+            for values in reader:
+                yield {
+                    name: None if value == CSV_NULL else decode(value) if decode else value
+                    for name, decode, value in zip(names, decoders, values)
+                }
+        else:
+            decoders = {name: decode for name, decode in ((name, decoder(c, False)) for name, c in columns.items()) if decode}
+            for line in f:
+                row = loads(line)
+                for name, decode in decoders.items():
+                    if row.get(name) is not None:
+                        row[name] = decode(row[name])
+                yield row
+
+
+def load_table(connection, table, path: str, batch_size: int):
+    count, batch = 0, []
+    statement = table.insert()
+    for row in read_rows(table, path):
+        batch.append(row)
+        if len(batch) == batch_size:
+            connection.execute(statement, batch)
+            count, batch = count + len(batch), []
+    if batch:
+        connection.execute(statement, batch)
+        count += len(batch)
+    if connection.dialect.name == 'postgresql' and 'id' in table.columns and table.c.id.autoincrement:
+        # Explicit ids leave the sequence behind
+        connection.execute(
+            select(func.setval(func.pg_get_serial_sequence(table.name, 'id'), func.coalesce(func.max(table.c.id), 0) + 1, False))
+        )
+    return count
+
+
+def table_file(directory: str, table):
+    for extension in FORMATS.values():
+        path = os.path.join(directory, table.name + extension)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+@data_cli.command('reset')
+def reset():
+    """Delete every row of every table."""
+    started = time.perf_counter()
+    clear_data(db.session)
+    click.echo(f'Cleared {len(db.metadata.sorted_tables)} tables in {time.perf_counter() - started:.1f}s')
+
+
+@data_cli.command('seed')
+@click.option('--scale', type=click.Choice(['tiny', 'small', 'large']), default='small', show_default=True)
+@click.option('--seed', 'random_seed', type=int, default=0, help='Same seed, same rows.')
+def seed(scale, random_seed):
+    """Replace the database with the synthetic dataset of the benchmarks, without their media files."""
+    from benchmarks import dataset
+    from storehouse.leaderboard import rebuild as rebuild_leaderboard
+    from storehouse.scores import rebuild as rebuild_scores
+
+    started = time.perf_counter()
+    versions = table_versions(db.session)
+    counts = dataset.seed(dataset.SCALES[scale], reserve=0, seed=random_seed, media=False)
+    with db.engine.begin() as connection:
+        bump_versions(connection, versions)
+    click.get_current_context().invoke(rebuild_scores)
+    click.get_current_context().invoke(rebuild_leaderboard)
+    click.echo(
+        f'Seeded {counts["users"]} users, {counts["videos"]} videos and {counts["watchlists"]} watchlists '
+        f'in {time.perf_counter() - started:.1f}s'
+    )
+
+
+@data_cli.command('dump')
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(list(FORMATS)), default='ndjson', show_default=True)
+@click.option('--batch-size', type=int, default=10000, show_default=True)
+def dump(directory, file_format, batch_size):
+    """Write every table to DIRECTORY as one gzipped NDJSON or CSV file per table."""
+    os.makedirs(directory, exist_ok=True)
+    started = time.perf_counter()
+    with db.engine.connect() as connection:
+        # One read transaction, so the files are a consistent snapshot
+        with connection.begin():
+            for table in data_tables():
+                path = os.path.join(directory, table.name + FORMATS[file_format])
+                count = dump_table(connection, table, path, file_format == 'csv', batch_size)
+                click.echo(f'{table.name}: {count} rows')
+    click.echo(f'Dumped to {directory} in {time.perf_counter() - started:.1f}s')
+
+
+@data_cli.command('load')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('--batch-size', type=int, default=10000, show_default=True)
+def load(directory, batch_size):
+    """Replace the database with the files `flask data dump` wrote to DIRECTORY."""
+    started = time.perf_counter()
+    clear_data(db.session)
+    with unchecked_connection() as connection:
+        # Parents load first, so Postgres can keep checking foreign keys
+        for table in data_tables():
+            path = table_file(directory, table)
+            if path is None:
+                continue
+            with connection.begin():
+                count = load_table(connection, table, path, batch_size)
+            click.echo(f'{table.name}: {count} rows')
+    with db.engine.begin() as connection:
+        # ETags handed out while the tables were filling up must not match the loaded data
+        bump_versions(connection, table_versions(db.session))
+    click.echo(f'Loaded {directory} in {time.perf_counter() - started:.1f}s')
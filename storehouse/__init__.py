@@ -1,33 +1,142 @@
+import click
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_restful import Api
-from flask_migrate import Migrate
-from flasgger import Swagger
-from os import getenv
-
-
-app = Flask(__name__)
-api = Api(app)
-app.config['SECRET_KEY'] = getenv('SECRET_KEY')
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///sqlite.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SWAGGER'] = {
-    'title': 'Storehouse API',
-    'uiversion': 3,
-}
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
-swag = Swagger(app, template_file='docs/template.yml')
-from storehouse import endpoints, models
-
-api.add_resource(endpoints.UserEndpoints, '/user/<int:model_id>')
-api.add_resource(endpoints.UsersEndpoints, '/users')
-
-api.add_resource(endpoints.VideoEndpoints, '/video/<int:model_id>')
-api.add_resource(endpoints.VideosEndpoints, '/videos')
-
-api.add_resource(endpoints.WatchlistEndpoints, '/watchlist/<int:model_id>')
-api.add_resource(endpoints.WatchlistsEndpoints, '/watchlists')
-
-api.add_resource(endpoints.FranchiseEndpoints, '/franchise/<int:model_id>')
-api.add_resource(endpoints.FranchisesEndpoints, '/franchises')
+from os import getenv, path
+
+from storehouse.database import Database, ReadSession, engine_options, sqlite_pragmas
+
+
+db = Database()
+# Read-only endpoints use their own pool, point READ_DATABASE_URL to a replica if there is one
+read_session = db.create_scoped_session({'class_': ReadSession})
+
+
+def create_app(config: dict = None):
+    """Application factory, config overrides the environment"""
+    config = config or {}
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = getenv('SECRET_KEY')
+    app.config['SQLALCHEMY_DATABASE_URI'] = config.get('SQLALCHEMY_DATABASE_URI', getenv('DATABASE_URL', 'sqlite:///sqlite.db'))
+    app.config['SQLALCHEMY_BINDS'] = {'read': getenv('READ_DATABASE_URL', app.config['SQLALCHEMY_DATABASE_URI'])}
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLITE_PRAGMAS'] = sqlite_pragmas()
+    app.config['PAGE_SIZE'] = int(getenv('PAGE_SIZE', 50))
+    app.config['MAX_PAGE_SIZE'] = int(getenv('MAX_PAGE_SIZE', 500))
+    app.config['BULK_MAX_ITEMS'] = int(getenv('BULK_MAX_ITEMS', 1000))
+    app.config['MEDIA_ROOT'] = getenv('MEDIA_ROOT', path.join(app.instance_path, 'media'))
+    app.config['USE_X_SENDFILE'] = getenv('USE_X_SENDFILE') == '1'
+    # Seconds a running transcode job may go without progress before another worker picks it up
+    app.config['TRANSCODE_JOB_TIMEOUT'] = int(getenv('TRANSCODE_JOB_TIMEOUT', 600))
+    app.config['TOKEN_CACHE_SIZE'] = int(getenv('TOKEN_CACHE_SIZE', 10000))
+    app.config['TOKEN_CACHE_TTL'] = int(getenv('TOKEN_CACHE_TTL', 300))
+    app.config['RESPONSE_CACHE_SIZE'] = int(getenv('RESPONSE_CACHE_SIZE', 1024))
+    app.config['RESPONSE_CACHE_TTL'] = int(getenv('RESPONSE_CACHE_TTL', 300))
+    app.config['CACHE_CONTROL'] = getenv('CACHE_CONTROL', 'private, no-cache')
+    app.config['PROGRESS_FLUSH_INTERVAL'] = float(getenv('PROGRESS_FLUSH_INTERVAL', 5))
+    app.config['PROGRESS_MAX_PENDING'] = int(getenv('PROGRESS_MAX_PENDING', 10000))
+    # Seconds after which watching counts half on the trending board
+    app.config['TRENDING_HALF_LIFE'] = float(getenv('TRENDING_HALF_LIFE', 3 * 24 * 3600))
+    app.config['LEADERBOARD_SNAPSHOT_INTERVAL'] = float(getenv('LEADERBOARD_SNAPSHOT_INTERVAL', 30))
+    # Seconds a stored /feed is served before it is rebuilt, writes that change it invalidate it earlier
+    app.config['FEED_TTL'] = int(getenv('FEED_TTL', 300))
+    app.config['FEED_SECTION_SIZE'] = int(getenv('FEED_SECTION_SIZE', 20))
+    app.config['PASSWORD_HASH_METHOD'] = getenv('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:260000')
+    app.config['PASSWORD_SALT_LENGTH'] = int(getenv('PASSWORD_SALT_LENGTH', 16))
+    # HASH_WORKERS=0 hashes on the request thread
+    app.config['HASH_WORKERS'] = int(getenv('HASH_WORKERS', 2))
+    app.config['HASH_QUEUE_DEPTH'] = int(getenv('HASH_QUEUE_DEPTH', 16))
+    app.config['HASH_TIMEOUT'] = int(getenv('HASH_TIMEOUT', 10))
+    app.config['HASH_RETRY_AFTER'] = int(getenv('HASH_RETRY_AFTER', 1))
+    # Seconds a response to a request with an Idempotency-Key is replayed to retries
+    app.config['IDEMPOTENCY_TTL'] = int(getenv('IDEMPOTENCY_TTL', 3600))
+    # Token buckets per user, or per client address without a known token, RATE is tokens per second
+    app.config['RATE_LIMIT_ENABLED'] = getenv('RATE_LIMIT_ENABLED', '1') == '1'
+    app.config['RATE_LIMIT_DATABASE'] = getenv('RATE_LIMIT_DATABASE', path.join(app.instance_path, 'ratelimit.db'))
+    app.config['RATE_LIMIT_USER_RATE'] = float(getenv('RATE_LIMIT_USER_RATE', 10))
+    app.config['RATE_LIMIT_USER_BURST'] = float(getenv('RATE_LIMIT_USER_BURST', 100))
+    app.config['RATE_LIMIT_IP_RATE'] = float(getenv('RATE_LIMIT_IP_RATE', 20))
+    app.config['RATE_LIMIT_IP_BURST'] = float(getenv('RATE_LIMIT_IP_BURST', 200))
+    # Tokens per request by endpoint, e.g. 'auth.login=20,searchendpoints=1', see storehouse.ratelimit.COSTS
+    app.config['RATE_LIMIT_COSTS'] = getenv('RATE_LIMIT_COSTS', '')
+    # Request timings, query counts and /metrics, off unless METRICS_ENABLED=1
+    app.config['METRICS_ENABLED'] = getenv('METRICS_ENABLED') == '1'
+    app.config['SLOW_QUERY_MS'] = float(getenv('SLOW_QUERY_MS', 100))
+    app.config['REPEATED_QUERY_WARNING'] = int(getenv('REPEATED_QUERY_WARNING', 10))
+    # Share of requests run under cProfile, their stats are written to PROFILE_DIR
+    app.config['PROFILE_SAMPLE_RATE'] = float(getenv('PROFILE_SAMPLE_RATE', 0))
+    app.config['PROFILE_DIR'] = getenv('PROFILE_DIR', path.join(app.instance_path, 'profiles'))
+    # Prebuilt by `flask apidocs build`, otherwise the spec is parsed from docstrings on first request
+    app.config['APISPEC_FILE'] = getenv('APISPEC_FILE', path.join(app.instance_path, 'apispec.json'))
+    app.config['SWAGGER'] = {
+        'title': 'Storehouse API',
+        'uiversion': 3,
+    }
+    app.config.update(config)
+
+    db.init_app(app)
+    app.teardown_appcontext(lambda exception: read_session.remove())
+
+    from storehouse import (
+        apidocs, endpoints, idempotency, leaderboard, metrics, progress, ratelimit, scores, search, serializers,
+        transcode, uploads,
+    )
+    from storehouse.cache import response_cache
+    response_cache.configure(app.config['RESPONSE_CACHE_SIZE'], app.config['RESPONSE_CACHE_TTL'])
+    endpoints.token_cache.configure(app.config['TOKEN_CACHE_SIZE'], app.config['TOKEN_CACHE_TTL'])
+    progress.buffer.init_app(app)
+    leaderboard.leaderboards.init_app(app)
+    apidocs.init_app(app)
+    metrics.metrics.init_app(app)
+    # Ahead of idempotency, so rejected requests never reach the database
+    ratelimit.limiter.init_app(app)
+    idempotency.store.init_app(app)
+
+    for command in (
+        apidocs.apidocs_cli, leaderboard.leaderboard_cli, scores.scores_cli, search.search_cli, transcode.transcode_cli,
+        uploads.uploads_cli,
+    ):
+        app.cli.add_command(command)
+    if click.get_current_context(silent=True) is not None:
+        # Only the flask command needs the migration tooling
+        from flask_migrate import Migrate
+        Migrate(app, db)
+
+    app.register_blueprint(endpoints.auth)
+    api = Api(app)
+    api.representations['application/json'] = serializers.output_json
+    metrics.metrics.instrument(api)
+    api.add_resource(endpoints.UserEndpoints, '/user/<int:model_id>')
+    api.add_resource(endpoints.UsersEndpoints, '/users')
+
+    api.add_resource(endpoints.VideoEndpoints, '/video/<int:model_id>')
+    api.add_resource(endpoints.VideosEndpoints, '/videos')
+    api.add_resource(endpoints.LeaderboardEndpoints, '/videos/<any(top, trending):board>')
+    api.add_resource(endpoints.VideoStreamEndpoints, '/video/<int:model_id>/stream')
+    api.add_resource(endpoints.VideoRenditionsEndpoints, '/video/<int:model_id>/renditions')
+    api.add_resource(endpoints.VideoHlsEndpoints, '/video/<int:model_id>/hls/<path:filename>')
+
+    api.add_resource(endpoints.UploadsEndpoints, '/uploads')
+    api.add_resource(endpoints.UploadEndpoints, '/upload/<string:upload_id>')
+    api.add_resource(endpoints.UploadFinalizeEndpoints, '/upload/<string:upload_id>/finalize')
+
+    api.add_resource(endpoints.WatchlistEndpoints, '/watchlist/<int:model_id>')
+    api.add_resource(endpoints.WatchlistsEndpoints, '/watchlists')
+
+    api.add_resource(endpoints.FranchiseEndpoints, '/franchise/<int:model_id>')
+    api.add_resource(endpoints.FranchiseTitlesEndpoints, '/franchise/<int:model_id>/titles')
+    api.add_resource(endpoints.FranchisesEndpoints, '/franchises')
+
+    api.add_resource(endpoints.SearchEndpoints, '/search')
+    api.add_resource(endpoints.ProgressEndpoints, '/progress')
+    api.add_resource(endpoints.FeedEndpoints, '/feed')
+    return app
+
+
+def __getattr__(name: str):
+    # `from storehouse import app` builds the default app on first use
+    if name == 'app':
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
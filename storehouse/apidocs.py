@@ -0,0 +1,68 @@
+import click
+import json
+import os
+from flask import current_app
+from flask.cli import AppGroup
+from threading import Lock
+
+
+# Served by flasgger once it is set up
+DOC_PATHS = ('/apidocs', '/apispec_1.json', '/flasgger_static')
+TEMPLATE_FILE = 'docs/template.yml'
+
+apidocs_cli = AppGroup('apidocs', help='API documentation commands.')
+
+
+def setup(app):
+    """Register flasgger, the spec comes from APISPEC_FILE when it was prebuilt"""
+    from flasgger import Swagger
+    swagger = Swagger(app, template_file=TEMPLATE_FILE)
+    spec_file = app.config['APISPEC_FILE']
+    if spec_file and os.path.exists(spec_file):
+        with open(spec_file) as f:
+            # Same cache flasgger fills on the first spec request outside debug mode
+            swagger.apispecs['apispec_1'] = json.load(f)
+    return swagger
+
+
+class LazyDocs:
+    """
+    WSGI middleware setting flasgger up on the first request for the API docs, so
+    importing it and parsing every endpoint docstring stay off the startup path
+    """
+    def __init__(self, app):
+        self.app = app
+        self.wsgi_app = app.wsgi_app
+        self._ready = False
+        self._lock = Lock()
+
+    def __call__(self, environ, start_response):
+        if not self._ready and environ.get('PATH_INFO', '').startswith(DOC_PATHS):
+            with self._lock:
+                if not self._ready:
+                    setup(self.app)
+                    self._ready = True
+        return self.wsgi_app(environ, start_response)
+
+
+def init_app(app):
+    if app.debug:
+        # Flask refuses new routes after the first request in debug mode
+        setup(app)
+    else:
+        app.wsgi_app = LazyDocs(app)
+
+
+@apidocs_cli.command('build')
+@click.argument('filename', required=False)
+def build(filename):
+    """Write the API spec to FILENAME, APISPEC_FILE by default, for workers to load instead of parsing docstrings."""
+    filename = filename or current_app.config['APISPEC_FILE']
+    swagger = getattr(current_app, 'swag', None) or setup(current_app)
+    swagger.apispecs.pop('apispec_1', None)
+    with current_app.test_request_context():
+        spec = swagger.get_apispecs('apispec_1')
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    with open(filename, 'w') as f:
+        json.dump(spec, f)
+    click.echo(f'Wrote {len(spec.get("paths", {}))} paths to {filename}')
@@ -0,0 +1,65 @@
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+
+class TTLCache:
+    """
+    Thread safe LRU cache bounded by maxsize, entries expire after ttl seconds
+    or at the absolute timestamp passed to set
+    """
+    def __init__(self, maxsize: int, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def configure(self, maxsize: int, ttl: float = None):
+        with self._lock:
+            self.maxsize = maxsize
+            self.ttl = ttl
+            self._data.clear()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires = item
+            if expires is not None and expires <= time():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires: float = None):
+        if self.ttl is not None:
+            deadline = time() + self.ttl
+            expires = deadline if expires is None else min(expires, deadline)
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def discard(self, predicate):
+        # predicate is called with (key, value)
+        with self._lock:
+            for key in [k for k, (v, _) in self._data.items() if predicate(k, v)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# (table, table version, query string) -> collection payload, sized by create_app
+response_cache = TTLCache(1024)
@@ -0,0 +1,60 @@
+import sqlite3
+from os import getenv
+from flask import current_app, has_app_context
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import event, orm
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.pool import QueuePool
+
+
+class Database(SQLAlchemy):
+    # Scoped sessions may pass their own session class_
+    def create_session(self, options):
+        return orm.sessionmaker(db=self, **dict({'class_': SignallingSession}, **options))
+
+
+class ReadSession(SignallingSession):
+    # Bound to the 'read' engine of the current app
+    def __init__(self, db, **options):
+        options.update(bind=db.get_engine(bind='read'), binds={})
+        super().__init__(db, **options)
+
+
+def engine_options(uri: str):
+    options = {
+        'pool_size': int(getenv('DB_POOL_SIZE', 5)),
+        'max_overflow': int(getenv('DB_MAX_OVERFLOW', 10)),
+        'pool_recycle': int(getenv('DB_POOL_RECYCLE', 1800)),
+        'pool_timeout': int(getenv('DB_POOL_TIMEOUT', 30)),
+    }
+    if make_url(uri).get_backend_name() == 'sqlite':
+        # SQLite files default to NullPool, which reopens the file and reruns the pragmas on every checkout
+        options['poolclass'] = QueuePool
+        options['connect_args'] = {'check_same_thread': False}
+    else:
+        options['pool_pre_ping'] = True
+    return options
+
+
+def sqlite_pragmas():
+    return {
+        'journal_mode': getenv('SQLITE_JOURNAL_MODE', 'WAL'),
+        'synchronous': getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),
+        'busy_timeout': int(getenv('SQLITE_BUSY_TIMEOUT', 5000)),
+        'mmap_size': int(getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+        # Negative values are KiB
+        'cache_size': int(getenv('SQLITE_CACHE_SIZE', -64 * 1024)),
+        # Off by default in SQLite, ON DELETE CASCADE depends on it
+        'foreign_keys': 'ON',
+    }
+
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    pragmas = current_app.config['SQLITE_PRAGMAS'] if has_app_context() else sqlite_pragmas()
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
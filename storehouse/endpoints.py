@@ -1,13 +1,29 @@
 import jwt
-from flask import request, jsonify, make_response
-from flask_restful import fields
-from datetime import datetime, timedelta
+import json
+import os
+from collections import namedtuple
+from flask import Blueprint, current_app, g, request, jsonify, make_response, redirect, send_file, send_from_directory, url_for
+from flask_restful import Resource, fields, marshal
+from datetime import date, datetime, timedelta
 from functools import wraps
-from werkzeug.security import check_password_hash
+from sqlalchemy.exc import IntegrityError, StatementError
 
-from storehouse import app
-from storehouse.models import User, Video, Watchlist, Franchise
-from storehouse.utils import GenericsEndpoints, GenericEndpoints
+from storehouse import db
+from storehouse.cache import TTLCache
+from storehouse.feed import get_feed
+from storehouse.hashing import verify_password
+from storehouse.leaderboard import leaderboards
+from storehouse.media import (
+    ChecksumMismatch, create_part, media_path, probe_duration, upload_path, video_path, write_chunk,
+)
+from storehouse.models import User, Video, Watchlist, Franchise, Upload
+from storehouse.progress import buffer as progress_buffer, continue_watching
+from storehouse.search import search
+from storehouse.transcode import enqueue, latest_job, renditions_dir
+from storehouse.serializers import serializer
+from storehouse.utils import (
+    GenericsEndpoints, GenericEndpoints, boolean, cache_headers, decode_cursor, encode_cursor, make_etag, page_size,
+)
 
 
 user_fields = {
@@ -21,13 +37,36 @@ video_fields = {
     'owner_id': fields.Integer,
     'episodes': fields.Integer,
     'is_series': fields.Boolean,
-    'upload_date': fields.DateTime,
+    'upload_date': fields.DateTime(dt_format='iso8601'),
     'score': fields.Float,
+    'rating_count': fields.Integer,
+}
+score_bucket_fields = {
+    'bucket': fields.Integer,
+    'ratings': fields.Integer,
 }
 franchise_fields = {
     'id': fields.Integer,
     'name': fields.String,
 }
+upload_fields = {
+    'id': fields.String,
+    'size': fields.Integer,
+    'offset': fields.Integer,
+}
+progress_fields = {
+    'video_id': fields.Integer,
+    'episode': fields.Integer,
+    'position': fields.Float,
+    'updated': fields.DateTime(dt_format='iso8601'),
+}
+transcode_fields = {
+    'status': fields.String,
+    'progress': fields.Float,
+    'error': fields.String,
+}
+upload_video_fields = ('title', 'owner_id', 'episodes', 'is_series', 'franchise_id', 'order_number', 'duration')
+franchise_title_fields = dict(video_fields, order_number=fields.Integer)
 watchlist_fields = {
     'id': fields.Integer,
     'user_id': fields.Integer,
@@ -38,29 +77,44 @@ watchlist_fields = {
 }
 
 
+CurrentUser = namedtuple('CurrentUser', 'id name email')
+# Verified token -> CurrentUser, entries live until the token expires or TOKEN_CACHE_TTL,
+# whichever comes first, so other workers pick up user changes within the ttl
+token_cache = TTLCache(10000)
+
+auth = Blueprint('auth', __name__)
+
+
+def forget_user(user_id: int):
+    token_cache.discard(lambda token, user: user.id == user_id)
+
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        token = None
-        if 'x-access-token' in request.headers:
-            token = request.headers['x-access-token']
+        token = request.headers.get('x-access-token')
         if not token:
-            return jsonify({'message': 'Token is missing !!'}), 401
+            return {'message': 'Token is missing !!'}, 401
 
-        try:
-            data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
-            current_user = User.query.filter_by(public_id=data['public_id']).first()
-        except:  # TODO make tokens expirable
-            return jsonify({
-                'message': 'Token is invalid !!'
-            }), 401
+        current_user = token_cache.get(token)
+        if current_user is None:
+            try:
+                data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])
+                user = User.get(data['user_id'])
+            except (jwt.InvalidTokenError, KeyError):
+                user = None
+            if not user:
+                return {'message': 'Token is invalid !!'}, 401
+            current_user = CurrentUser(user.id, user.name, user.email)
+            token_cache.set(token, current_user, expires=data.get('exp'))
 
-        return f(current_user, *args, **kwargs)
+        g.current_user = current_user
+        return f(*args, **kwargs)
 
     return decorated
 
 
-@app.route('/users/login', methods=['POST'])
+@auth.route('/users/login', methods=['POST'])
 def login():
     """
     Login endpoint, use this to get your token
@@ -85,10 +139,14 @@ def login():
         description: wrong email or password
       404:
         description: user not found
+      429:
+        description: too many logins in progress, retry after Retry-After seconds
+      503:
+        description: password check took longer than HASH_TIMEOUT, retry after Retry-After seconds
     """
     auth = request.get_json(force=True)
 
-    if not all([auth, auth.get('email'), auth.get('password')]):
+    if not isinstance(auth, dict) or not all([auth.get('email'), auth.get('password')]):
         return make_response(
             'Could not verify',
             401,
@@ -103,11 +161,11 @@ def login():
             {'WWW-Authenticate': 'Basic realm ="User does not exist!"'}
         )
 
-    if check_password_hash(user.password, auth.get('password')):
+    if verify_password(user.password, auth.get('password')):
         token = jwt.encode({
-            'public_id': user.public_id,
+            'user_id': user.id,
             'exp': datetime.utcnow() + timedelta(minutes=30)
-        }, app.config['SECRET_KEY'])
+        }, current_app.config['SECRET_KEY'])
         return make_response(jsonify({'token': token}), 201)
 
     return make_response(
@@ -117,7 +175,7 @@ def login():
     )
 
 
-@app.route('/users/signup', methods=['POST'])
+@auth.route('/users/signup', methods=['POST'])
 def signup():
     """
     Registration endpoint, use this to create a new user
@@ -142,11 +200,21 @@ def signup():
         description: successful registration
       202:
         description: user already exists
+      400:
+        description: not an object, or missing or invalid fields
+      429:
+        description: too many signups in progress, retry after Retry-After seconds
+      503:
+        description: password check took longer than HASH_TIMEOUT, retry after Retry-After seconds
     """
     args = request.get_json(force=True)
+    if not isinstance(args, dict) or not isinstance(args.get('email'), str):
+        return {'error': 'bad request'}, 400
     user = User.query.filter_by(email=args['email']).first()
     if not user:
-        User.create(args)
+        error = User.create(args)
+        if error:
+            return {'error': error}, 400
         return make_response('Successfully registered.', 201)
     return make_response('User already exists. Please Log in.', 202)
 
@@ -161,6 +229,19 @@ class UsersEndpoints(GenericsEndpoints):
         ---
         tags:
           - user
+        parameters:
+          - in: query
+            name: limit
+            description: page size, capped by MAX_PAGE_SIZE
+            type: integer
+          - in: query
+            name: after
+            description: cursor returned as "next" by the previous page
+            type: string
+          - in: query
+            name: format
+            description: pass ndjson to stream every row as newline delimited json
+            type: string
         responses:
           200:
             description: All users data
@@ -176,6 +257,11 @@ class UsersEndpoints(GenericsEndpoints):
 class UserEndpoints(GenericEndpoints):
     model = User
     model_fields = user_fields
+    expandable = {
+        'watchlist': watchlist_fields,
+        'watchlist.target': video_fields,
+        'uploads': video_fields,
+    }
 
     def get(self, model_id):
         """
@@ -188,6 +274,10 @@ class UserEndpoints(GenericEndpoints):
             name: id
             required: true
             type: integer
+          - in: query
+            name: expand
+            description: comma separated relationships to include, any of watchlist, watchlist.target, uploads
+            type: string
         responses:
           200:
             schema:
@@ -201,7 +291,7 @@ class UserEndpoints(GenericEndpoints):
     @token_required
     def put(self, model_id):
         """
-        Update user
+        Create or replace user
         ---
         tags:
           - user
@@ -210,15 +300,20 @@ class UserEndpoints(GenericEndpoints):
             name: id
             required: true
             type: integer
+          - in: header
+            name: Idempotency-Key
+            type: string
+            description: retries with the same key get the stored response instead of writing again
         responses:
-          200:
-            schema:
-              $ref: '#/definitions/User'
-          404:
-            description: User with this id was not found
-            schema: {'error': 'object not found'}
+          201:
+            description: User with this id was created or overwritten
+          400:
+            description: Missing or invalid fields
+            schema: {'error': 'missing fields: name'}
         """
-        return super(UserEndpoints, self).put(model_id)
+        response = super(UserEndpoints, self).put(model_id)
+        forget_user(model_id)
+        return response
 
     @token_required
     def patch(self, model_id):
@@ -240,7 +335,9 @@ class UserEndpoints(GenericEndpoints):
             description: User with this id was not found
             schema: {'error': 'object not found'}
         """
-        return super(UserEndpoints, self).patch(model_id)
+        response = super(UserEndpoints, self).patch(model_id)
+        forget_user(model_id)
+        return response
 
     @token_required
     def delete(self, model_id):
@@ -262,12 +359,17 @@ class UserEndpoints(GenericEndpoints):
             description: User with this id was not found
             schema: {'error': 'object not found'}
         """
-        return super(UserEndpoints, self).delete(model_id)
+        response = super(UserEndpoints, self).delete(model_id)
+        forget_user(model_id)
+        return response
 
 
 class VideoEndpoints(GenericEndpoints):
     model = Video
     model_fields = video_fields
+    expandable = {
+        'histogram': score_bucket_fields,
+    }
 
     def get(self, model_id):
         """
@@ -280,6 +382,10 @@ class VideoEndpoints(GenericEndpoints):
             name: id
             required: true
             type: integer
+          - in: query
+            name: expand
+            description: pass histogram to include rating counts per score bucket
+            type: string
         responses:
           200:
             schema:
@@ -293,7 +399,7 @@ class VideoEndpoints(GenericEndpoints):
     @token_required
     def put(self, model_id):
         """
-        Update video
+        Create or replace video
         ---
         tags:
           - video
@@ -302,13 +408,16 @@ class VideoEndpoints(GenericEndpoints):
             name: id
             required: true
             type: integer
+          - in: header
+            name: Idempotency-Key
+            type: string
+            description: retries with the same key get the stored response instead of writing again
         responses:
-          200:
-            schema:
-              $ref: '#/definitions/Video'
-          404:
-            description: Video with this id was not found
-            schema: {'error': 'object not found'}
+          201:
+            description: Video with this id was created or overwritten
+          400:
+            description: Missing or invalid fields
+            schema: {'error': 'missing fields: name'}
         """
         return super(VideoEndpoints, self).put(model_id)
 
@@ -357,9 +466,122 @@ class VideoEndpoints(GenericEndpoints):
         return super(VideoEndpoints, self).delete(model_id)
 
 
+class VideoStreamEndpoints(Resource):
+    def get(self, model_id):
+        """
+        Stream video, redirects to the adaptive bitrate playlist once it is transcoded.
+        The original file supports Range requests and conditional GET.
+        ---
+        tags:
+          - video
+        parameters:
+          - in: path
+            name: model_id
+            required: true
+            type: integer
+          - in: query
+            name: download
+            description: serve the original file as an attachment
+            type: boolean
+          - in: header
+            name: Range
+            type: string
+        produces:
+          - video/mp4
+        responses:
+          200:
+            description: Whole file
+          206:
+            description: Requested byte range
+          302:
+            description: Redirect to the HLS master playlist
+          304:
+            description: File was not modified
+          404:
+            description: Video with this id or its file was not found
+            schema: {'error': 'object not found'}
+          416:
+            description: Requested range is not satisfiable
+        """
+        video = Video.get(model_id)
+        if not video or not video.file_path:
+            return {'error': 'object not found'}, 404
+        download = 'download' in request.args
+        if not download:
+            job = latest_job(video.id)
+            if job and job.status == 'done':
+                return redirect(url_for('videohlsendpoints', model_id=video.id, filename='master.m3u8'))
+        try:
+            # send_file hands the open file to wsgi.file_wrapper (sendfile) or X-Sendfile
+            # and seeks to the requested range, so nothing is buffered in the worker
+            return send_file(video_path(video.file_path), conditional=True, etag=True, as_attachment=download)
+        except (ValueError, FileNotFoundError):
+            return {'error': 'object not found'}, 404
+
+
+class VideoRenditionsEndpoints(Resource):
+    def get(self, model_id):
+        """
+        Get transcoding state and the renditions of a video
+        ---
+        tags:
+          - video
+        parameters:
+          - in: path
+            name: model_id
+            required: true
+            type: integer
+        responses:
+          200:
+            description: status is queued, running, done or failed, renditions are listed once done
+            schema: {'status': 'string', 'progress': 'float', 'error': 'string', 'master': 'string', 'renditions': []}
+          404:
+            description: Video was never queued for transcoding
+            schema: {'error': 'object not found'}
+        """
+        job = latest_job(model_id)
+        if not job:
+            return {'error': 'object not found'}, 404
+        result = marshal(job, transcode_fields)
+        if job.status == 'done':
+            result['master'] = url_for('videohlsendpoints', model_id=model_id, filename='master.m3u8')
+            result['renditions'] = [
+                dict(rendition, url=url_for('videohlsendpoints', model_id=model_id, filename=f'{rendition["name"]}/index.m3u8'))
+                for rendition in json.loads(job.renditions)
+            ]
+        return result, 200
+
+
+class VideoHlsEndpoints(Resource):
+    mimetypes = {'.m3u8': 'application/vnd.apple.mpegurl', '.ts': 'video/mp2t'}
+
+    def get(self, model_id, filename):
+        """
+        HLS playlists and segments of a transcoded video
+        ---
+        tags:
+          - video
+        responses:
+          200:
+            description: Playlist or segment
+          404:
+            schema: {'error': 'object not found'}
+        """
+        mimetype = self.mimetypes.get(os.path.splitext(filename)[1])
+        if not mimetype:
+            return {'error': 'object not found'}, 404
+        try:
+            return send_from_directory(renditions_dir(model_id), filename, mimetype=mimetype, conditional=True)
+        except ValueError:
+            return {'error': 'object not found'}, 404
+
+
 class VideosEndpoints(GenericsEndpoints):
     model = Video
     model_fields = video_fields
+    filters = {'owner_id': int, 'franchise_id': int, 'is_series': boolean}
+    range_filters = {'upload_date': date.fromisoformat, 'score': float}
+    sortable = ('upload_date', 'score')
 
     @token_required
     def get(self):
@@ -368,6 +590,46 @@ class VideosEndpoints(GenericsEndpoints):
         ---
         tags:
           - video
+        parameters:
+          - in: query
+            name: limit
+            description: page size, capped by MAX_PAGE_SIZE
+            type: integer
+          - in: query
+            name: after
+            description: cursor returned as "next" by the previous page
+            type: string
+          - in: query
+            name: format
+            description: pass ndjson to stream every row as newline delimited json
+            type: string
+          - in: query
+            name: owner_id
+            type: integer
+          - in: query
+            name: franchise_id
+            type: integer
+          - in: query
+            name: is_series
+            type: boolean
+          - in: query
+            name: upload_date_min
+            description: iso date, inclusive
+            type: string
+          - in: query
+            name: upload_date_max
+            description: iso date, inclusive
+            type: string
+          - in: query
+            name: score_min
+            type: number
+          - in: query
+            name: score_max
+            type: number
+          - in: query
+            name: sort
+            description: id, upload_date or score, prefix with - for descending order
+            type: string
         responses:
           200:
             description: All videos data
@@ -379,7 +641,7 @@ class VideosEndpoints(GenericsEndpoints):
     @token_required
     def post(self):
         """
-        Create a new video
+        Create a new video, post a list of videos to create many at once
         ---
         tags:
           - video
@@ -417,10 +679,315 @@ class VideosEndpoints(GenericsEndpoints):
         """
         return super(VideosEndpoints, self).post()
 
+    @token_required
+    def patch(self):
+        """
+        Update many videos, items without an id or unknown ids are reported in errors
+        ---
+        tags:
+          - video
+        parameters:
+          - in: json
+            name: body
+            required: true
+            description: list of video objects with their id
+            type: array
+        responses:
+          200:
+            schema: {'updated': 'integer', 'errors': []}
+          207:
+            description: Some items failed, see errors
+          413:
+            description: Too many items
+        """
+        return super(VideosEndpoints, self).bulk_update()
+
+    @token_required
+    def delete(self):
+        """
+        Delete many videos
+        ---
+        tags:
+          - video
+        parameters:
+          - in: json
+            name: body
+            required: true
+            description: list of video ids
+            type: array
+        responses:
+          200:
+            schema: {'deleted': 'integer', 'errors': []}
+          207:
+            description: Some ids were not found, see errors
+          413:
+            description: Too many items
+        """
+        return super(VideosEndpoints, self).bulk_delete()
+
+
+class LeaderboardEndpoints(Resource):
+    @token_required
+    def get(self, board):
+        """
+        Most watched videos, top counts every watched episode and trending halves
+        older watching every TRENDING_HALF_LIFE seconds
+        ---
+        tags:
+          - video
+        parameters:
+          - in: path
+            name: board
+            required: true
+            type: string
+            enum: [top, trending]
+          - in: query
+            name: limit
+            description: page size, capped by MAX_PAGE_SIZE
+            type: integer
+          - in: query
+            name: offset
+            description: rank to start at, returned as "next" by the previous page
+            type: integer
+        responses:
+          200:
+            description: Highest value first
+            schema: {'items': [], 'next': 'integer'}
+          400:
+            schema: {'error': 'bad request'}
+        """
+        try:
+            limit = page_size(request.args.get('limit'))
+            offset = int(request.args.get('offset', 0))
+            if offset < 0:
+                raise ValueError('offset must not be negative')
+        except ValueError:
+            return {'error': 'bad request'}, 400
+
+        ranked = leaderboards.page(board, offset, limit + 1)
+        videos = {video.id: video for video in Video.read_query().filter(Video.id.in_([i for i, _ in ranked[:limit]]))}
+        items = [
+            dict(marshal(videos[video_id], video_fields), rank=offset + position + 1, value=value)
+            for position, (video_id, value) in enumerate(ranked[:limit]) if video_id in videos
+        ]
+        return {
+            'items': items,
+            'next': offset + limit if len(ranked) > limit else None,
+        }, 200
+
+
+class UploadsEndpoints(Resource):
+    @token_required
+    def post(self):
+        """
+        Start a resumable video upload
+        ---
+        tags:
+          - upload
+        parameters:
+          - in: json
+            name: size
+            required: true
+            description: total file size in bytes
+            type: integer
+          - in: json
+            name: filename
+            type: string
+          - in: json
+            name: title
+            required: true
+            type: string
+          - in: json
+            name: owner_id
+            required: true
+            type: integer
+          - in: json
+            name: duration
+            description: used only if the duration can not be read from the file
+            type: float
+        responses:
+          201:
+            description: Upload created, send chunks to /upload/<id>
+            schema:
+              $ref: '#/definitions/Upload'
+          400:
+            schema: {'error': 'bad request'}
+        """
+        args = request.get_json(force=True)
+        if not isinstance(args, dict):
+            return {'error': 'bad request'}, 400
+        size = args.get('size')
+        if not isinstance(size, int) or size <= 0 or not args.get('title') or not args.get('owner_id'):
+            return {'error': 'bad request'}, 400
+
+        video = {k: v for k, v in args.items() if k in upload_video_fields}
+        # Checked now rather than at finalize, after the whole file was sent; duration may come from the file
+        error = Video.validate(video, partial=True)
+        if error:
+            return {'error': error}, 400
+        upload = Upload(owner_id=args['owner_id'], size=size, filename=args.get('filename'), fields=json.dumps(video))
+        db.session.add(upload)
+        try:
+            db.session.flush()
+        except IntegrityError:
+            db.session.rollback()
+            return {'error': 'owner not found'}, 400
+        create_part(upload.id)
+        db.session.commit()
+        return marshal(upload, upload_fields), 201
+
+
+class UploadEndpoints(Resource):
+    @token_required
+    def get(self, upload_id):
+        """
+        Get upload state, offset is where an interrupted upload continues
+        ---
+        tags:
+          - upload
+        responses:
+          200:
+            schema:
+              $ref: '#/definitions/Upload'
+          404:
+            schema: {'error': 'object not found'}
+        """
+        upload = Upload.query.get(upload_id)
+        if not upload:
+            return {'error': 'object not found'}, 404
+        return marshal(upload, upload_fields), 200
+
+    @token_required
+    def patch(self, upload_id):
+        """
+        Append a chunk, request body is the raw bytes
+        ---
+        tags:
+          - upload
+        consumes:
+          - application/octet-stream
+        parameters:
+          - in: header
+            name: Upload-Offset
+            required: true
+            description: must equal the current upload offset
+            type: integer
+          - in: header
+            name: X-Chunk-SHA256
+            required: true
+            description: hex sha256 of the chunk
+            type: string
+        responses:
+          200:
+            schema:
+              $ref: '#/definitions/Upload'
+          400:
+            description: Checksum mismatch or chunk larger than the rest of the file
+          404:
+            schema: {'error': 'object not found'}
+          409:
+            description: Offset does not match or the upload is being written
+        """
+        upload = Upload.query.get(upload_id)
+        if not upload:
+            return {'error': 'object not found'}, 404
+        checksum = request.headers.get('X-Chunk-SHA256')
+        try:
+            offset = int(request.headers['Upload-Offset'])
+        except (KeyError, ValueError):
+            return {'error': 'bad request'}, 400
+        if not checksum:
+            return {'error': 'bad request'}, 400
+        if offset != upload.offset:
+            return {'error': 'offset mismatch', 'offset': upload.offset}, 409
+
+        try:
+            new_offset = write_chunk(upload.id, offset, request.stream, upload.size - offset, checksum)
+        except BlockingIOError:
+            return {'error': 'upload is busy', 'offset': upload.offset}, 409
+        except ChecksumMismatch:
+            return {'error': 'checksum mismatch', 'offset': upload.offset}, 400
+        except ValueError:
+            return {'error': 'chunk exceeds upload size', 'offset': upload.offset}, 400
+
+        upload.offset = new_offset
+        db.session.commit()
+        return marshal(upload, upload_fields), 200
+
+
+class UploadFinalizeEndpoints(Resource):
+    @token_required
+    def post(self, upload_id):
+        """
+        Finish upload and create the video
+        ---
+        tags:
+          - upload
+        responses:
+          201:
+            schema:
+              $ref: '#/definitions/Video'
+          400:
+            description: Duration could not be determined or the video fields are invalid, the upload is kept
+          404:
+            schema: {'error': 'object not found'}
+          409:
+            description: Upload is not complete
+        """
+        upload = Upload.query.get(upload_id)
+        if not upload:
+            return {'error': 'object not found'}, 404
+        if upload.offset != upload.size:
+            return {'error': 'upload is not complete', 'offset': upload.offset}, 409
+
+        args = json.loads(upload.fields)
+        part = upload_path(upload.id)
+        args['duration'] = probe_duration(part) or args.get('duration')
+        if not args['duration']:
+            return {'error': 'could not determine duration'}, 400
+        error = Video.validate(args)
+        if error:
+            return {'error': error}, 400
+
+        extension = os.path.splitext(upload.filename or '')[1]
+        file_path = os.path.join('videos', upload.id + extension)
+        target = media_path(file_path)
+        video = Video(file_path=file_path, **args)
+        db.session.add(video)
+        db.session.delete(upload)
+        try:
+            # Flushes the video, so its foreign keys and order number are checked here
+            Video.touch()
+            db.session.flush()
+            Video.changed([(None, video.tracked_values())])
+            enqueue(video.id)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(part, target)
+        except StatementError as e:
+            # Unknown franchise or a taken order number, raised before the part is moved
+            db.session.rollback()
+            return {'error': str(e.orig)}, 400
+        except Exception:
+            db.session.rollback()
+            raise
+        try:
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            os.replace(target, part)
+            if isinstance(e, StatementError):
+                return {'error': str(e.orig)}, 400
+            raise
+        return marshal(video, video_fields), 201
+
 
 class WatchlistEndpoints(GenericEndpoints):
     model = Watchlist
     model_fields = watchlist_fields
+    expandable = {
+        'target': video_fields,
+        'user': user_fields,
+    }
 
     @token_required
     def get(self, model_id):
@@ -434,6 +1001,10 @@ class WatchlistEndpoints(GenericEndpoints):
             name: id
             required: true
             type: integer
+          - in: query
+            name: expand
+            description: comma separated relationships to include, any of target, user
+            type: string
         responses:
           200:
             schema:
@@ -447,7 +1018,7 @@ class WatchlistEndpoints(GenericEndpoints):
     @token_required
     def put(self, model_id):
         """
-        Update watchlist
+        Create or replace watchlist
         ---
         tags:
           - watchlist
@@ -456,13 +1027,16 @@ class WatchlistEndpoints(GenericEndpoints):
             name: id
             required: true
             type: integer
+          - in: header
+            name: Idempotency-Key
+            type: string
+            description: retries with the same key get the stored response instead of writing again
         responses:
-          200:
-            schema:
-              $ref: '#/definitions/Watchlist'
-          404:
-            description: Watchlist with this id was not found
-            schema: {'error': 'object not found'}
+          201:
+            description: Watchlist with this id was created or overwritten
+          400:
+            description: Missing or invalid fields
+            schema: {'error': 'missing fields: name'}
         """
         return super(WatchlistEndpoints, self).put(model_id)
 
@@ -514,6 +1088,8 @@ class WatchlistEndpoints(GenericEndpoints):
 class WatchlistsEndpoints(GenericsEndpoints):
     model = Watchlist
     model_fields = watchlist_fields
+    filters = {'user_id': int, 'target_id': int}
+    range_filters = {'score': float}
 
     def get(self):
         """
@@ -521,6 +1097,31 @@ class WatchlistsEndpoints(GenericsEndpoints):
         ---
         tags:
           - watchlist
+        parameters:
+          - in: query
+            name: limit
+            description: page size, capped by MAX_PAGE_SIZE
+            type: integer
+          - in: query
+            name: after
+            description: cursor returned as "next" by the previous page
+            type: string
+          - in: query
+            name: format
+            description: pass ndjson to stream every row as newline delimited json
+            type: string
+          - in: query
+            name: user_id
+            type: integer
+          - in: query
+            name: target_id
+            type: integer
+          - in: query
+            name: score_min
+            type: number
+          - in: query
+            name: score_max
+            type: number
         responses:
           200:
             description: All watchlists data
@@ -532,7 +1133,7 @@ class WatchlistsEndpoints(GenericsEndpoints):
     @token_required
     def post(self):
         """
-        Create a new watchlist
+        Create a new watchlist, post a list of watchlists to create many at once
         ---
         tags:
           - watchlist
@@ -557,10 +1158,59 @@ class WatchlistsEndpoints(GenericsEndpoints):
         """
         return super(WatchlistsEndpoints, self).post()
 
+    @token_required
+    def patch(self):
+        """
+        Update many watchlists, items without an id or unknown ids are reported in errors
+        ---
+        tags:
+          - watchlist
+        parameters:
+          - in: json
+            name: body
+            required: true
+            description: list of watchlist objects with their id
+            type: array
+        responses:
+          200:
+            schema: {'updated': 'integer', 'errors': []}
+          207:
+            description: Some items failed, see errors
+          413:
+            description: Too many items
+        """
+        return super(WatchlistsEndpoints, self).bulk_update()
+
+    @token_required
+    def delete(self):
+        """
+        Delete many watchlists
+        ---
+        tags:
+          - watchlist
+        parameters:
+          - in: json
+            name: body
+            required: true
+            description: list of watchlist ids
+            type: array
+        responses:
+          200:
+            schema: {'deleted': 'integer', 'errors': []}
+          207:
+            description: Some ids were not found, see errors
+          413:
+            description: Too many items
+        """
+        return super(WatchlistsEndpoints, self).bulk_delete()
+
 
 class FranchiseEndpoints(GenericEndpoints):
     model = Franchise
     model_fields = franchise_fields
+    expandable = {
+        'titles': video_fields,
+    }
 
     def get(self, model_id):
         """
@@ -573,6 +1223,10 @@ class FranchiseEndpoints(GenericEndpoints):
             name: id
             required: true
             type: integer
+          - in: query
+            name: expand
+            description: comma separated relationships to include, any of titles
+            type: string
         responses:
           200:
             schema:
@@ -586,7 +1240,7 @@ class FranchiseEndpoints(GenericEndpoints):
     @token_required
     def put(self, model_id):
         """
-        Update franchise
+        Create or replace franchise
         ---
         tags:
           - franchise
@@ -595,13 +1249,16 @@ class FranchiseEndpoints(GenericEndpoints):
             name: id
             required: true
             type: integer
+          - in: header
+            name: Idempotency-Key
+            type: string
+            description: retries with the same key get the stored response instead of writing again
         responses:
-          200:
-            schema:
-              $ref: '#/definitions/Franchise'
-          404:
-            description: Franchise with this id was not found
-            schema: {'error': 'object not found'}
+          201:
+            description: Franchise with this id was created or overwritten
+          400:
+            description: Missing or invalid fields
+            schema: {'error': 'missing fields: name'}
         """
         return super(FranchiseEndpoints, self).put(model_id)
 
@@ -639,6 +1296,10 @@ class FranchiseEndpoints(GenericEndpoints):
             name: id
             required: true
             type: integer
+          - in: query
+            name: expand
+            description: comma separated relationships to include, any of titles
+            type: string
         responses:
           200:
             schema:
@@ -650,6 +1311,74 @@ class FranchiseEndpoints(GenericEndpoints):
         return super(FranchiseEndpoints, self).delete(model_id)
 
 
+class FranchiseTitlesEndpoints(Resource):
+    @token_required
+    def get(self, model_id):
+        """
+        Titles of a franchise in order_number order, or the titles before and after one of them
+        ---
+        tags:
+          - franchise
+        parameters:
+          - in: path
+            name: model_id
+            required: true
+            type: integer
+          - in: query
+            name: limit
+            description: page size, capped by MAX_PAGE_SIZE
+            type: integer
+          - in: query
+            name: after
+            description: cursor returned as "next" by the previous page
+            type: string
+          - in: query
+            name: video_id
+            description: return {"previous", "next"} around this title instead of a page
+            type: integer
+        responses:
+          200:
+            description: Titles without an order_number are not listed
+            schema: {'items': [], 'next': 'string'}
+          400:
+            schema: {'error': 'bad request'}
+          404:
+            description: Franchise was not found or the video is not one of its ordered titles
+            schema: {'error': 'object not found'}
+        """
+        try:
+            limit = page_size(request.args.get('limit'))
+            after = request.args.get('after')
+            after = decode_cursor(after, 'order_number', int)[0] if after else None
+            video_id = int(request.args['video_id']) if 'video_id' in request.args else None
+        except ValueError:
+            return {'error': 'bad request'}, 400
+
+        versions = sorted((model.__tablename__, model.version()) for model in (Franchise, Video))
+        etag = make_etag(versions, model_id, request.query_string.decode())
+        headers = cache_headers(etag)
+        if request.if_none_match.contains(etag):
+            return '', 304, headers
+        if Franchise.read(model_id) is None:
+            return {'error': 'object not found'}, 404
+
+        serialize = serializer(franchise_title_fields)
+        select = serialize.columns(Video)
+        if video_id is not None:
+            order_number = Video.franchise_position(model_id, video_id)
+            if order_number is None:
+                return {'error': 'object not found'}, 404
+            previous, following = Video.franchise_neighbours(model_id, order_number, select)
+            return {
+                'previous': serialize(previous) if previous else None,
+                'next': serialize(following) if following else None,
+            }, 200, headers
+
+        rows = Video.franchise_titles(model_id, select, after, limit + 1)
+        next_cursor = encode_cursor(rows[limit - 1], 'order_number') if len(rows) > limit else None
+        return {'items': serialize.many(rows[:limit]), 'next': next_cursor}, 200, headers
+
+
 class FranchisesEndpoints(GenericsEndpoints):
     model = Franchise
     model_fields = franchise_fields
@@ -661,6 +1390,19 @@ class FranchisesEndpoints(GenericsEndpoints):
         ---
         tags:
           - franchise
+        parameters:
+          - in: query
+            name: limit
+            description: page size, capped by MAX_PAGE_SIZE
+            type: integer
+          - in: query
+            name: after
+            description: cursor returned as "next" by the previous page
+            type: string
+          - in: query
+            name: format
+            description: pass ndjson to stream every row as newline delimited json
+            type: string
         responses:
           200:
             description: All franchises data
@@ -672,7 +1414,7 @@ class FranchisesEndpoints(GenericsEndpoints):
     @token_required
     def post(self):
         """
-        Create a new franchise
+        Create a new franchise, post a list of franchises to create many at once
         ---
         tags:
           - franchise
@@ -687,3 +1429,178 @@ class FranchisesEndpoints(GenericsEndpoints):
               $ref: '#/definitions/Franchise'
         """
         return super(FranchisesEndpoints, self).post()
+
+    @token_required
+    def patch(self):
+        """
+        Update many franchises, items without an id or unknown ids are reported in errors
+        ---
+        tags:
+          - franchise
+        parameters:
+          - in: json
+            name: body
+            required: true
+            description: list of franchise objects with their id
+            type: array
+        responses:
+          200:
+            schema: {'updated': 'integer', 'errors': []}
+          207:
+            description: Some items failed, see errors
+          413:
+            description: Too many items
+        """
+        return super(FranchisesEndpoints, self).bulk_update()
+
+    @token_required
+    def delete(self):
+        """
+        Delete many franchises
+        ---
+        tags:
+          - franchise
+        parameters:
+          - in: json
+            name: body
+            required: true
+            description: list of franchise ids
+            type: array
+        responses:
+          200:
+            schema: {'deleted': 'integer', 'errors': []}
+          207:
+            description: Some ids were not found, see errors
+          413:
+            description: Too many items
+        """
+        return super(FranchisesEndpoints, self).bulk_delete()
+
+
+class SearchEndpoints(Resource):
+    def get(self):
+        """
+        Search videos by title and franchises by name, every word matches as a prefix
+        ---
+        tags:
+          - search
+        parameters:
+          - in: query
+            name: q
+            required: true
+            type: string
+          - in: query
+            name: limit
+            description: results per model, capped by MAX_PAGE_SIZE
+            type: integer
+        responses:
+          200:
+            description: Best matches first
+            schema: {'videos': [], 'franchises': []}
+          400:
+            schema: {'error': 'bad request'}
+        """
+        query = request.args.get('q', '')
+        try:
+            limit = page_size(request.args.get('limit'))
+        except ValueError:
+            return {'error': 'bad request'}, 400
+        if not query.strip():
+            return {'error': 'bad request'}, 400
+        return {
+            'videos': marshal(search(Video, query, limit), video_fields),
+            'franchises': marshal(search(Franchise, query, limit), franchise_fields),
+        }, 200
+
+
+class FeedEndpoints(Resource):
+    @token_required
+    def get(self):
+        """
+        Home page of the current user: continue watching, new titles in the franchises on their
+        watchlist and top rated titles they have not watched yet
+        ---
+        tags:
+          - feed
+        responses:
+          200:
+            description: Stored per user, rebuilt after writes that change it or FEED_TTL seconds.
+              Positions reported to /progress show up once they are saved
+            schema: {'continue_watching': [], 'new_in_franchises': [], 'top_rated': []}
+          304:
+            description: Not modified since the ETag sent in If-None-Match
+          401:
+            description: The user was deleted
+        """
+        feed = get_feed(g.current_user.id)
+        if feed is None:
+            forget_user(g.current_user.id)
+            return {'message': 'Token is invalid !!'}, 401
+        body, built = feed
+        etag = make_etag(g.current_user.id, built.isoformat())
+        headers = cache_headers(etag)
+        if request.if_none_match.contains(etag):
+            return '', 304, headers
+        # Stored encoded, served without marshalling
+        return current_app.response_class(body, mimetype='application/json', headers=headers)
+
+
+class ProgressEndpoints(Resource):
+    @token_required
+    def get(self):
+        """
+        Continue watching, playback positions of the current user, latest first
+        ---
+        tags:
+          - progress
+        parameters:
+          - in: query
+            name: limit
+            type: integer
+        responses:
+          200:
+            schema:
+              type: array
+              items: {'video_id': 'integer', 'episode': 'integer', 'position': 'float', 'updated': 'string'}
+        """
+        try:
+            limit = page_size(request.args.get('limit'))
+        except ValueError:
+            return {'error': 'bad request'}, 400
+        return marshal(continue_watching(g.current_user.id, limit), progress_fields), 200
+
+    @token_required
+    def post(self):
+        """
+        Report playback position, players call this every few seconds
+        ---
+        tags:
+          - progress
+        parameters:
+          - in: json
+            name: video_id
+            required: true
+            type: integer
+          - in: json
+            name: episode
+            type: integer
+            default: 1
+          - in: json
+            name: position
+            required: true
+            description: seconds from the start of the episode
+            type: float
+        responses:
+          202:
+            description: Position is buffered and saved within PROGRESS_FLUSH_INTERVAL seconds
+          400:
+            schema: {'error': 'bad request'}
+        """
+        args = request.get_json(force=True)
+        if not isinstance(args, dict):
+            return {'error': 'bad request'}, 400
+        video_id, episode, position = args.get('video_id'), args.get('episode', 1), args.get('position')
+        if not isinstance(video_id, int) or not isinstance(episode, int) or not isinstance(position, (int, float)):
+            return {'error': 'bad request'}, 400
+        progress_buffer.record(g.current_user.id, video_id, episode, float(position))
+        return '', 202
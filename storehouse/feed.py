@@ -0,0 +1,103 @@
+from datetime import datetime, timedelta
+from flask import current_app
+from flask_restful import fields
+from sqlalchemy import literal, select
+
+from storehouse import db
+from storehouse.models import Feed, User, Video, Watchlist, WatchProgress, dialect_insert
+from storehouse.serializers import dumps, serializer
+
+
+feed_video_fields = {
+    'id': fields.Integer,
+    'title': fields.String,
+    'owner_id': fields.Integer,
+    'franchise_id': fields.Integer(default=None),
+    'episodes': fields.Integer,
+    'is_series': fields.Boolean,
+    'upload_date': fields.DateTime(dt_format='iso8601'),
+    'score': fields.Float,
+    'rating_count': fields.Integer,
+}
+feed_progress_fields = {
+    'episode': fields.Integer,
+    'position': fields.Float,
+    'updated': fields.DateTime(dt_format='iso8601'),
+}
+
+
+def continue_watching(user_id: int, limit: int):
+    serialize, progress = serializer(feed_video_fields), serializer(feed_progress_fields)
+    columns = serialize.columns(Video)
+    rows = db.session.query(*columns, *progress.columns(WatchProgress)).join(
+        WatchProgress, WatchProgress.video_id == Video.id
+    ).filter(WatchProgress.user_id == user_id).order_by(WatchProgress.updated.desc()).limit(limit)
+    return [dict(serialize(row[:len(columns)]), **progress(row[len(columns):])) for row in rows]
+
+
+def new_in_franchises(user_id: int, limit: int):
+    """Latest titles of the franchises on the watchlist of the user, leaving out the ones already on it"""
+    serialize = serializer(feed_video_fields)
+    watched = db.session.query(Watchlist.target_id).filter(Watchlist.user_id == user_id)
+    followed = db.session.query(Video.franchise_id).filter(Video.id.in_(watched), Video.franchise_id.isnot(None))
+    rows = db.session.query(*serialize.columns(Video)).filter(
+        Video.franchise_id.in_(followed), Video.id.notin_(watched)
+    ).order_by(Video.upload_date.desc(), Video.id.desc()).limit(limit)
+    return serialize.many(rows)
+
+
+def top_rated(user_id: int, limit: int):
+    serialize = serializer(feed_video_fields)
+    watched = db.session.query(Watchlist.target_id).filter(Watchlist.user_id == user_id)
+    rows = db.session.query(*serialize.columns(Video)).filter(
+        Video.rating_count > 0, Video.id.notin_(watched)
+    ).order_by(Video.score.desc(), Video.id.desc()).limit(limit)
+    return serialize.many(rows)
+
+
+def build(user_id: int):
+    limit = current_app.config['FEED_SECTION_SIZE']
+    return dumps({
+        'continue_watching': continue_watching(user_id, limit),
+        'new_in_franchises': new_in_franchises(user_id, limit),
+        'top_rated': top_rated(user_id, limit),
+    }).encode()
+
+
+def get_feed(user_id: int):
+    """
+    (body, built) of the stored feed of the user, built first when it is missing,
+    was invalidated by a write or is older than FEED_TTL. Top rated titles only change
+    with the ttl, the other sections are invalidated by the writes they depend on.
+    None when the user is gone.
+    """
+    row = db.session.query(Feed.generation, Feed.body, Feed.built).filter(Feed.user_id == user_id).first()
+    db.session.commit()
+    expired = datetime.utcnow() - timedelta(seconds=current_app.config['FEED_TTL'])
+    if row is not None and row.body is not None and row.built > expired:
+        return row.body, row.built
+
+    if row is None:
+        # Invalidations only reach existing rows, so one is there before the build reads anything.
+        # Selected from user, a user deleted since their token was verified gets no row
+        statement = dialect_insert(Feed.__table__).from_select(
+            ['user_id', 'generation'], select(User.id, literal(0)).where(User.id == user_id),
+        )
+        db.session.execute(statement.on_conflict_do_nothing(index_elements=['user_id']))
+        db.session.commit()
+        generation = db.session.query(Feed.generation).filter(Feed.user_id == user_id).scalar()
+        db.session.commit()
+        if generation is None:
+            return None
+    else:
+        generation = row.generation
+
+    body = build(user_id)
+    db.session.commit()
+    built = datetime.utcnow()
+    # Not stored when a write invalidated the feed during the build, the next read builds again
+    db.session.query(Feed).filter(Feed.user_id == user_id, Feed.generation == generation).update(
+        {Feed.body: body, Feed.built: built}, synchronize_session=False,
+    )
+    db.session.commit()
+    return body, built
@@ -0,0 +1,66 @@
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from flask import current_app
+from multiprocessing import get_context
+from threading import BoundedSemaphore, Lock
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class HashingBusy(TooManyRequests):
+    description = 'Too many password checks in progress, try again later.'
+
+
+class HashingTimeout(ServiceUnavailable):
+    description = 'Password check took too long, try again later.'
+
+
+# Key derivation is CPU bound and holds the GIL, so it runs in worker processes.
+# Each web worker gets its own pool on first use. The workers are spawned, forking
+# would copy a process that runs background threads.
+_executor = None
+_slots = None
+_lock = Lock()
+
+
+def _pool():
+    global _executor, _slots
+    with _lock:
+        if _executor is None:
+            workers = current_app.config['HASH_WORKERS']
+            _executor = ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'))
+            _slots = BoundedSemaphore(workers + current_app.config['HASH_QUEUE_DEPTH'])
+    return _executor, _slots
+
+
+def _run(function, *args):
+    global _executor
+    if not current_app.config['HASH_WORKERS']:
+        return function(*args)
+
+    executor, slots = _pool()
+    if not slots.acquire(blocking=False):
+        raise HashingBusy(retry_after=current_app.config['HASH_RETRY_AFTER'])
+    try:
+        future = executor.submit(function, *args)
+    except BaseException:
+        slots.release()
+        raise
+    # A slot is free once the job is, not when the request stops waiting for it
+    future.add_done_callback(lambda future: slots.release())
+    try:
+        return future.result(timeout=current_app.config['HASH_TIMEOUT'])
+    except TimeoutError:
+        raise HashingTimeout(retry_after=current_app.config['HASH_RETRY_AFTER'])
+    except BrokenProcessPool:
+        with _lock:
+            _executor = None
+        raise
+
+
+def hash_password(password: str):
+    return _run(generate_password_hash, password, current_app.config['PASSWORD_HASH_METHOD'], current_app.config['PASSWORD_SALT_LENGTH'])
+
+
+def verify_password(password_hash: str, password: str):
+    return _run(check_password_hash, password_hash, password)
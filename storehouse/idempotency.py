@@ -0,0 +1,110 @@
+import time
+from datetime import datetime, timedelta
+from flask import g, make_response, request
+from hashlib import sha256
+
+from storehouse import db
+from storehouse.models import IdempotencyKey, dialect_insert
+
+
+HEADER = 'Idempotency-Key'
+METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+# Worth retrying, so they are not stored
+RETRYABLE = (409, 429)
+# Endpoints that read the body from the stream, whatever its content type. Their headers stand in
+# for the body, reading it here would leave the view an empty stream.
+STREAMED = {'uploadendpoints': ('Upload-Offset', 'X-Chunk-SHA256', 'Content-Length')}
+
+
+class IdempotencyStore:
+    """
+    Stored responses for retried writes. The first request with a key claims it with an
+    INSERT ... ON CONFLICT DO NOTHING, retries get its response back once it finished.
+    Keys are scoped to the access token and kept for ttl seconds.
+    """
+    def __init__(self, ttl: int = 3600):
+        self.ttl = ttl
+        self._purged = 0
+
+    def init_app(self, app):
+        self.ttl = app.config['IDEMPOTENCY_TTL']
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+
+    def before_request(self):
+        key = request.headers.get(HEADER)
+        if not key or request.method not in METHODS:
+            return None
+        key = sha256(f'{request.headers.get("x-access-token", "")}:{key}'.encode()).hexdigest()
+        fingerprint = self.fingerprint()
+        self.purge()
+
+        table = IdempotencyKey.__table__
+        # Own connection, the request's session stays untouched
+        with db.engine.begin() as connection:
+            statement = dialect_insert(table).values(key=key, fingerprint=fingerprint, created=datetime.utcnow())
+            claimed = connection.execute(statement.on_conflict_do_nothing(index_elements=['key'])).rowcount
+            stored = None if claimed else connection.execute(table.select().where(table.c.key == key)).first()
+        if claimed:
+            g.idempotency_key = key
+            return None
+        if stored.fingerprint != fingerprint:
+            return {'error': f'{HEADER} was used for another request'}, 422
+        if stored.status is None:
+            return {'error': f'a request with this {HEADER} is in progress'}, 409
+        response = make_response(stored.body, stored.status)
+        response.content_type = stored.content_type
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+
+    def after_request(self, response):
+        key = g.pop('idempotency_key', None)
+        if key is None:
+            return response
+        if response.status_code >= 500 or response.status_code in RETRYABLE or response.is_streamed:
+            db.session.rollback()
+            self.release(key)
+            return response
+
+        table = IdempotencyKey.__table__
+        with db.engine.begin() as connection:
+            connection.execute(table.update().where(table.c.key == key).values(
+                status=response.status_code, body=response.get_data(), content_type=response.content_type,
+            ))
+        return response
+
+    def teardown_request(self, exception):
+        # after_request did not run, let the client retry
+        key = g.pop('idempotency_key', None)
+        if key is not None:
+            db.session.rollback()
+            self.release(key)
+
+    @staticmethod
+    def fingerprint():
+        digest = sha256(f'{request.method} {request.full_path}'.encode())
+        headers = STREAMED.get(request.endpoint)
+        if headers:
+            digest.update(' '.join(request.headers.get(name, '') for name in headers).encode())
+        else:
+            digest.update(request.get_data())
+        return digest.hexdigest()
+
+    @staticmethod
+    def release(key: str):
+        table = IdempotencyKey.__table__
+        with db.engine.begin() as connection:
+            connection.execute(table.delete().where(table.c.key == key))
+
+    def purge(self):
+        # At most once a minute per worker, so keys may outlive ttl by that much
+        if time.monotonic() - self._purged < 60:
+            return
+        self._purged = time.monotonic()
+        table = IdempotencyKey.__table__
+        with db.engine.begin() as connection:
+            connection.execute(table.delete().where(table.c.created < datetime.utcnow() - timedelta(seconds=self.ttl)))
+
+
+store = IdempotencyStore()
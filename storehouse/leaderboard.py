@@ -0,0 +1,251 @@
+import click
+import math
+import time
+from bisect import bisect_left, insort
+from collections import defaultdict
+from datetime import datetime, timedelta
+from flask.cli import AppGroup
+from sqlalchemy import case, event, func, select
+from threading import Lock
+
+from storehouse import db
+from storehouse.models import LeaderboardScore, Video, Watchlist, chunked, dialect_insert
+from storehouse.periodic import PeriodicTask
+
+
+# Decayed values are stored as value * 2 ** (t / half_life - era * ERA), so adding
+# activity never rescales the other entries. ERA half-lives keep the floats in range.
+ERA = 64
+
+leaderboard_cli = AppGroup('leaderboard', help='Top and trending video commands.')
+
+
+def merge(entry: tuple, delta: tuple):
+    # Sum of two (era, value) pairs expressed in the later era, older eras fade to 0
+    if entry is None or delta is None:
+        return entry or delta
+    (era, value), (delta_era, delta_value) = entry, delta
+    if era < delta_era:
+        return delta_era, value * 2.0 ** ((era - delta_era) * ERA) + delta_value
+    return era, value + delta_value * 2.0 ** ((delta_era - era) * ERA)
+
+
+def watched(row: dict):
+    # Episodes watched by one watchlist row, rewatches included
+    if not row:
+        return 0
+    return (row.get('episodes') or 0) * (1 + (row.get('rewatches') or 0))
+
+
+def watch_deltas(changes: list):
+    """Per-video (top, trending) amounts of (old, new) watchlist rows"""
+    top, trending = defaultdict(int), defaultdict(int)
+    for old, new in changes:
+        if old:
+            top[old['target_id']] -= watched(old)
+        if new:
+            top[new['target_id']] += watched(new)
+            # Only new watching heats a video up, corrections downwards do not cool it
+            same = old and old['target_id'] == new['target_id']
+            gained = watched(new) - (watched(old) if same else 0)
+            if gained > 0:
+                trending[new['target_id']] += gained
+    return {'top': top, 'trending': trending}
+
+
+class Leaderboard:
+    """
+    Videos sorted by value, highest first. With a half_life the values decay
+    exponentially, so recent watching outranks older watching of the same size.
+    """
+    def __init__(self, name: str, half_life: float = None):
+        self.name = name
+        self.half_life = half_life
+        self.entries = {}
+        # (-rank, video_id) kept sorted with bisect
+        self.index = []
+
+    def era(self, now: float):
+        """(era, weight of one unit added at now)"""
+        if not self.half_life:
+            return 0, 1.0
+        exponent = now / self.half_life
+        era = int(exponent // ERA)
+        return era, 2.0 ** (exponent - era * ERA)
+
+    def rank(self, era: int, value: float):
+        return era * ERA + math.log2(value) if self.half_life else value
+
+    def set(self, video_id: int, era: int, value: float):
+        old = self.entries.pop(video_id, None)
+        if old is not None:
+            del self.index[bisect_left(self.index, (-self.rank(*old), video_id))]
+        if value > 0:
+            self.entries[video_id] = (era, value)
+            insort(self.index, (-self.rank(era, value), video_id))
+
+    def page(self, offset: int, limit: int, now: float):
+        """[(video_id, value as of now)]"""
+        era, weight = self.era(now)
+        return [
+            (video_id, merge((era, 0.0), self.entries[video_id])[1] / weight)
+            for _, video_id in self.index[offset:offset + limit]
+        ]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def upsert_scores(rows: list):
+    # Same sum as merge(), so every worker can add its deltas without reading first
+    table = LeaderboardScore.__table__
+    statement = dialect_insert(table)
+    old, new = table.c, statement.excluded
+    fade = 2.0 ** -ERA
+    statement = statement.on_conflict_do_update(
+        index_elements=['board', 'video_id'],
+        set_={
+            'value': case(
+                (old.era == new.era, old.value + new.value),
+                (old.era == new.era - 1, old.value * fade + new.value),
+                (old.era == new.era + 1, old.value + new.value * fade),
+                (old.era < new.era, new.value),
+                else_=old.value,
+            ),
+            'era': case((old.era < new.era, new.era), else_=old.era),
+            'updated': new.updated,
+        },
+    )
+    for chunk in chunked(rows, 1000):
+        db.session.execute(statement, chunk)
+
+
+class Leaderboards:
+    """
+    In-process top and trending boards, updated as watchlist rows commit. Deltas are
+    added to the leaderboard_score snapshot every snapshot_interval seconds, which also
+    brings in what other workers wrote, so a restart loads the snapshot instead of
+    aggregating every watchlist.
+    """
+    def __init__(self, boards: list, snapshot_interval: float = 30):
+        self.app = None
+        self.boards = {board.name: board for board in boards}
+        self.snapshot_interval = snapshot_interval
+        self._pending = {}
+        self._synced = None
+        self._lock = Lock()
+        self._syncer = PeriodicTask('leaderboard-sync', self.sync, 'Could not sync leaderboards')
+
+    def init_app(self, app):
+        self.app = app
+        self.boards['trending'].half_life = app.config['TRENDING_HALF_LIFE']
+        self.snapshot_interval = app.config['LEADERBOARD_SNAPSHOT_INTERVAL']
+
+    def record(self, changes: list):
+        now = time.time()
+        with self._lock:
+            for name, amounts in watch_deltas(changes).items():
+                board = self.boards[name]
+                era, weight = board.era(now)
+                for video_id, amount in amounts.items():
+                    if amount:
+                        delta = (era, amount * weight)
+                        board.set(video_id, *merge(board.entries.get(video_id), delta))
+                        self._pending[(name, video_id)] = merge(self._pending.get((name, video_id)), delta)
+            self._syncer.start(self.app, self.snapshot_interval)
+
+    def forget(self, video_ids: list):
+        """Drop deleted videos from the boards, their snapshot rows went with them"""
+        with self._lock:
+            for video_id in video_ids:
+                for board in self.boards.values():
+                    board.set(video_id, 0, 0)
+                    self._pending.pop((board.name, video_id), None)
+
+    def page(self, name: str, offset: int, limit: int):
+        if self._synced is None:
+            # First read of this worker loads the whole snapshot
+            self.sync()
+        with self._lock:
+            self._syncer.start(self.app, self.snapshot_interval)
+            return self.boards[name].page(offset, limit, time.time())
+
+    def sync(self):
+        """Write the pending deltas, then load the snapshot rows changed since the last sync"""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        now = datetime.utcnow()
+        try:
+            # Videos deleted by another worker would fail the foreign key
+            existing = Video.existing_ids([video_id for _, video_id in batch])
+            if batch:
+                upsert_scores([
+                    {'board': board, 'video_id': video_id, 'era': era, 'value': value, 'updated': now}
+                    for (board, video_id), (era, value) in batch.items() if video_id in existing
+                ])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            with self._lock:
+                for key, delta in batch.items():
+                    self._pending[key] = merge(self._pending.get(key), delta)
+            raise
+
+        query = LeaderboardScore.query
+        if self._synced is not None:
+            # Overlap a little, a slow worker may commit rows stamped before our last sync
+            query = query.filter(LeaderboardScore.updated >= self._synced - timedelta(seconds=2 * self.snapshot_interval))
+        rows = query.all()
+        db.session.commit()
+        self.forget({video_id for _, video_id in batch} - existing)
+        with self._lock:
+            for row in rows:
+                if row.board in self.boards:
+                    # Deltas recorded while syncing are not in the snapshot yet
+                    entry = merge((row.era, row.value), self._pending.get((row.board, row.video_id)))
+                    self.boards[row.board].set(row.video_id, *entry)
+            self._synced = now
+        return len(batch)
+
+    def stop(self):
+        self._syncer.stop()
+
+
+# Half life and snapshot interval come from the app config in init_app
+leaderboards = Leaderboards([Leaderboard('top'), Leaderboard('trending', half_life=3 * 24 * 3600)])
+
+
+@event.listens_for(db.session, 'after_commit')
+def record_watchlist_changes(session):
+    changes = session.info.pop('watchlist_changes', None)
+    if changes:
+        leaderboards.record(changes)
+    deleted = session.info.pop('deleted_videos', None)
+    if deleted:
+        leaderboards.forget(deleted)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_watchlist_changes(session):
+    session.info.pop('watchlist_changes', None)
+    session.info.pop('deleted_videos', None)
+
+
+@leaderboard_cli.command('rebuild')
+def rebuild():
+    """Recompute the top board from watchlists, trending keeps its snapshot as it has no history."""
+    watchlist = Watchlist.__table__
+    amount = func.sum(watchlist.c.episodes * (1 + func.coalesce(watchlist.c.rewatches, 0)))
+    now = datetime.utcnow()
+    rows = [
+        {'board': 'top', 'video_id': video_id, 'era': 0, 'value': value or 0, 'updated': now}
+        for video_id, value in db.session.execute(
+            select(watchlist.c.target_id, amount).group_by(watchlist.c.target_id)
+        )
+    ]
+    db.session.execute(LeaderboardScore.__table__.delete().where(LeaderboardScore.board == 'top'))
+    for chunk in chunked(rows, 1000):
+        db.session.execute(LeaderboardScore.__table__.insert(), chunk)
+    db.session.commit()
+    click.echo(f'Rebuilt top board of {len(rows)} videos, web workers pick it up on their next sync')
+
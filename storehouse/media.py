@@ -0,0 +1,111 @@
+import fcntl
+import os
+import shutil
+import subprocess
+from contextlib import suppress
+from flask import current_app
+from hashlib import sha256
+from sqlalchemy import event
+from werkzeug.utils import safe_join
+
+from storehouse import db
+
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class ChecksumMismatch(ValueError):
+    pass
+
+
+def media_path(relative: str):
+    # Stored paths are relative to MEDIA_ROOT and must not escape it
+    path = safe_join(current_app.config['MEDIA_ROOT'], relative)
+    if path is None:
+        raise ValueError(f'Unsafe media path {relative}')
+    return path
+
+
+def video_path(relative: str):
+    # Video files live under MEDIA_ROOT/videos, links included
+    directory = os.path.realpath(os.path.join(current_app.config['MEDIA_ROOT'], 'videos'))
+    path = os.path.realpath(media_path(relative))
+    if not path.startswith(directory + os.sep):
+        raise ValueError(f'Not a video file {relative}')
+    return path
+
+
+def upload_path(upload_id: str):
+    return media_path(os.path.join('uploads', f'{upload_id}.part'))
+
+
+def remove_after_commit(files=(), directories=()):
+    """Remove these media paths once the current transaction commits, a rollback keeps them"""
+    removed = db.session.info.setdefault('deleted_media', [])
+    removed.extend((relative, False) for relative in files)
+    removed.extend((relative, True) for relative in directories)
+
+
+@event.listens_for(db.session, 'after_commit')
+def remove_deleted_media(session):
+    for relative, directory in session.info.pop('deleted_media', ()):
+        # Already gone or never written, stored paths that escape MEDIA_ROOT are left alone
+        with suppress(OSError, ValueError):
+            if directory:
+                shutil.rmtree(media_path(relative))
+            else:
+                os.remove(media_path(relative))
+
+
+@event.listens_for(db.session, 'after_rollback')
+def keep_deleted_media(session):
+    session.info.pop('deleted_media', None)
+
+
+def create_part(upload_id: str):
+    path = upload_path(upload_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+
+
+def write_chunk(upload_id: str, offset: int, stream, limit: int, checksum: str):
+    """
+    Copy stream into the upload file at offset in CHUNK_SIZE blocks and return the new offset.
+    On a bad checksum or oversized chunk the file is truncated back to offset.
+    Raises BlockingIOError if another request is writing the same upload.
+    """
+    digest = sha256()
+    written = 0
+    with open(upload_path(upload_id), 'r+b') as file:
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # Drop leftovers of an interrupted chunk past the committed offset
+        file.truncate(offset)
+        file.seek(offset)
+        while written <= limit:
+            block = stream.read(min(CHUNK_SIZE, limit + 1 - written))
+            if not block:
+                break
+            digest.update(block)
+            file.write(block)
+            written += len(block)
+
+        if written > limit:
+            file.truncate(offset)
+            raise ValueError('Chunk exceeds declared upload size')
+        if digest.hexdigest() != checksum.lower():
+            file.truncate(offset)
+            raise ChecksumMismatch('Chunk checksum does not match')
+        file.flush()
+        os.fsync(file.fileno())
+    return offset + written
+
+
+def probe_duration(path: str):
+    try:
+        result = subprocess.run(
+            ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', path],
+            capture_output=True, text=True, timeout=60, check=True,
+        )
+        return float(result.stdout.strip())
+    except (OSError, subprocess.SubprocessError, ValueError):
+        return None
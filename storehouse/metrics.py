@@ -0,0 +1,206 @@
+import cProfile
+import os
+import random
+import time
+from collections import Counter, defaultdict
+from flask import Blueprint, Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from threading import Lock
+
+
+# Upper bounds in seconds of the request duration histogram
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Label for queries run outside a request, e.g. by the flush and sync threads
+BACKGROUND = 'background'
+
+metrics_blueprint = Blueprint('metrics', __name__)
+
+
+class RequestStats:
+    __slots__ = ('start', 'queries', 'db', 'encode', 'statements', 'profile')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db = 0.0
+        self.encode = 0.0
+        self.statements = Counter()
+        self.profile = None
+
+
+class Metrics:
+    """
+    Opt-in request and query instrumentation. Counters live in the process, every
+    web worker reports its own through /metrics.
+    """
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.slow_query = 0.1
+        self.repeated_query = 10
+        self.profile_rate = 0.0
+        self.profile_dir = None
+        self._lock = Lock()
+        self._requests = Counter()
+        self._durations = defaultdict(lambda: [0] * (len(BUCKETS) + 1))
+        self._duration_sums = Counter()
+        self._queries = Counter()
+        self._query_seconds = Counter()
+        self._slow_queries = Counter()
+        self._encode_seconds = Counter()
+
+    def init_app(self, app):
+        if not app.config['METRICS_ENABLED']:
+            return
+        self.app = app
+        self.enabled = True
+        self.slow_query = app.config['SLOW_QUERY_MS'] / 1000
+        self.repeated_query = app.config['REPEATED_QUERY_WARNING']
+        self.profile_rate = app.config['PROFILE_SAMPLE_RATE']
+        self.profile_dir = app.config['PROFILE_DIR']
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.register_blueprint(metrics_blueprint)
+        if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+    def instrument(self, api):
+        """Time how long the API representations take to encode responses"""
+        if self.enabled:
+            api.representations = {
+                mediatype: timed_representation(output) for mediatype, output in api.representations.items()
+            }
+
+    def before_request(self):
+        g.metrics = stats = RequestStats()
+        if self.profile_rate and random.random() < self.profile_rate:
+            stats.profile = cProfile.Profile()
+            try:
+                stats.profile.enable()
+            except ValueError:
+                # Another profiler is running
+                stats.profile = None
+
+    def after_request(self, response):
+        stats = g.pop('metrics', None)
+        if stats is None:
+            return response
+        if stats.profile is not None:
+            stats.profile.disable()
+            self.dump_profile(stats.profile)
+        elapsed = time.perf_counter() - stats.start
+        endpoint = request.endpoint or 'unmatched'
+
+        with self._lock:
+            self._requests[(endpoint, request.method, response.status_code)] += 1
+            buckets = self._durations[endpoint]
+            buckets[next((i for i, bound in enumerate(BUCKETS) if elapsed <= bound), len(BUCKETS))] += 1
+            self._duration_sums[endpoint] += elapsed
+            self._encode_seconds[endpoint] += stats.encode
+
+        # The same statement over and over is usually a lazy relationship loaded per row
+        for statement, count in stats.statements.items():
+            if count >= self.repeated_query:
+                self.app.logger.warning('%s ran the same query %d times: %s', endpoint, count, statement)
+
+        response.headers['Server-Timing'] = ', '.join((
+            f'db;dur={stats.db * 1000:.1f};desc="{stats.queries} queries"',
+            f'encode;dur={stats.encode * 1000:.1f}',
+            f'total;dur={elapsed * 1000:.1f}',
+        ))
+        return response
+
+    def record_query(self, statement: str, elapsed: float):
+        stats = g.get('metrics') if has_request_context() else None
+        endpoint = (request.endpoint or 'unmatched') if stats is not None else BACKGROUND
+        if stats is not None:
+            stats.queries += 1
+            stats.db += elapsed
+            stats.statements[statement] += 1
+        slow = elapsed >= self.slow_query
+        with self._lock:
+            self._queries[endpoint] += 1
+            self._query_seconds[endpoint] += elapsed
+            if slow:
+                self._slow_queries[endpoint] += 1
+        if slow:
+            self.app.logger.warning('Slow query, %.1fms on %s: %s', elapsed * 1000, endpoint, statement)
+
+    def dump_profile(self, profile):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        filename = f'{time.time_ns()}-{request.endpoint or "unmatched"}.prof'
+        profile.dump_stats(os.path.join(self.profile_dir, filename))
+
+    def render(self):
+        """Prometheus text exposition format"""
+        with self._lock:
+            requests = sorted(self._requests.items())
+            durations = {endpoint: list(buckets) for endpoint, buckets in self._durations.items()}
+            sums = dict(self._duration_sums)
+            counters = [
+                ('storehouse_db_queries_total', 'SQL statements executed', dict(self._queries)),
+                ('storehouse_db_seconds_total', 'Time spent executing SQL statements', dict(self._query_seconds)),
+                ('storehouse_slow_queries_total', 'SQL statements slower than SLOW_QUERY_MS', dict(self._slow_queries)),
+                ('storehouse_encode_seconds_total', 'Time spent encoding response bodies', dict(self._encode_seconds)),
+            ]
+
+        lines = [
+            '# HELP storehouse_requests_total Requests handled',
+            '# TYPE storehouse_requests_total counter',
+        ]
+        for (endpoint, method, status), count in requests:
+            lines.append(f'storehouse_requests_total{labels(endpoint=endpoint, method=method, status=status)} {count}')
+
+        lines += [
+            '# HELP storehouse_request_duration_seconds Time from the start of the request to the response',
+            '# TYPE storehouse_request_duration_seconds histogram',
+        ]
+        for endpoint, buckets in sorted(durations.items()):
+            total = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), buckets):
+                total += count
+                lines.append(f'storehouse_request_duration_seconds_bucket{labels(endpoint=endpoint, le=bound)} {total}')
+            lines.append(f'storehouse_request_duration_seconds_sum{labels(endpoint=endpoint)} {sums[endpoint]}')
+            lines.append(f'storehouse_request_duration_seconds_count{labels(endpoint=endpoint)} {total}')
+
+        for name, help_text, values in counters:
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+            for endpoint, value in sorted(values.items()):
+                lines.append(f'{name}{labels(endpoint=endpoint)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def labels(**values):
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for value in values.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(values, escaped)) + '}'
+
+
+def timed_representation(output):
+    def timed(data, code, headers=None):
+        start = time.perf_counter()
+        response = output(data, code, headers)
+        stats = g.get('metrics')
+        if stats is not None:
+            stats.encode += time.perf_counter() - start
+        return response
+    return timed
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    if metrics.enabled:
+        metrics.record_query(statement, elapsed)
+
+
+@metrics_blueprint.route('/metrics')
+def scrape():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+metrics = Metrics()
@@ -1,10 +1,123 @@
-from datetime import date
-from werkzeug.security import generate_password_hash
+import os
+from collections import Counter, defaultdict
+from datetime import date, datetime
+from uuid import uuid4
+from sqlalchemy import bindparam, case, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import StatementError
 
-from storehouse import db
+from storehouse import db, read_session
+from storehouse.cache import response_cache
+from storehouse.hashing import hash_password
+from storehouse.media import remove_after_commit
+
+
+class TableVersion(db.Model):
+    # Change counter per table, bumped in the same transaction as every write
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, default=0, nullable=False)
+
+    @classmethod
+    def current(cls, name: str):
+        return read_session.query(cls.version).filter_by(name=name).scalar() or 0
+
+    @classmethod
+    def bump(cls, name: str):
+        updated = cls.query.filter_by(name=name).update({cls.version: cls.version + 1})
+        if not updated:
+            db.session.add(cls(name=name, version=1))
+
+
+# Ratings are 0-10, the last bucket also holds 10
+SCORE_BUCKETS = 10
+
+
+def score_bucket(score: float):
+    return min(max(int(score), 0), SCORE_BUCKETS - 1)
+
+
+def dialect_insert(table):
+    # INSERT with on_conflict_do_update, available for SQLite and Postgres
+    dialect = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+    return dialect.insert(table)
+
+
+def chunked(items: list, size: int = 500):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class NotFound(LookupError):
+    pass
+
+
+def column_default(column):
+    default = column.default
+    return default.arg if default is not None and default.is_scalar else None
+
+
+def coerce(column, value):
+    """value as the python type of the column, dates may be ISO strings. Raises ValueError otherwise"""
+    python_type = column.type.python_type
+    if python_type in (date, datetime) and isinstance(value, str):
+        # Dates are serialized as midnight datetimes, so those are taken back too
+        parsed = datetime.fromisoformat(value)
+        return parsed.date() if python_type is date else parsed
+    # bool is an int, but not a number a client meant to send
+    if isinstance(value, bool) and python_type is not bool:
+        raise ValueError(column.name)
+    if python_type is float and isinstance(value, int):
+        return float(value)
+    if not isinstance(value, python_type):
+        raise ValueError(column.name)
+    return value
+
+
+def write_lock():
+    """
+    Begin the transaction with the write lock on SQLite, so rows read to diff a write against can
+    not change before it commits. pysqlite only begins at the first write and FOR UPDATE is
+    ignored there, other databases lock the rows read with FOR UPDATE instead.
+    """
+    connection = db.session.connection()
+    if connection.dialect.name == 'sqlite' and not connection.connection.dbapi_connection.in_transaction:
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
 
 
 class CRUDs:
+    # Columns passed to changed(), for models that keep aggregates of their rows elsewhere
+    tracked = ()
+    # Columns derived from other rows, clients can not write them
+    read_only = ()
+
+    @classmethod
+    def changed(cls, changes: list):
+        """
+        Runs in the write transaction with (old, new) dicts of the tracked columns
+        of every written row, old is None for created and new is None for deleted rows
+        """
+
+    @classmethod
+    def deleting(cls, ids: list):
+        """
+        Runs in the delete transaction before the rows with these ids go, for models
+        whose rows take others with them through ON DELETE CASCADE
+        """
+
+    @classmethod
+    def snapshot(cls, ids: list, lock: bool = False):
+        # lock keeps the rows from changing until the transaction ends
+        rows = {}
+        if cls.tracked:
+            if lock:
+                write_lock()
+            columns = [cls.id] + [getattr(cls, name) for name in cls.tracked]
+            for chunk in chunked(list(set(ids))):
+                query = db.session.query(*columns).filter(cls.id.in_(chunk))
+                query = query.with_for_update() if lock else query
+                rows.update((row.id, {name: getattr(row, name) for name in cls.tracked}) for row in query)
+        return rows
+
     @classmethod
     def get(cls, model_id: int):
         return cls.query.get(model_id)
@@ -13,53 +126,353 @@ class CRUDs:
     def get_all(cls):
         return cls.query.all()
 
+    @classmethod
+    def read_query(cls):
+        # Read-only endpoints go through the separate read pool
+        return read_session.query(cls)
+
+    @classmethod
+    def read(cls, model_id: int, options: list = ()):
+        return cls.read_query().options(*options).get(model_id)
+
+    @classmethod
+    def get_page(cls, after: tuple = None, limit: int = 50, filters: list = (), sort: str = 'id', descending=False,
+                 select: list = None):
+        # Keyset pagination over (sort, id), after is the position of the last row of the previous page
+        # select returns rows of those columns instead of model instances
+        columns = (cls.id,) if sort == 'id' else (getattr(cls, sort), cls.id)
+        query = cls.read_query() if select is None else read_session.query(*select, *columns)
+        query = query.filter(*filters)
+        if after is not None:
+            position = tuple_(*columns)
+            query = query.filter(position < after if descending else position > after)
+        order = [column.desc() if descending else column for column in columns]
+        return query.order_by(*order).limit(limit).all()
+
+    @classmethod
+    def iter_all(cls, filters: list = (), batch_size: int = 1000, select: list = None):
+        # Server-side cursor, rows are hydrated batch_size at a time
+        query = cls.read_query() if select is None else read_session.query(*select)
+        query = query.filter(*filters).order_by(cls.id)
+        return query.execution_options(stream_results=True).yield_per(batch_size)
+
+    @classmethod
+    def version(cls):
+        return TableVersion.current(cls.__tablename__)
+
+    @classmethod
+    def touch(cls):
+        TableVersion.bump(cls.__tablename__)
+        response_cache.discard(lambda key, value: key[0] == cls.__tablename__)
+
+    def tracked_values(self):
+        return {name: getattr(self, name) for name in self.tracked}
+
     @classmethod
     def create(cls, fields: dict):
+        """Returns the validation error instead of creating an invalid row"""
+        error = cls.validate(fields)
+        if error:
+            return error
         entry = cls(**fields)
         db.session.add(entry)
+        if cls.tracked:
+            db.session.flush()
+            cls.changed([(None, entry.tracked_values())])
+        cls.touch()
         db.session.commit()
 
     @classmethod
     def update(cls, model_id: int, fields: dict):
-        entry = cls.get(model_id)
-        assert entry, 'User not found'
+        """Returns the validation error instead of writing invalid fields"""
+        error = cls.validate(fields, partial=True)
+        if error:
+            return error
+        # Locked, so a concurrent write can not change the tracked values between snapshot and commit
+        if cls.tracked:
+            write_lock()
+        entry = cls.query.filter(cls.id == model_id).with_for_update().first() if cls.tracked else cls.get(model_id)
+        if entry is None:
+            db.session.rollback()
+            raise NotFound('object not found')
+        old = entry.tracked_values()
         fields = {k: v for k, v in fields.items() if v}
         for field, value in fields.items():
             setattr(entry, field, value)
+        if cls.tracked:
+            cls.changed([(old, entry.tracked_values())])
+        cls.touch()
+        db.session.commit()
+
+    @classmethod
+    def put(cls, model_id: int, fields: dict):
+        """
+        Create the row with this id or replace the existing one with a single
+        INSERT ... ON CONFLICT DO UPDATE, so concurrent PUTs can not both insert.
+        Writable columns left out go back to their defaults, read-only ones keep their values.
+        fields must be a complete object, returns the validation error otherwise.
+        """
+        fields = dict(fields, id=model_id) if isinstance(fields, dict) else fields
+        error = cls.validate(fields)
+        if error:
+            return error
+        old = cls.snapshot([model_id], lock=True).get(model_id)
+        statement = dialect_insert(cls.__table__).values(fields)
+        # excluded holds the defaults of the columns the insert left out
+        columns = cls.__table__.columns
+        updated = {
+            name: statement.excluded[name] for name in columns.keys() if name != 'id' and name not in cls.read_only
+        }
+        statement = statement.on_conflict_do_update(index_elements=['id'], set_=updated) if updated \
+            else statement.on_conflict_do_nothing(index_elements=['id'])
+        db.session.execute(statement)
+        if cls.tracked:
+            new = {name: fields[name] if name in fields else column_default(columns[name]) for name in cls.tracked}
+            cls.changed([(old, new)])
+        cls.touch()
         db.session.commit()
 
     @classmethod
     def delete(cls, model_id: int):
-        db.session.delete(cls.query.get(model_id))
+        """One DELETE statement, dependent rows go with it through ON DELETE CASCADE"""
+        # deleting() may read the dependent rows as well
+        write_lock()
+        old = cls.snapshot([model_id], lock=True).get(model_id)
+        cls.deleting([model_id])
+        if not cls.query.filter(cls.id == model_id).delete(synchronize_session=False):
+            db.session.rollback()
+            raise NotFound('object not found')
+        if cls.tracked:
+            cls.changed([(old, None)])
+        cls.touch()
+        db.session.commit()
+
+    @classmethod
+    def existing_ids(cls, ids: list):
+        found = set()
+        for chunk in chunked(list(set(ids))):
+            found.update(row.id for row in db.session.query(cls.id).filter(cls.id.in_(chunk)))
+        return found
+
+    @classmethod
+    def validate(cls, fields, partial: bool = False) -> str:
+        if not isinstance(fields, dict):
+            return 'object expected'
+        columns = cls.__table__.columns
+        unknown = set(fields) - set(columns.keys())
+        if unknown:
+            return f'unknown fields: {", ".join(sorted(unknown))}'
+        read_only = set(fields) & set(cls.read_only)
+        if read_only:
+            return f'read-only fields: {", ".join(sorted(read_only))}'
+        # Converted in place, so the values reach the database as the types its columns bind
+        invalid = []
+        for name, value in fields.items():
+            if value is not None:
+                try:
+                    fields[name] = coerce(columns[name], value)
+                except ValueError:
+                    invalid.append(name)
+        if invalid:
+            return f'invalid fields: {", ".join(sorted(invalid))}'
+        if partial:
+            return None
+        missing = [
+            c.name for c in columns
+            if not (c.nullable or c.primary_key or c.default or c.server_default) and fields.get(c.name) is None
+        ]
+        if missing:
+            return f'missing fields: {", ".join(missing)}'
+
+    @classmethod
+    def bulk_create(cls, items: list):
+        """
+        Insert all valid items in one transaction with executemany.
+        Returns (created count, [{'index', 'error'}]), a failing row does not abort the rest.
+        """
+        errors, rows = [], []
+        for index, fields in enumerate(items):
+            error = cls.validate(fields)
+            if error:
+                errors.append({'index': index, 'error': error})
+            else:
+                rows.append((index, fields))
+
+        try:
+            with db.session.begin_nested():
+                db.session.bulk_insert_mappings(cls, [fields for _, fields in rows])
+            created = [fields for _, fields in rows]
+        except StatementError:
+            # Retry row by row to find out which items are broken
+            created = []
+            for index, fields in rows:
+                try:
+                    with db.session.begin_nested():
+                        db.session.bulk_insert_mappings(cls, [fields])
+                    created.append(fields)
+                except StatementError as e:
+                    errors.append({'index': index, 'error': str(e.orig)})
+        if created:
+            if cls.tracked:
+                cls.changed([(None, {name: fields.get(name) for name in cls.tracked}) for fields in created])
+            cls.touch()
+        db.session.commit()
+        return len(created), sorted(errors, key=lambda e: e['index'])
+
+    @classmethod
+    def bulk_update(cls, items: list):
+        """
+        Update rows by id in one transaction, same rules as update.
+        Returns (updated count, [{'id', 'error'}]).
+        """
+        errors, rows, valid = [], [], []
+        for fields in items:
+            if isinstance(fields, dict) and isinstance(fields.get('id'), int):
+                valid.append(fields)
+            else:
+                errors.append({'id': None, 'error': 'id is required'})
+        # Every item is diffed against the row as it was before the batch, so an id may only appear once
+        repeated = {i for i, count in Counter(fields['id'] for fields in valid).items() if count > 1}
+        errors.extend({'id': fields['id'], 'error': 'duplicate id'} for fields in valid if fields['id'] in repeated)
+        valid = [fields for fields in valid if fields['id'] not in repeated]
+
+        found = cls.existing_ids([fields['id'] for fields in valid])
+        for fields in valid:
+            error = cls.validate(fields, partial=True)
+            if not error and fields['id'] not in found:
+                error = 'object not found'
+            if error:
+                errors.append({'id': fields['id'], 'error': error})
+            else:
+                rows.append({k: v for k, v in fields.items() if v})
+
+        old = cls.snapshot([fields['id'] for fields in rows], lock=True)
+        try:
+            with db.session.begin_nested():
+                db.session.bulk_update_mappings(cls, rows)
+            updated = rows
+        except StatementError:
+            updated = []
+            for fields in rows:
+                try:
+                    with db.session.begin_nested():
+                        db.session.bulk_update_mappings(cls, [fields])
+                    updated.append(fields)
+                except StatementError as e:
+                    errors.append({'id': fields['id'], 'error': str(e.orig)})
+        if updated:
+            if cls.tracked:
+                cls.changed([
+                    (old[fields['id']], dict(old[fields['id']], **{k: v for k, v in fields.items() if k in cls.tracked}))
+                    for fields in updated
+                ])
+            cls.touch()
+        db.session.commit()
+        return len(updated), errors
+
+    @classmethod
+    def bulk_delete(cls, ids: list):
+        """
+        Delete rows by id with one DELETE per chunk of ids.
+        Returns (deleted count, [{'id', 'error'}]).
+        """
+        write_lock()
+        found = cls.existing_ids(ids)
+        errors = [{'id': i, 'error': 'object not found'} for i in ids if i not in found]
+        if found and cls.tracked:
+            cls.changed([(old, None) for old in cls.snapshot(found, lock=True).values()])
+        if found:
+            cls.deleting(list(found))
+        for chunk in chunked(list(found)):
+            cls.query.filter(cls.id.in_(chunk)).delete(synchronize_session=False)
+        if found:
+            cls.touch()
         db.session.commit()
+        return len(found), errors
 
 
 class User(db.Model, CRUDs):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(20), nullable=False)
-    password = db.Column(db.String(80), nullable=False)
+    password = db.Column(db.String(255), nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
-    watchlist = db.relationship('Watchlist', backref='user', lazy=True)
-    uploads = db.relationship('Video', backref='owner', lazy=True)
+    # Dependent rows are removed by ON DELETE CASCADE, not loaded and deleted by the ORM
+    watchlist = db.relationship('Watchlist', backref='user', lazy=True, passive_deletes=True)
+    uploads = db.relationship('Video', backref='owner', lazy=True, passive_deletes=True)
 
     @classmethod
     def create(cls, fields: dict):
-        fields['password'] = generate_password_hash(fields['password'])
-        super(User, cls).create(fields)
+        if isinstance(fields, dict) and fields.get('password'):
+            fields['password'] = hash_password(fields['password'])
+        return super(User, cls).create(fields)
+
+    @classmethod
+    def update(cls, model_id: int, fields: dict):
+        if isinstance(fields, dict) and fields.get('password'):
+            fields['password'] = hash_password(fields['password'])
+        return super(User, cls).update(model_id, fields)
+
+    @classmethod
+    def deleting(cls, ids: list):
+        # Their watchlists cascade, so the ratings leave the aggregates of the videos they rated
+        changes = []
+        columns = [getattr(Watchlist, name) for name in Watchlist.tracked]
+        for chunk in chunked(ids):
+            changes.extend(
+                (dict(zip(Watchlist.tracked, row)), None)
+                for row in db.session.query(*columns).filter(Watchlist.user_id.in_(chunk))
+            )
+        if changes:
+            Watchlist.changed(changes)
+        # And so do their videos
+        videos = [
+            row.id for chunk in chunked(ids) for row in db.session.query(Video.id).filter(Video.owner_id.in_(chunk))
+        ]
+        if videos:
+            Video.deleting(videos)
+        # And their unfinished uploads
+        remove_after_commit(files=[
+            os.path.join('uploads', f'{row.id}.part')
+            for chunk in chunked(ids) for row in db.session.query(Upload.id).filter(Upload.owner_id.in_(chunk))
+        ])
+        Watchlist.touch()
+        Video.touch()
+
+    @classmethod
+    def put(cls, model_id: int, fields: dict):
+        if isinstance(fields, dict) and fields.get('password'):
+            fields['password'] = hash_password(fields['password'])
+        return super(User, cls).put(model_id, fields)
 
     def __repr__(self):
         return f'User(id={self.id} name={self.name} email={self.email})'
 
 
 class Watchlist(db.Model, CRUDs):
+    # Composite indexes back the filters of WatchlistsEndpoints, id keeps keyset pagination in the index
+    __table_args__ = (
+        db.Index('ix_watchlist_user_id', 'user_id', 'id'),
+        db.Index('ix_watchlist_target_id', 'target_id', 'id'),
+        db.Index('ix_watchlist_score', 'score', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    target_id = db.Column(db.Integer, db.ForeignKey('video.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    target_id = db.Column(db.Integer, db.ForeignKey('video.id', ondelete='CASCADE'), nullable=False)
     target_type = db.Column(db.String(10))
     score = db.Column(db.Float)
     episodes = db.Column(db.Integer, nullable=False)
     rewatches = db.Column(db.Integer, default=0)
 
+    tracked = ('user_id', 'target_id', 'score', 'episodes', 'rewatches')
+
+    @classmethod
+    def changed(cls, changes: list):
+        Video.apply_ratings(changes)
+        Feed.invalidate_users([row['user_id'] for pair in changes for row in pair if row])
+        # Picked up by the leaderboards once the transaction commits
+        db.session.info.setdefault('watchlist_changes', []).extend(changes)
+
     def __repr__(self):
         return f'Watchlist(id={self.id} user_id={self.user_id} target_id={self.target_id})'
 
@@ -67,16 +480,36 @@ class Watchlist(db.Model, CRUDs):
 class Franchise(db.Model, CRUDs):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(30), nullable=False)
-    titles = db.relationship('Video', backref='franchise', lazy=True)
+    titles = db.relationship(
+        'Video', backref='franchise', lazy=True, order_by='Video.order_number', passive_deletes=True,
+    )
+
+    @classmethod
+    def deleting(cls, ids: list):
+        # franchise_id of the titles is set to NULL
+        Feed.invalidate_followers(ids)
+        Video.touch()
 
     def __repr__(self):
         return f'Franchise(id={self.id} name={self.name})'
 
 
 class Video(db.Model, CRUDs):
+    # Composite indexes back the filters and sort keys of VideosEndpoints
+    __table_args__ = (
+        db.Index('ix_video_owner_id', 'owner_id', 'id'),
+        db.Index('ix_video_franchise_id', 'franchise_id', 'id'),
+        db.Index('ix_video_is_series', 'is_series', 'id'),
+        db.Index('ix_video_upload_date', 'upload_date', 'id'),
+        db.Index('ix_video_score', 'score', 'id'),
+        # Position of a title in its franchise, titles without an order_number are not ordered
+        db.Index('ix_video_franchise_order', 'franchise_id', 'order_number', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    franchise_id = db.Column(db.Integer, db.ForeignKey('franchise.id'))
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    # Titles outlive their franchise
+    franchise_id = db.Column(db.Integer, db.ForeignKey('franchise.id', ondelete='SET NULL'))
     title = db.Column(db.String(50), nullable=False)
     episodes = db.Column(db.Integer, default=1)
     is_series = db.Column(db.Boolean, default=False, nullable=False)
@@ -84,10 +517,240 @@ class Video(db.Model, CRUDs):
     score = db.Column(db.Float, default=0, nullable=False)
     duration = db.Column(db.Float, nullable=False)
     order_number = db.Column(db.Integer)
-    watchlists = db.relationship('Watchlist', backref='target', lazy=True)
+    file_path = db.Column(db.String(255))
+    # score is the average of rating_sum over rating_count, kept up to date by Watchlist writes
+    rating_count = db.Column(db.Integer, default=0, nullable=False)
+    rating_sum = db.Column(db.Float, default=0, nullable=False)
+    watchlists = db.relationship('Watchlist', backref='target', lazy=True, passive_deletes=True)
+    histogram = db.relationship('ScoreBucket', lazy=True, order_by='ScoreBucket.bucket', passive_deletes=True)
+
+    tracked = ('franchise_id',)
+    # Maintained by apply_ratings from the watchlists, file_path is set by upload finalize only
+    read_only = ('score', 'rating_count', 'rating_sum', 'file_path')
+
+    @classmethod
+    def changed(cls, changes: list):
+        # New and edited titles show up in the feeds of the franchise followers
+        Feed.invalidate_followers([row['franchise_id'] for pair in changes for row in pair if row and row['franchise_id']])
+
+    @classmethod
+    def franchise_titles(cls, franchise_id: int, select: list, after: int = None, limit: int = 50):
+        # Range scan of ix_video_franchise_order
+        query = read_session.query(*select).filter(cls.franchise_id == franchise_id, cls.order_number.isnot(None))
+        if after is not None:
+            query = query.filter(cls.order_number > after)
+        return query.order_by(cls.order_number).limit(limit).all()
+
+    @classmethod
+    def franchise_position(cls, franchise_id: int, video_id: int):
+        return read_session.query(cls.order_number).filter(cls.id == video_id, cls.franchise_id == franchise_id).scalar()
+
+    @classmethod
+    def franchise_neighbours(cls, franchise_id: int, order_number: int, select: list):
+        # (previous, next) title, one index seek each
+        query = read_session.query(*select).filter(cls.franchise_id == franchise_id)
+        previous = query.filter(cls.order_number < order_number).order_by(cls.order_number.desc()).first()
+        following = query.filter(cls.order_number > order_number).order_by(cls.order_number).first()
+        return previous, following
+
+    @classmethod
+    def deleting(cls, ids: list):
+        # Their watchlists and histograms cascade, the leaderboards drop them once the transaction commits
+        db.session.info.setdefault('deleted_videos', []).extend(ids)
+        # So do their transcode jobs, files and renditions are removed after the commit as well
+        remove_after_commit(
+            files=[
+                row.file_path for chunk in chunked(ids)
+                for row in db.session.query(Video.file_path).filter(
+                    # Only files finalize put in place, never anything a row may point at elsewhere
+                    Video.id.in_(chunk), Video.file_path.startswith('videos/'), ~Video.file_path.contains('..'),
+                )
+            ],
+            directories=[os.path.join('renditions', str(video_id)) for video_id in ids],
+        )
+        # Feeds continuing them or listing them as new in a franchise, top rated sections catch up within FEED_TTL
+        franchises = set()
+        for chunk in chunked(ids):
+            watchers = select(Watchlist.user_id).where(Watchlist.target_id.in_(chunk)).union(
+                select(WatchProgress.user_id).where(WatchProgress.video_id.in_(chunk))
+            )
+            Feed.invalidate(Feed.user_id.in_(watchers))
+            franchises.update(
+                row.franchise_id for row in
+                db.session.query(Video.franchise_id).filter(Video.id.in_(chunk), Video.franchise_id.isnot(None))
+            )
+        Feed.invalidate_followers(list(franchises))
+        Watchlist.touch()
+        ScoreBucket.touch()
+
+    @classmethod
+    def rating_update(cls):
+        # executemany UPDATE adding delta_count ratings worth delta_sum to video_id
+        table = cls.__table__
+        count = table.c.rating_count + bindparam('delta_count')
+        total = table.c.rating_sum + bindparam('delta_sum')
+        return table.update().where(table.c.id == bindparam('video_id')).values(
+            rating_count=count, rating_sum=total, score=case((count > 0, total / count), else_=0)
+        )
+
+    @classmethod
+    def apply_ratings(cls, changes: list):
+        """Apply (old, new) watchlist target_id/score pairs to the rating aggregates"""
+        totals = defaultdict(lambda: [0, 0.0])
+        buckets = Counter()
+        for old, new in changes:
+            for row, sign in ((old, -1), (new, 1)):
+                if row and row.get('score') is not None:
+                    totals[row['target_id']][0] += sign
+                    totals[row['target_id']][1] += sign * row['score']
+                    buckets[(row['target_id'], score_bucket(row['score']))] += sign
+
+        totals = [
+            {'video_id': video_id, 'delta_count': count, 'delta_sum': total}
+            for video_id, (count, total) in totals.items() if count or total
+        ]
+        buckets = [
+            {'video_id': video_id, 'bucket': bucket, 'ratings': ratings}
+            for (video_id, bucket), ratings in buckets.items() if ratings
+        ]
+        if totals:
+            db.session.execute(cls.rating_update(), totals)
+        if buckets:
+            statement = dialect_insert(ScoreBucket.__table__)
+            statement = statement.on_conflict_do_update(
+                index_elements=['video_id', 'bucket'],
+                set_={'ratings': ScoreBucket.__table__.c.ratings + statement.excluded.ratings},
+            )
+            db.session.execute(statement, buckets)
+            table = ScoreBucket.__table__
+            db.session.execute(table.delete().where(
+                table.c.video_id.in_({row['video_id'] for row in buckets}), table.c.ratings <= 0
+            ))
+            ScoreBucket.touch()
+        if totals:
+            cls.touch()
 
     def __repr__(self):
         return f'Video(id={self.id} title={self.title})'
 
 
+class ScoreBucket(db.Model, CRUDs):
+    # Rating histogram, bucket n counts scores in [n, n + 1)
+    video_id = db.Column(db.Integer, db.ForeignKey('video.id', ondelete='CASCADE'), primary_key=True)
+    bucket = db.Column(db.Integer, primary_key=True)
+    ratings = db.Column(db.Integer, default=0, nullable=False)
+
+    def __repr__(self):
+        return f'ScoreBucket(video_id={self.video_id} bucket={self.bucket} ratings={self.ratings})'
+
+
+class LeaderboardScore(db.Model):
+    # Snapshot of the in-process leaderboards, see storehouse.leaderboard
+    board = db.Column(db.String(16), primary_key=True)
+    video_id = db.Column(db.Integer, db.ForeignKey('video.id', ondelete='CASCADE'), primary_key=True)
+    era = db.Column(db.Integer, default=0, nullable=False)
+    value = db.Column(db.Float, default=0, nullable=False)
+    updated = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_leaderboard_score_updated', 'updated'),
+    )
+
+    def __repr__(self):
+        return f'LeaderboardScore(board={self.board} video_id={self.video_id} value={self.value})'
+
+
+class Upload(db.Model):
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid4().hex)
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    filename = db.Column(db.String(255))
+    size = db.Column(db.BigInteger, nullable=False)
+    offset = db.Column(db.BigInteger, default=0, nullable=False)
+    fields = db.Column(db.Text, nullable=False)
+    created = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f'Upload(id={self.id} offset={self.offset}/{self.size})'
+
+
+class TranscodeJob(db.Model):
+    __table_args__ = (db.Index('ix_transcode_job_status', 'status', 'id'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    video_id = db.Column(db.Integer, db.ForeignKey('video.id', ondelete='CASCADE'), nullable=False, index=True)
+    # queued -> running -> done | failed
+    status = db.Column(db.String(10), default='queued', nullable=False)
+    progress = db.Column(db.Float, default=0, nullable=False)
+    renditions = db.Column(db.Text)
+    error = db.Column(db.Text)
+    worker = db.Column(db.String(64))
+    created = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    started = db.Column(db.DateTime)
+    # Touched by every progress report, running jobs without updates are considered dead
+    updated = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+    finished = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'TranscodeJob(id={self.id} video_id={self.video_id} status={self.status})'
+
+
+class WatchProgress(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    video_id = db.Column(db.Integer, db.ForeignKey('video.id', ondelete='CASCADE'), primary_key=True)
+    episode = db.Column(db.Integer, default=1, nullable=False)
+    position = db.Column(db.Float, nullable=False)
+    updated = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f'WatchProgress(user_id={self.user_id} video_id={self.video_id} position={self.position})'
+
+
+class Feed(db.Model):
+    # Materialized /feed responses, see storehouse.feed
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    # Bumped by every invalidation, a build only stores its body if nothing changed meanwhile
+    generation = db.Column(db.Integer, default=0, nullable=False)
+    # Encoded JSON, None until built and after an invalidation
+    body = db.Column(db.LargeBinary)
+    built = db.Column(db.DateTime)
+
+    @classmethod
+    def invalidate(cls, condition=None):
+        statement = cls.__table__.update().values(generation=cls.generation + 1, body=None)
+        if condition is not None:
+            statement = statement.where(condition)
+        db.session.execute(statement)
+
+    @classmethod
+    def invalidate_users(cls, user_ids: list):
+        for chunk in chunked(list(set(user_ids))):
+            cls.invalidate(cls.user_id.in_(chunk))
+
+    @classmethod
+    def invalidate_followers(cls, franchise_ids: list):
+        # Followers have a title of the franchise on their watchlist
+        for chunk in chunked(list(set(franchise_ids))):
+            followers = select(Watchlist.user_id).join(Video, Video.id == Watchlist.target_id).where(
+                Video.franchise_id.in_(chunk)
+            )
+            cls.invalidate(cls.user_id.in_(followers))
+
+    def __repr__(self):
+        return f'Feed(user_id={self.user_id} generation={self.generation})'
+
+
+class IdempotencyKey(db.Model):
+    # Responses to writes sent with an Idempotency-Key header, see storehouse.idempotency
+    key = db.Column(db.String(64), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    # None while the first request with the key is running
+    status = db.Column(db.Integer)
+    body = db.Column(db.LargeBinary)
+    content_type = db.Column(db.String(100))
+    created = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+    def __repr__(self):
+        return f'IdempotencyKey(key={self.key} status={self.status})'
+
+
 # db.create_all() Needed on first run
@@ -0,0 +1,43 @@
+import atexit
+from threading import Event, Thread
+
+
+class PeriodicTask:
+    """
+    Calls function in an app context every interval seconds on a daemon thread and once more
+    at exit, so work buffered in the process is written before it ends.
+    """
+    def __init__(self, name: str, function, error: str):
+        self.name = name
+        self.function = function
+        # Logged with the traceback when a call fails, the next one retries
+        self.error = error
+        self.app = None
+        self.interval = None
+        self._stop = Event()
+        self._thread = None
+
+    def start(self, app, interval: float):
+        # Started on first use so every forked web worker gets its own thread, callers hold their lock
+        if self._thread is not None:
+            return
+        self.app, self.interval = app, interval
+        self._thread = Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    self.function()
+                except Exception:
+                    self.app.logger.exception(self.error)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is None:
+            # Never used, nothing to write
+            return
+        with self.app.app_context():
+            self.function()
@@ -0,0 +1,117 @@
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+from threading import Lock
+
+from storehouse import db, read_session
+from storehouse.models import Feed, User, Video, WatchProgress, dialect_insert
+from storehouse.periodic import PeriodicTask
+
+
+def upsert_progress(rows: list):
+    statement = dialect_insert(WatchProgress.__table__)
+    statement = statement.on_conflict_do_update(
+        index_elements=['user_id', 'video_id'],
+        set_={column: statement.excluded[column] for column in ('episode', 'position', 'updated')},
+        # Another worker may have flushed a newer heartbeat already
+        where=statement.excluded.updated >= WatchProgress.__table__.c.updated,
+    )
+    db.session.execute(statement, rows)
+
+
+def upsert_valid_progress(rows: list):
+    """Written rows, a user or video deleted since they were checked fails the foreign key of its rows only"""
+    try:
+        with db.session.begin_nested():
+            upsert_progress(rows)
+        return rows
+    except IntegrityError:
+        written = []
+        for row in rows:
+            try:
+                with db.session.begin_nested():
+                    upsert_progress([row])
+                written.append(row)
+            except IntegrityError:
+                pass
+        return written
+
+
+class ProgressBuffer:
+    """
+    Write-behind buffer for player heartbeats. Reports are coalesced per (user, video)
+    and written in one batch every flush_interval seconds and at shutdown.
+    """
+    def __init__(self, flush_interval: float = 5, max_pending: int = 10000):
+        self.app = None
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._lock = Lock()
+        self._flusher = PeriodicTask('progress-flush', self.flush, 'Could not flush watch progress')
+
+    def init_app(self, app):
+        self.app = app
+        self.flush_interval = app.config['PROGRESS_FLUSH_INTERVAL']
+        self.max_pending = app.config['PROGRESS_MAX_PENDING']
+
+    def record(self, user_id: int, video_id: int, episode: int, position: float):
+        with self._lock:
+            self._pending[(user_id, video_id)] = (episode, position, datetime.utcnow())
+            full = len(self._pending) >= self.max_pending
+            self._flusher.start(self.app, self.flush_interval)
+        if full:
+            self.flush()
+
+    def pending(self, user_id: int):
+        with self._lock:
+            return {video_id: value for (user, video_id), value in self._pending.items() if user == user_id}
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return 0
+
+        try:
+            # Reports of deleted users and videos are dropped, other workers may accept them until their caches expire
+            videos = Video.existing_ids([video_id for _, video_id in batch])
+            users = User.existing_ids([user_id for user_id, _ in batch])
+            rows = [
+                {'user_id': user_id, 'video_id': video_id, 'episode': episode, 'position': position, 'updated': updated}
+                for (user_id, video_id), (episode, position, updated) in batch.items()
+                if video_id in videos and user_id in users
+            ]
+            if rows:
+                rows = upsert_valid_progress(rows)
+                Feed.invalidate_users([row['user_id'] for row in rows])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            with self._lock:
+                # Keep the batch for the next flush unless newer reports replaced it
+                for key, value in batch.items():
+                    self._pending.setdefault(key, value)
+            raise
+        return len(rows)
+
+    def stop(self):
+        self._flusher.stop()
+
+
+def continue_watching(user_id: int, limit: int):
+    """Persisted progress merged with the not yet flushed reports of this worker, latest first"""
+    progress = {
+        row.video_id: (row.episode, row.position, row.updated)
+        for row in read_session.query(WatchProgress).filter_by(user_id=user_id)
+    }
+    for video_id, value in buffer.pending(user_id).items():
+        if video_id not in progress or value[2] >= progress[video_id][2]:
+            progress[video_id] = value
+    items = sorted(progress.items(), key=lambda item: item[1][2], reverse=True)[:limit]
+    return [
+        {'video_id': video_id, 'episode': episode, 'position': position, 'updated': updated}
+        for video_id, (episode, position, updated) in items
+    ]
+
+
+buffer = ProgressBuffer()
@@ -0,0 +1,135 @@
+import math
+import os
+import sqlite3
+import time
+from flask import request
+from threading import local
+
+from storehouse.endpoints import token_cache
+
+
+# Tokens a request to these endpoints takes from its bucket, every other endpoint takes 1
+COSTS = {
+    # Password hashing
+    'auth.login': 10,
+    'auth.signup': 10,
+    # Pages of up to MAX_PAGE_SIZE rows
+    'usersendpoints': 3,
+    'videosendpoints': 3,
+    'watchlistsendpoints': 3,
+    'franchisesendpoints': 3,
+    'searchendpoints': 3,
+    'uploadfinalizeendpoints': 5,
+    'metrics.scrape': 0,
+}
+
+# One statement, so concurrent requests of every worker update a bucket atomically.
+# SET expressions see the row before the update.
+TAKE = '''
+INSERT INTO bucket (key, tokens, updated, allowed) VALUES (:key, :burst - :cost, :now, 1)
+ON CONFLICT (key) DO UPDATE SET
+    tokens = min(:burst, tokens + (:now - updated) * :rate)
+        - CASE WHEN min(:burst, tokens + (:now - updated) * :rate) >= :cost THEN :cost ELSE 0 END,
+    allowed = min(:burst, tokens + (:now - updated) * :rate) >= :cost,
+    updated = :now
+RETURNING tokens, allowed
+'''
+
+
+def parse_costs(value: str):
+    # 'auth.login=20,searchendpoints=1'
+    costs = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        endpoint, cost = item.split('=')
+        costs[endpoint.strip()] = int(cost)
+    return costs
+
+
+class Buckets:
+    """
+    Token buckets in a SQLite file of their own, shared by every worker process on the host
+    without taking the write lock of the application database
+    """
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._local = local()
+
+    def connection(self):
+        # One per thread and process, sqlite3 connections must not cross a fork
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+            connection = sqlite3.connect(self.filename, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            # Losing the last buckets in a crash is fine
+            connection.execute('PRAGMA synchronous=OFF')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL, updated REAL, allowed INTEGER)'
+            )
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return connection
+
+    def take(self, key: str, cost: float, rate: float, burst: float):
+        """Seconds until the bucket has cost tokens, 0 when they were taken"""
+        cost = min(cost, burst)
+        parameters = {'key': key, 'cost': cost, 'rate': rate, 'burst': burst, 'now': time.time()}
+        tokens, allowed = self.connection().execute(TAKE, parameters).fetchall()[0]
+        return 0 if allowed else (cost - tokens) / rate
+
+    def purge(self, idle: float):
+        # Buckets untouched for this long are full again, same as a missing one
+        self.connection().execute('DELETE FROM bucket WHERE updated < ?', (time.time() - idle,))
+
+
+class RateLimiter:
+    """
+    Token bucket per user for requests with a known access token, per client address otherwise.
+    Runs before the request hooks and views that use the application database, so a client
+    over its limit gets a 429 without touching it.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.buckets = None
+        self.costs = dict(COSTS)
+        self.user_limit = (10.0, 100.0)
+        self.ip_limit = (20.0, 200.0)
+        self._purged = 0
+
+    def init_app(self, app):
+        if not app.config['RATE_LIMIT_ENABLED']:
+            return
+        self.enabled = True
+        self.buckets = Buckets(app.config['RATE_LIMIT_DATABASE'])
+        costs = app.config['RATE_LIMIT_COSTS']
+        self.costs = dict(COSTS, **(parse_costs(costs) if isinstance(costs, str) else costs))
+        self.user_limit = (app.config['RATE_LIMIT_USER_RATE'], app.config['RATE_LIMIT_USER_BURST'])
+        self.ip_limit = (app.config['RATE_LIMIT_IP_RATE'], app.config['RATE_LIMIT_IP_BURST'])
+        app.before_request(self.before_request)
+
+    def before_request(self):
+        cost = self.costs.get(request.endpoint, 1)
+        if not cost:
+            return None
+        # Only tokens token_required already verified, unknown ones count against the address
+        token = request.headers.get('x-access-token')
+        user = token_cache.get(token) if token else None
+        if user is not None:
+            key, (rate, burst) = f'user:{user.id}', self.user_limit
+        else:
+            key, (rate, burst) = f'ip:{request.remote_addr}', self.ip_limit
+        self.purge()
+
+        wait = self.buckets.take(key, cost, rate, burst)
+        if wait:
+            return {'error': 'too many requests'}, 429, {'Retry-After': str(math.ceil(wait))}
+        return None
+
+    def purge(self):
+        # At most once a minute per worker
+        if time.monotonic() - self._purged < 60:
+            return
+        self._purged = time.monotonic()
+        self.buckets.purge(max(burst / rate for rate, burst in (self.user_limit, self.ip_limit)))
+
+
+limiter = RateLimiter()
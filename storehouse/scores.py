@@ -0,0 +1,40 @@
+import click
+from flask.cli import AppGroup
+from sqlalchemy import case, func, select
+
+from storehouse import db
+from storehouse.models import SCORE_BUCKETS, ScoreBucket, Video, Watchlist, chunked
+
+
+scores_cli = AppGroup('scores', help='Video rating aggregate commands.')
+
+
+@scores_cli.command('rebuild')
+def rebuild():
+    """Recompute rating counts, averages and histograms of every video from watchlists."""
+    watchlist = Watchlist.__table__
+    rated = watchlist.c.score.isnot(None)
+    bucket = case(*[(watchlist.c.score < n + 1, n) for n in range(SCORE_BUCKETS - 1)], else_=SCORE_BUCKETS - 1)
+
+    # One grouped scan of watchlist, written back with executemany
+    totals = [
+        {'video_id': video_id, 'delta_count': count, 'delta_sum': total}
+        for video_id, count, total in db.session.execute(
+            select(watchlist.c.target_id, func.count(), func.sum(watchlist.c.score)).where(rated)
+            .group_by(watchlist.c.target_id)
+        )
+    ]
+    db.session.execute(Video.__table__.update().values(rating_count=0, rating_sum=0, score=0))
+    for chunk in chunked(totals, 10000):
+        db.session.execute(Video.rating_update(), chunk)
+
+    db.session.execute(ScoreBucket.__table__.delete())
+    db.session.execute(ScoreBucket.__table__.insert().from_select(
+        ['video_id', 'bucket', 'ratings'],
+        select(watchlist.c.target_id, bucket, func.count()).where(rated).group_by(watchlist.c.target_id, bucket),
+    ))
+    Video.touch()
+    ScoreBucket.touch()
+    db.session.commit()
+    click.echo(f'Rebuilt scores of {len(totals)} videos')
+
@@ -0,0 +1,83 @@
+import re
+import click
+from flask.cli import AppGroup
+from sqlalchemy import DDL, event, or_, text
+
+from storehouse import db, read_session
+from storehouse.models import Franchise, Video
+
+
+# Indexed column of every searchable model
+searchable = {Video: 'title', Franchise: 'name'}
+search_cli = AppGroup('search', help='Full-text search index commands.')
+
+
+def fts_ddl(table: str, column: str):
+    # External content FTS5 table kept in sync by triggers, so every write path
+    # (CRUDs, bulk and set-based statements) updates the index in the same transaction
+    fts = f'{table}_fts'
+    insert = f'INSERT INTO {fts}(rowid, {column}) VALUES (new.id, new.{column});'
+    delete = f"INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.id, old.{column});"
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({column}, content='{table}', content_rowid='id', "
+        f"tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+        f'CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN {insert} END',
+        f'CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN {delete} END',
+        f'CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF {column} ON {table} BEGIN {delete} {insert} END',
+    ]
+
+
+for model, column in searchable.items():
+    table = model.__tablename__
+    for statement in fts_ddl(table, column):
+        event.listen(model.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+    event.listen(
+        model.__table__, 'before_drop', DDL(f'DROP TABLE IF EXISTS {table}_fts').execute_if(dialect='sqlite')
+    )
+
+
+def match_expression(query: str):
+    # Every word must match as a prefix: 'star wa' -> '"star"* "wa"*'
+    return ' '.join(f'"{term}"*' for term in re.findall(r'\w+', query))
+
+
+def word_prefix(column, term: str):
+    # term at the start of the column or of a word in it, % and _ in term are literal
+    escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return or_(column.ilike(f'{escaped}%', escape='\\'), column.ilike(f'% {escaped}%', escape='\\'))
+
+
+def search(model, query: str, limit: int):
+    column = searchable[model]
+    expression = match_expression(query)
+    if not expression:
+        return []
+
+    if db.engine.dialect.name != 'sqlite':
+        # No FTS5 outside SQLite, fall back to unranked word prefix matching
+        conditions = [word_prefix(getattr(model, column), term) for term in re.findall(r'\w+', query)]
+        return model.read_query().filter(*conditions).limit(limit).all()
+
+    fts = f'{model.__tablename__}_fts'
+    ids = [row[0] for row in read_session.execute(
+        text(f'SELECT rowid FROM {fts} WHERE {fts} MATCH :query ORDER BY rank LIMIT :limit'),
+        {'query': expression, 'limit': limit},
+    )]
+    rows = {row.id: row for row in model.read_query().filter(model.id.in_(ids))}
+    return [rows[i] for i in ids if i in rows]
+
+
+@search_cli.command('rebuild')
+def rebuild():
+    """Create missing search tables and reindex every searchable model."""
+    if db.engine.dialect.name != 'sqlite':
+        click.echo('Search tables are only used with SQLite')
+        return
+    for model, column in searchable.items():
+        fts = f'{model.__tablename__}_fts'
+        for statement in fts_ddl(model.__tablename__, column):
+            db.session.execute(text(statement))
+        db.session.execute(text(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')"))
+        click.echo(f'Rebuilt {fts}')
+    db.session.commit()
+
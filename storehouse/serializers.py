@@ -0,0 +1,95 @@
+import json
+from flask import current_app, make_response
+from flask_restful import fields
+from flask_restful.representations.json import output_json as restful_output_json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Value conversions of the flask_restful fields, see Raw.output and the format methods
+CONVERTERS = {
+    fields.Raw: lambda value: value,
+    fields.String: str,
+    fields.Integer: int,
+    fields.Float: float,
+    fields.Boolean: bool,
+}
+
+
+def converter(field):
+    """None and the conversion marshal would apply to a value for this field"""
+    cls = field if isinstance(field, type) else type(field)
+    default = field.default if not isinstance(field, type) else cls().default
+    if getattr(field, 'attribute', None) is not None:
+        raise TypeError('fields with an attribute are not supported')
+    if cls is fields.DateTime:
+        dt_format = field.dt_format if not isinstance(field, type) else 'rfc822'
+        if dt_format != 'iso8601':
+            raise TypeError(f'{dt_format} dates are not supported')
+        return default, lambda value: value.isoformat()
+    if cls not in CONVERTERS:
+        raise TypeError(f'{cls.__name__} fields are not supported')
+    return default, CONVERTERS[cls]
+
+
+class Serializer:
+    """
+    marshal() for a flat field map, compiled once. Works on rows selected with
+    columns(), so list endpoints skip hydrating ORM objects.
+    """
+    def __init__(self, model_fields: dict):
+        self.names = tuple(model_fields)
+        self.converters = tuple(converter(field) for field in model_fields.values())
+
+    def columns(self, model):
+        return [getattr(model, name) for name in self.names]
+
+    def __call__(self, row):
+        return {
+            name: default if value is None else convert(value)
+            for name, (default, convert), value in zip(self.names, self.converters, row)
+        }
+
+    def many(self, rows):
+        return [self(row) for row in rows]
+
+
+_serializers = {}
+
+
+def serializer(model_fields: dict):
+    """The compiled Serializer of a field map, None when it needs the full marshal"""
+    key = id(model_fields)
+    if key not in _serializers:
+        try:
+            compiled = Serializer(model_fields)
+        except TypeError:
+            compiled = None
+        # The map is kept so its id is not reused
+        _serializers[key] = (model_fields, compiled)
+    return _serializers[key][1]
+
+
+def dumps(data):
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(data)
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def output_json(data, code, headers=None):
+    """flask_restful's JSON representation, encoded by orjson when it is installed"""
+    if current_app.debug or current_app.config.get('RESTFUL_JSON'):
+        # Indentation and encoder settings are only understood by the json module
+        return restful_output_json(data, code, headers)
+    response = make_response(dumps(data) + '\n', code)
+    response.headers.extend(headers or {})
+    return response
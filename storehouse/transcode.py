@@ -0,0 +1,215 @@
+import click
+import json
+import os
+import shutil
+import socket
+import subprocess
+from datetime import datetime, timedelta
+from flask import current_app, has_app_context
+from flask.cli import AppGroup
+from multiprocessing import get_context
+from time import monotonic, sleep
+
+from storehouse import create_app, db
+from storehouse.media import media_path
+from storehouse.models import TranscodeJob, Video
+
+
+# name, height, video kbit/s, audio kbit/s
+LADDER = (
+    ('1080p', 1080, 5000, 192),
+    ('720p', 720, 2800, 128),
+    ('480p', 480, 1400, 128),
+    ('360p', 360, 800, 96),
+)
+transcode_cli = AppGroup('transcode', help='Video transcoding queue commands.')
+
+
+def renditions_dir(video_id: int):
+    return media_path(os.path.join('renditions', str(video_id)))
+
+
+def enqueue(video_id: int):
+    # Joins the caller's transaction
+    job = TranscodeJob(video_id=video_id)
+    db.session.add(job)
+    return job
+
+
+def latest_job(video_id: int):
+    return TranscodeJob.query.filter_by(video_id=video_id).order_by(TranscodeJob.id.desc()).first()
+
+
+def claim(worker: str):
+    """Mark the oldest queued job as running, the status check in the UPDATE stops two workers taking one job"""
+    while True:
+        job_id = db.session.query(TranscodeJob.id).filter_by(status='queued').order_by(TranscodeJob.id).limit(1).scalar()
+        if job_id is None:
+            db.session.rollback()
+            return None
+        claimed = TranscodeJob.query.filter_by(id=job_id, status='queued').update(
+            {'status': 'running', 'worker': worker, 'started': datetime.utcnow(), 'progress': 0},
+            synchronize_session=False,
+        )
+        db.session.commit()
+        if claimed:
+            return TranscodeJob.query.get(job_id)
+
+
+def requeue_stale(timeout: int):
+    deadline = datetime.utcnow() - timedelta(seconds=timeout)
+    count = TranscodeJob.query.filter(TranscodeJob.status == 'running', TranscodeJob.updated < deadline).update(
+        {'status': 'queued', 'worker': None}, synchronize_session=False
+    )
+    db.session.commit()
+    return count
+
+
+def probe(path: str):
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+         '-show_entries', 'stream=width,height:format=duration', '-of', 'json', path],
+        capture_output=True, text=True, check=True, timeout=60,
+    )
+    info = json.loads(result.stdout)
+    stream = info['streams'][0]
+    return int(stream['width']), int(stream['height']), float(info['format']['duration'])
+
+
+def ladder(width: int, height: int):
+    # Never upscale, a source smaller than every rung still gets the lowest one
+    rungs = [rung for rung in LADDER if rung[1] <= height] or [LADDER[-1]]
+    return [
+        {'name': name, 'width': round(width * h / height / 2) * 2, 'height': h, 'video': video, 'audio': audio}
+        for name, h, video, audio in rungs
+    ]
+
+
+def encode(source: str, target: str, rendition: dict, duration: float, report):
+    os.makedirs(target, exist_ok=True)
+    video = rendition['video']
+    command = [
+        'ffmpeg', '-y', '-v', 'error', '-nostats', '-progress', 'pipe:1', '-i', source,
+        '-vf', f'scale=-2:{rendition["height"]}', '-c:v', 'libx264', '-preset', 'veryfast',
+        '-b:v', f'{video}k', '-maxrate', f'{video * 107 // 100}k', '-bufsize', f'{video * 2}k',
+        '-g', '48', '-keyint_min', '48', '-sc_threshold', '0',
+        '-c:a', 'aac', '-b:a', f'{rendition["audio"]}k', '-ac', '2',
+        '-f', 'hls', '-hls_time', '6', '-hls_playlist_type', 'vod',
+        '-hls_segment_filename', os.path.join(target, 'segment_%05d.ts'),
+        os.path.join(target, 'index.m3u8'),
+    ]
+    with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as process:
+        for line in process.stdout:
+            key, _, value = line.strip().partition('=')
+            # out_time_ms is in microseconds as well
+            if key in ('out_time_us', 'out_time_ms') and value.isdigit() and duration:
+                report(min(int(value) / 1e6 / duration, 1.0))
+        error = process.stderr.read()
+    if process.returncode:
+        raise RuntimeError(error.strip() or f'ffmpeg exited with {process.returncode}')
+
+
+def write_master(target: str, renditions: list):
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3']
+    for rendition in renditions:
+        bandwidth = (rendition['video'] + rendition['audio']) * 1000
+        lines.append(f'#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},RESOLUTION={rendition["width"]}x{rendition["height"]}')
+        lines.append(f'{rendition["name"]}/index.m3u8')
+    temporary = os.path.join(target, 'master.m3u8.tmp')
+    with open(temporary, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+    os.replace(temporary, os.path.join(target, 'master.m3u8'))
+
+
+def process(job: TranscodeJob):
+    video = Video.query.get(job.video_id)
+    source = media_path(video.file_path)
+    width, height, duration = probe(source)
+    renditions = ladder(width, height)
+    target = renditions_dir(video.id)
+    last_report = monotonic()
+
+    for index, rendition in enumerate(renditions):
+        def report(fraction):
+            nonlocal last_report
+            if monotonic() - last_report >= 1:
+                job.progress = (index + fraction) / len(renditions)
+                db.session.commit()
+                last_report = monotonic()
+
+        encode(source, os.path.join(target, rendition['name']), rendition, duration, report)
+
+    write_master(target, renditions)
+    job.renditions = json.dumps(renditions)
+    job.status = 'done'
+    job.progress = 1
+    job.finished = datetime.utcnow()
+    db.session.commit()
+
+
+def run(job: TranscodeJob):
+    # Read up front, the video and its jobs may be deleted while it runs and a rolled back job can not reload
+    job_id, video_id = job.id, job.video_id
+    try:
+        process(job)
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.exception('Transcode job %s failed', job_id)
+        failed = TranscodeJob.query.filter_by(id=job_id).update(
+            {'status': 'failed', 'error': str(e), 'finished': datetime.utcnow()}, synchronize_session=False,
+        )
+        db.session.commit()
+        if not failed:
+            # Deleted along with its video, drop what it wrote
+            shutil.rmtree(renditions_dir(video_id), ignore_errors=True)
+
+
+def work(poll: float, once: bool = False):
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    # Spawned worker processes build their own app
+    app = current_app._get_current_object() if has_app_context() else create_app()
+    with app.app_context():
+        requeued = None
+        while True:
+            # Jobs of workers that died while this one runs are picked up again, at most once a minute
+            if requeued is None or monotonic() - requeued >= 60:
+                requeue_stale(app.config['TRANSCODE_JOB_TIMEOUT'])
+                requeued = monotonic()
+            job = claim(worker)
+            if job:
+                run(job)
+            elif once:
+                return
+            else:
+                sleep(poll)
+
+
+@transcode_cli.command('worker')
+@click.option('--processes', default=1, help='Worker processes to start.')
+@click.option('--poll', default=5.0, help='Seconds to wait when the queue is empty.')
+@click.option('--once', is_flag=True, help='Exit when the queue is empty.')
+def worker_command(processes, poll, once):
+    """Process queued transcode jobs."""
+    if processes == 1:
+        return work(poll, once)
+    # spawn, so every worker opens its own database connections
+    context = get_context('spawn')
+    workers = [context.Process(target=work, args=(poll, once)) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+@transcode_cli.command('enqueue')
+@click.argument('video_ids', nargs=-1, type=int)
+@click.option('--all', 'everything', is_flag=True, help='Queue every video with a file.')
+def enqueue_command(video_ids, everything):
+    """Queue videos for transcoding."""
+    if everything:
+        video_ids = [row.id for row in db.session.query(Video.id).filter(Video.file_path.isnot(None))]
+    for video_id in video_ids:
+        enqueue(video_id)
+    db.session.commit()
+    click.echo(f'Queued {len(video_ids)} videos')
+
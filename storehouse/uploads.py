@@ -0,0 +1,44 @@
+import click
+import os
+import time
+from datetime import datetime, timedelta
+from flask.cli import AppGroup
+
+from storehouse import db
+from storehouse.media import media_path, remove_after_commit
+from storehouse.models import Upload, chunked
+
+
+uploads_cli = AppGroup('uploads', help='Resumable upload commands.')
+
+
+def purge(older_than: timedelta):
+    """Delete uploads started before older_than ago and their part files, returns (rows, stray files)"""
+    deadline = datetime.utcnow() - older_than
+    ids = [row.id for row in db.session.query(Upload.id).filter(Upload.created < deadline)]
+    for chunk in chunked(ids):
+        Upload.query.filter(Upload.id.in_(chunk)).delete(synchronize_session=False)
+    remove_after_commit(files=[os.path.join('uploads', f'{upload_id}.part') for upload_id in ids])
+    db.session.commit()
+
+    # Part files without a row, left by a crash between creating the file and committing the row
+    directory = media_path('uploads')
+    names = [name for name in os.listdir(directory) if name.endswith('.part')] if os.path.isdir(directory) else []
+    known = {row.id for chunk in chunked([name[:-5] for name in names]) for row in
+             db.session.query(Upload.id).filter(Upload.id.in_(chunk))}
+    db.session.commit()
+    strays = 0
+    for name in names:
+        path = os.path.join(directory, name)
+        if name[:-5] not in known and os.path.getmtime(path) < time.time() - older_than.total_seconds():
+            os.remove(path)
+            strays += 1
+    return len(ids), strays
+
+
+@uploads_cli.command('purge')
+@click.option('--older-than', default=24.0, show_default=True, help='Hours since the upload was started.')
+def purge_command(older_than):
+    """Delete unfinished uploads and their part files."""
+    rows, strays = purge(timedelta(hours=older_than))
+    click.echo(f'Purged {rows} uploads and {strays} part files without one')
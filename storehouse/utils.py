@@ -1,38 +1,154 @@
 import jwt
-from flask import request, jsonify, make_response
-from flask_restful import Resource, marshal
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from hashlib import sha1
+from flask import current_app, request, jsonify, make_response, Response, stream_with_context
+from flask_restful import Resource, fields, marshal
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload
 
 
-from storehouse import app
+from storehouse import db
+from storehouse.cache import response_cache
+from storehouse.models import NotFound
+from storehouse.serializers import dumps, serializer
+
+
+def encode_cursor(row, sort: str = 'id'):
+    position = [row.id] if sort == 'id' else [getattr(row, sort), row.id]
+    raw = json.dumps({'sort': sort, 'after': position}, default=str).encode()
+    return urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, sort: str = 'id', parse=str):
+    try:
+        raw = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        data = json.loads(raw)
+        if data['sort'] != sort:
+            raise ValueError('cursor belongs to another sort order')
+        if sort == 'id':
+            return (int(data['after'][0]),)
+        key, last_id = data['after']
+        return parse(key), int(last_id)
+    except (ValueError, KeyError, TypeError):
+        raise ValueError('invalid cursor')
+
+
+def boolean(value: str):
+    if value.lower() in ('1', 'true'):
+        return True
+    if value.lower() in ('0', 'false'):
+        return False
+    raise ValueError(f'{value} is not a boolean')
+
+
+def page_size(value):
+    if value is None:
+        return current_app.config['PAGE_SIZE']
+    limit = int(value)
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    return min(limit, current_app.config['MAX_PAGE_SIZE'])
+
+
+def make_etag(*parts):
+    return sha1(':'.join(map(str, parts)).encode()).hexdigest()
+
+
+def cache_headers(etag: str):
+    return {'ETag': f'"{etag}"', 'Cache-Control': current_app.config['CACHE_CONTROL']}
+
+
+def expand_tree(expand: str, expandable: dict):
+    # 'watchlist.target,uploads' -> {'watchlist': {'target': {}}, 'uploads': {}}
+    tree = {}
+    for path in filter(None, (p.strip() for p in expand.split(','))):
+        if path not in expandable:
+            raise ValueError(f'{path} can not be expanded')
+        node = tree
+        for name in path.split('.'):
+            node = node.setdefault(name, {})
+    return tree
+
+
+def expansion(model, model_fields: dict, expandable: dict, tree: dict, prefix: str = ''):
+    """
+    Build marshal fields with nested relationships and the loader options that fetch them,
+    collections are loaded with one extra SELECT ... IN query and scalars are joined.
+    Returns (fields, options, models involved).
+    """
+    result, options, models = dict(model_fields), [], {model}
+    for name, children in tree.items():
+        relationship = getattr(model, name)
+        target = relationship.property.mapper.class_
+        path = prefix + name
+        nested_fields, nested_options, nested_models = expansion(
+            target, expandable[path], expandable, children, path + '.'
+        )
+        loader = selectinload if relationship.property.uselist else joinedload
+        options.append(loader(relationship).options(*nested_options))
+        models |= nested_models
+
+        nested = fields.Nested(nested_fields, allow_null=True)
+        result[name] = fields.List(nested) if relationship.property.uselist else nested
+    return result, options, models
 
 
 class GenericEndpoints(Resource):
     model = None
     model_fields = None
+    # 'relationship.path' -> fields of the related model, allowed values of ?expand=
+    expandable = {}
 
     def get(self, model_id):
-        instance = self.model.get(model_id)
-        return marshal(instance, self.model_fields), 200
+        try:
+            tree = expand_tree(request.args.get('expand', ''), self.expandable)
+        except ValueError as e:
+            return {'error': str(e)}, 400
+        model_fields, options, models = expansion(self.model, self.model_fields, self.expandable, tree)
+
+        # Table versions change on every write, so a matching ETag skips the query and marshal
+        versions = sorted((m.__tablename__, m.version()) for m in models)
+        etag = make_etag(versions, model_id, request.query_string.decode())
+        headers = cache_headers(etag)
+        if request.if_none_match.contains(etag):
+            return '', 304, headers
+
+        instance = self.model.read(model_id, options)
+        if not instance:
+            return {'error': 'object not found'}, 404
+        return marshal(instance, model_fields), 200, headers
 
     def put(self, model_id):
         args = request.get_json(force=True)
         try:
-            self.model.update(model_id, args)
-        except AssertionError:
-            self.model.create(args)
+            error = self.model.put(model_id, args)
+        except IntegrityError:
+            # Ends the transaction, on SQLite the failed statement holds the write lock until then
+            db.session.rollback()
+            return {'error': 'bad request'}, 400
+        if error:
+            return {'error': error}, 400
         return '', 201
 
     def patch(self, model_id):
         args = request.get_json(force=True)
         try:
-            self.model.update(model_id, args)
-        except AssertionError:
+            error = self.model.update(model_id, args)
+        except NotFound:
             return {'error': 'object not found'}, 404
+        except IntegrityError:
+            db.session.rollback()
+            return {'error': 'bad request'}, 400
+        if error:
+            return {'error': error}, 400
         return '', 200
 
     def delete(self, model_id):
-        self.model.delete(model_id)
+        try:
+            self.model.delete(model_id)
+        except NotFound:
+            return {'error': 'object not found'}, 404
         return '', 204
 
 
@@ -40,14 +156,113 @@ class GenericsEndpoints(Resource):
     model = None
     model_fields = None
     model_parser = None
+    # query parameter -> parser, equality filter on the column with the same name
+    filters = {}
+    # column -> parser, filtered with ?<column>_min= and ?<column>_max=
+    range_filters = {}
+    # columns allowed in ?sort=, prefixed with - for descending order
+    sortable = ()
 
     def get(self):
-        return marshal(self.model.get_all(), self.model_fields), 200
+        if request.args.get('format') == 'ndjson':
+            return self.stream()
+
+        key = (self.model.__tablename__, self.model.version(), request.query_string.decode())
+        etag = make_etag(*key)
+        headers = cache_headers(etag)
+        if request.if_none_match.contains(etag):
+            return '', 304, headers
+
+        page = response_cache.get(key)
+        if page is None:
+            try:
+                page = self.get_page()
+            except ValueError:
+                return {'error': 'bad request'}, 400
+            response_cache.set(key, page)
+        return page, 200, headers
+
+    def get_page(self):
+        limit = page_size(request.args.get('limit'))
+        conditions = self.conditions()
+        sort, descending = self.sort_order()
+        after = request.args.get('after')
+        after = decode_cursor(after, sort, self.range_filters.get(sort, str)) if after else None
+
+        serialize = serializer(self.model_fields)
+        select = serialize.columns(self.model) if serialize else None
+        rows = self.model.get_page(after, limit + 1, conditions, sort, descending, select)
+        next_cursor = encode_cursor(rows[limit - 1], sort) if len(rows) > limit else None
+        items = serialize.many(rows[:limit]) if serialize else marshal(rows[:limit], self.model_fields)
+        return {'items': items, 'next': next_cursor}
+
+    def conditions(self):
+        conditions = []
+        for name, parse in self.filters.items():
+            if name in request.args:
+                conditions.append(getattr(self.model, name) == parse(request.args[name]))
+        for name, parse in self.range_filters.items():
+            column = getattr(self.model, name)
+            if f'{name}_min' in request.args:
+                conditions.append(column >= parse(request.args[f'{name}_min']))
+            if f'{name}_max' in request.args:
+                conditions.append(column <= parse(request.args[f'{name}_max']))
+        return conditions
+
+    def sort_order(self):
+        sort = request.args.get('sort', 'id')
+        descending = sort.startswith('-')
+        sort = sort.lstrip('-')
+        if sort != 'id' and sort not in self.sortable:
+            raise ValueError(f'can not sort by {sort}')
+        return sort, descending
+
+    def stream(self):
+        try:
+            conditions = self.conditions()
+        except ValueError:
+            return {'error': 'bad request'}, 400
+
+        serialize = serializer(self.model_fields)
+
+        def generate():
+            if serialize:
+                for row in self.model.iter_all(conditions, select=serialize.columns(self.model)):
+                    yield dumps(serialize(row)) + '\n'
+            else:
+                for row in self.model.iter_all(conditions):
+                    yield dumps(marshal(row, self.model_fields)) + '\n'
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
     def post(self):
         args = request.get_json(force=True)
+        if isinstance(args, list):
+            return self.bulk(self.model.bulk_create, args, 'created', 201)
         try:
-            self.model.create(args)
+            error = self.model.create(args)
         except IntegrityError:
+            db.session.rollback()
             return {'error': 'bad request'}, 400
+        if error:
+            return {'error': error}, 400
         return '', 201
+
+    def bulk_update(self):
+        args = request.get_json(force=True)
+        if not isinstance(args, list):
+            return {'error': 'bad request'}, 400
+        return self.bulk(self.model.bulk_update, args, 'updated')
+
+    def bulk_delete(self):
+        ids = request.get_json(force=True)
+        if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+            return {'error': 'bad request'}, 400
+        return self.bulk(self.model.bulk_delete, ids, 'deleted')
+
+    @staticmethod
+    def bulk(method, items: list, action: str, status: int = 200):
+        if len(items) > current_app.config['BULK_MAX_ITEMS']:
+            return {'error': f'at most {current_app.config["BULK_MAX_ITEMS"]} items per request'}, 413
+        count, errors = method(items)
+        return {action: count, 'errors': errors}, 207 if errors else status
@@ -0,0 +1,57 @@
+import jwt
+import pytest
+from sqlalchemy import func
+
+from storehouse import create_app, db
+from storehouse.models import User, Video
+
+
+@pytest.fixture
+def config(tmp_path):
+    # Overridden by test modules that need other settings
+    database = f'sqlite:///{tmp_path / "test.db"}'
+    return {
+        'SQLALCHEMY_DATABASE_URI': database,
+        'SQLALCHEMY_BINDS': {'read': database},
+        'MEDIA_ROOT': str(tmp_path / 'media'),
+        'SECRET_KEY': 'test',
+        'HASH_WORKERS': 0,
+        'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1',
+        'RATE_LIMIT_ENABLED': False,
+    }
+
+
+@pytest.fixture
+def app(config):
+    app = create_app(config)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def user(app):
+    User.create({'name': 'user', 'email': 'user@example.com', 'password': 'secret'})
+    return User.query.filter_by(email='user@example.com').one()
+
+
+@pytest.fixture
+def headers(app, user):
+    return {'x-access-token': jwt.encode({'user_id': user.id}, app.config['SECRET_KEY'], algorithm='HS256')}
+
+
+@pytest.fixture
+def create_video(client, headers):
+    """Posts a video of the test user, fields override the defaults, returns its id"""
+    def create(**fields):
+        body = dict({'title': 'video', 'owner_id': 1, 'duration': 1.0}, **fields)
+        response = client.post('/videos', headers=headers, json=body)
+        assert response.status_code == 201, response.get_json()
+        return db.session.query(func.max(Video.id)).scalar()
+    return create
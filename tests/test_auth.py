@@ -0,0 +1,22 @@
+import jwt
+
+from storehouse.endpoints import token_cache
+from storehouse.models import User
+
+
+def test_user_writes_drop_their_cached_tokens(app, client, headers):
+    User.create({'name': 'other', 'email': 'other@example.com', 'password': 'secret'})
+    other = {'x-access-token': jwt.encode({'user_id': 2}, app.config['SECRET_KEY'], algorithm='HS256')}
+    for user_headers in (headers, other):
+        assert client.get('/videos', headers=user_headers).status_code == 200
+    assert token_cache.get(headers['x-access-token']).name == 'user'
+
+    assert client.patch('/user/1', headers=headers, json={'name': 'renamed'}).status_code == 200
+    assert token_cache.get(headers['x-access-token']) is None
+    assert client.get('/videos', headers=headers).status_code == 200
+    assert token_cache.get(headers['x-access-token']).name == 'renamed'
+
+    assert client.delete('/user/1', headers=headers).status_code == 204
+    assert client.get('/videos', headers=headers).status_code == 401
+    # Tokens of other users stay cached
+    assert token_cache.get(other['x-access-token']).id == 2
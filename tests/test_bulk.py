@@ -0,0 +1,34 @@
+from datetime import date
+
+from storehouse import db
+from storehouse.models import Video
+
+
+def test_bulk_create_reports_wrongly_typed_items(client, headers):
+    items = [
+        {'title': 'dated', 'owner_id': 1, 'duration': 1, 'upload_date': '2020-01-01'},
+        {'title': 'bad date', 'owner_id': 1, 'duration': 1.0, 'upload_date': 'yesterday'},
+        {'title': 'bad duration', 'owner_id': 1, 'duration': '1.0'},
+        {'title': 'bad flag', 'owner_id': 1, 'duration': 1.0, 'is_series': 'yes'},
+    ]
+    response = client.post('/videos', headers=headers, json=items)
+    assert response.status_code == 207
+    assert response.json['created'] == 1
+    assert [(e['index'], e['error']) for e in response.json['errors']] == [
+        (1, 'invalid fields: upload_date'), (2, 'invalid fields: duration'), (3, 'invalid fields: is_series'),
+    ]
+    assert db.session.query(Video.upload_date).scalar() == date(2020, 1, 1)
+
+
+def test_bulk_update_reports_wrongly_typed_items(client, headers):
+    client.post('/videos', headers=headers, json=[{'title': f'video {i}', 'owner_id': 1, 'duration': 1.0} for i in range(2)])
+    response = client.patch('/videos', headers=headers, json=[{'id': 1, 'episodes': 'two'}, {'id': 2, 'episodes': 2}])
+    assert response.status_code == 207
+    assert response.json == {'updated': 1, 'errors': [{'id': 1, 'error': 'invalid fields: episodes'}]}
+
+
+def test_non_object_bodies_are_rejected(client, headers):
+    assert client.post('/uploads', headers=headers, json=[1]).status_code == 400
+    assert client.post('/progress', headers=headers, json='position').status_code == 400
+    assert client.post('/users/signup', json=['a@a']).status_code == 400
+    assert client.post('/users/login', json=[]).status_code == 401
@@ -0,0 +1,27 @@
+import scripts
+from scripts import data_cli
+
+
+def test_etags_from_during_a_load_do_not_match_after_it(app, client, headers, tmp_path, monkeypatch):
+    client.post('/videos', headers=headers, json={'title': 'video', 'owner_id': 1, 'duration': 1.0})
+    runner = app.test_cli_runner()
+    assert runner.invoke(data_cli, ['dump', str(tmp_path)]).exit_code == 0
+
+    etags = []
+    load_table = scripts.load_table
+
+    def load_table_after_a_read(connection, table, path, batch_size):
+        if table.name == 'video':
+            # Served while the table is still empty
+            response = client.get('/videos', headers=headers)
+            assert response.json['items'] == []
+            etags.append(response.headers['ETag'])
+        return load_table(connection, table, path, batch_size)
+
+    monkeypatch.setattr(scripts, 'load_table', load_table_after_a_read)
+    result = runner.invoke(data_cli, ['load', str(tmp_path)])
+    assert result.exit_code == 0, result.output
+
+    response = client.get('/videos', headers=dict(headers, **{'If-None-Match': etags[0]}))
+    assert response.status_code == 200
+    assert [video['title'] for video in response.json['items']] == ['video']
@@ -0,0 +1,39 @@
+import jwt
+from sqlalchemy import text
+
+from storehouse import db
+from storehouse.models import Feed, User, WatchProgress
+
+
+def test_feed_of_a_deleted_user_is_refused(client, headers):
+    assert client.get('/feed', headers=headers).status_code == 200
+    db.session.query(Feed).delete()
+    db.session.commit()
+    # Deleted by another worker, this one still has the token cached
+    with db.engine.begin() as connection:
+        connection.execute(text('DELETE FROM user'))
+    assert client.get('/feed', headers=headers).status_code == 401
+
+
+def test_video_deletes_invalidate_the_feeds_listing_them(app, client, headers):
+    User.create({'name': 'other', 'email': 'other@example.com', 'password': 'secret'})
+    other = {'x-access-token': jwt.encode({'user_id': 2}, app.config['SECRET_KEY'], algorithm='HS256')}
+    for number in (1, 2):
+        client.post('/videos', headers=headers, json={'title': f'video {number}', 'owner_id': 1, 'duration': 1.0})
+    db.session.add(WatchProgress(user_id=1, video_id=1, episode=1, position=10.0))
+    db.session.commit()
+
+    def stored(build=False):
+        if build:
+            client.get('/feed', headers=headers), client.get('/feed', headers=other)
+        db.session.expire_all()
+        return {feed.user_id: feed.body is not None for feed in Feed.query}
+
+    assert stored(build=True) == {1: True, 2: True}
+    # Listed by no feed
+    assert client.delete('/video/2', headers=headers).status_code == 204
+    assert stored() == {1: True, 2: True}
+
+    # Continued by the first user only
+    assert client.delete('/video/1', headers=headers).status_code == 204
+    assert stored() == {1: False, 2: True}
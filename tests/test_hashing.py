@@ -0,0 +1,40 @@
+import time
+
+import pytest
+
+from storehouse import hashing
+
+
+@pytest.fixture
+def pool(app, monkeypatch):
+    # One worker and no queue, a pool of its own for this test
+    monkeypatch.setattr(hashing, '_executor', None)
+    monkeypatch.setattr(hashing, '_slots', None)
+    app.config.update(HASH_WORKERS=1, HASH_QUEUE_DEPTH=0, HASH_TIMEOUT=30)
+    # Spawning the worker takes longer than the timeout of the tests
+    assert hashing._run(sum, [1, 2]) == 3
+    app.config['HASH_TIMEOUT'] = 0.2
+    yield
+    if hashing._executor is not None:
+        hashing._executor.shutdown()
+
+
+def slow_check(password_hash, password):
+    time.sleep(1)
+
+
+def test_timed_out_hash_keeps_its_slot(pool):
+    with pytest.raises(hashing.HashingTimeout):
+        hashing._run(time.sleep, 1)
+    # Still running in the pool
+    with pytest.raises(hashing.HashingBusy):
+        hashing._run(sum, [1, 2])
+    time.sleep(1)
+    assert hashing._run(sum, [1, 2]) == 3
+
+
+def test_timed_out_login_is_a_503(pool, app, client, user, monkeypatch):
+    monkeypatch.setattr(hashing, 'check_password_hash', slow_check)
+    response = client.post('/users/login', json={'email': user.email, 'password': 'secret'})
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == str(app.config['HASH_RETRY_AFTER'])
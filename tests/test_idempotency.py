@@ -0,0 +1,48 @@
+from hashlib import sha256
+
+
+def start_upload(client, headers, size: int):
+    body = {'size': size, 'title': 'video', 'owner_id': 1, 'filename': 'video.mp4'}
+    response = client.post('/uploads', headers=headers, json=body)
+    assert response.status_code == 201
+    return response.get_json()['id']
+
+
+def test_chunk_upload_with_idempotency_key_is_streamed(client, headers):
+    chunk = b'x' * 1024
+    upload_id = start_upload(client, headers, len(chunk))
+    chunk_headers = dict(
+        headers, **{'Upload-Offset': '0', 'X-Chunk-SHA256': sha256(chunk).hexdigest(), 'Idempotency-Key': 'chunk-0'}
+    )
+
+    response = client.patch(f'/upload/{upload_id}', headers=chunk_headers, data=chunk,
+                            content_type='application/octet-stream')
+    assert response.status_code == 200
+    assert response.get_json()['offset'] == len(chunk)
+
+    retry = client.patch(f'/upload/{upload_id}', headers=chunk_headers, data=chunk,
+                         content_type='application/octet-stream')
+    assert retry.status_code == 200
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    assert retry.get_json() == response.get_json()
+
+
+def test_same_key_with_another_body_is_rejected(client, headers):
+    key = dict(headers, **{'Idempotency-Key': 'franchise'})
+    assert client.post('/franchises', headers=key, json={'name': 'one'}).status_code == 201
+    assert client.post('/franchises', headers=key, json={'name': 'one'}).headers['Idempotent-Replayed'] == 'true'
+    assert client.post('/franchises', headers=key, json={'name': 'two'}).status_code == 422
+
+
+def test_failed_writes_with_idempotency_key_are_stored(client, headers):
+    # A foreign key error must not leave the write lock to the connection storing the response
+    client.post('/videos', headers=headers, json={'title': 'video', 'owner_id': 1, 'duration': 1.0})
+    body = {'title': 'video', 'owner_id': 404, 'duration': 1.0}
+    requests = [
+        (client.put, '/video/5', body), (client.patch, '/video/1', {'owner_id': 404}), (client.post, '/videos', body),
+    ]
+    for number, (method, url, json) in enumerate(requests):
+        keyed = dict(headers, **{'Idempotency-Key': f'failed-{number}'})
+        assert method(url, headers=keyed, json=json).status_code == 400
+        retry = method(url, headers=keyed, json=json)
+        assert retry.status_code == 400 and retry.headers['Idempotent-Replayed'] == 'true'
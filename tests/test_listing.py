@@ -0,0 +1,65 @@
+import json
+
+
+def walk(client, headers, query):
+    # Every page of a listing, following the cursors
+    pages, after = [], None
+    while True:
+        url = f'/videos?{query}' + (f'&after={after}' if after else '')
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200
+        pages.append([item['id'] for item in response.json['items']])
+        after = response.json['next']
+        if after is None:
+            return pages
+
+
+def test_pages_follow_the_sort_order(client, headers, create_video):
+    dates = ['2022-01-03', '2022-01-01', '2022-01-02', '2022-01-01', '2022-01-03', '2022-01-02', '2022-01-01']
+    for upload_date in dates:
+        create_video(upload_date=upload_date)
+    by_date = sorted(range(1, 8), key=lambda video_id: (dates[video_id - 1], video_id))
+
+    assert walk(client, headers, 'limit=3') == [[1, 2, 3], [4, 5, 6], [7]]
+    # Equal dates are ordered by id
+    assert walk(client, headers, 'limit=2&sort=upload_date') == [by_date[0:2], by_date[2:4], by_date[4:6], by_date[6:]]
+    pages = walk(client, headers, 'limit=3&sort=-upload_date')
+    assert sum(pages, []) == by_date[::-1] and len(pages) == 3
+    assert walk(client, headers, 'limit=2&sort=-upload_date&upload_date_min=2022-01-02') == [[5, 1], [6, 3]]
+
+
+def test_cursors_and_sorts_are_checked(client, headers, create_video):
+    for _ in range(3):
+        create_video()
+    after = client.get('/videos?limit=1&sort=score', headers=headers).json['next']
+    assert client.get(f'/videos?limit=1&sort=score&after={after}', headers=headers).status_code == 200
+    for query in (f'sort=-upload_date&after={after}', f'after={after}', 'after=garbage', 'sort=title', 'is_series=maybe'):
+        response = client.get(f'/videos?{query}', headers=headers)
+        assert response.status_code == 400, query
+        assert response.json == {'error': 'bad request'}
+
+
+def test_ndjson_streams_every_matching_row(client, headers, create_video):
+    for number in range(5):
+        create_video(is_series=number % 2 == 0)
+    response = client.get('/videos?format=ndjson&limit=1', headers=headers)
+    assert response.mimetype == 'application/x-ndjson'
+    assert [json.loads(line)['id'] for line in response.data.decode().splitlines()] == [1, 2, 3, 4, 5]
+
+    response = client.get('/videos?format=ndjson&is_series=true', headers=headers)
+    assert [json.loads(line)['id'] for line in response.data.decode().splitlines()] == [1, 3, 5]
+    assert client.get('/videos?format=ndjson&is_series=maybe', headers=headers).status_code == 400
+
+
+def test_etags_change_with_writes(client, headers, create_video):
+    create_video()
+    for url in ('/videos?limit=5', '/video/1'):
+        etag = client.get(url, headers=headers).headers['ETag']
+        response = client.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+        assert response.status_code == 304
+        assert response.headers['ETag'] == etag
+
+        assert client.patch('/video/1', headers=headers, json={'title': 'renamed'}).status_code == 200
+        response = client.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
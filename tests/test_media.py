@@ -0,0 +1,130 @@
+import json
+import os
+from datetime import datetime, timedelta
+from hashlib import sha256
+
+from storehouse import db
+from storehouse.media import create_part, media_path, upload_path
+from storehouse.models import Upload, Video
+from storehouse.uploads import purge
+
+
+def write(relative):
+    path = media_path(relative)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+    return path
+
+
+def create_video_files(create_video, number):
+    create_video(title=f'video {number}')
+    # As finalize sets it, clients can not
+    Video.query.filter_by(id=number).update({'file_path': f'videos/{number}.mp4'})
+    db.session.commit()
+    return write(f'videos/{number}.mp4'), write(f'renditions/{number}/master.m3u8')
+
+
+def start_upload(client, headers):
+    response = client.post('/uploads', headers=headers, json={'size': 10, 'title': 'upload', 'owner_id': 1})
+    assert response.status_code == 201
+    return response.json['id']
+
+
+def test_deleted_videos_take_their_files_along(client, headers, create_video):
+    first = create_video_files(create_video, 1)
+    second = create_video_files(create_video, 2)
+
+    assert client.delete('/video/1', headers=headers).status_code == 204
+    assert not any(os.path.exists(path) for path in first)
+    assert all(os.path.exists(path) for path in second)
+
+    assert client.delete('/videos', headers=headers, json=[2]).status_code == 200
+    assert not any(os.path.exists(path) for path in second)
+    assert not os.path.exists(media_path('renditions/2'))
+
+
+def test_deleted_users_take_their_files_along(client, headers, create_video):
+    files = create_video_files(create_video, 1)
+    upload_id = start_upload(client, headers)
+    assert os.path.exists(upload_path(upload_id))
+
+    assert client.delete('/user/1', headers=headers).status_code == 204
+    assert not any(os.path.exists(path) for path in files)
+    assert not os.path.exists(upload_path(upload_id))
+
+
+def test_rolled_back_deletes_keep_the_files(create_video):
+    files = create_video_files(create_video, 1)
+    Video.deleting([1])
+    db.session.rollback()
+    db.session.commit()
+    assert all(os.path.exists(path) for path in files)
+
+
+def test_purge_removes_old_uploads_and_stray_parts(client, headers):
+    old, recent = start_upload(client, headers), start_upload(client, headers)
+    db.session.query(Upload).filter_by(id=old).update({'created': datetime.utcnow() - timedelta(days=2)})
+    db.session.commit()
+    create_part('0' * 32)
+    stale = datetime.now().timestamp() - 2 * 24 * 3600
+    os.utime(upload_path('0' * 32), (stale, stale))
+
+    assert purge(timedelta(days=1)) == (1, 1)
+    assert [upload.id for upload in Upload.query] == [recent]
+    assert not os.path.exists(upload_path(old)) and not os.path.exists(upload_path('0' * 32))
+    assert os.path.exists(upload_path(recent))
+
+
+def test_clients_can_not_point_videos_at_files(client, headers, create_video):
+    create_video_files(create_video, 1)
+    body = {'title': 'video', 'owner_id': 1, 'duration': 1.0, 'file_path': 'videos/1.mp4'}
+    assert client.post('/videos', headers=headers, json=body).status_code == 400
+    assert client.patch('/video/1', headers=headers, json={'file_path': 'videos/2.mp4'}).status_code == 400
+    assert client.put('/video/2', headers=headers, json=body).status_code == 400
+
+
+def test_stream_serves_video_files_only(client, headers, create_video):
+    create_video_files(create_video, 1)
+    assert client.get('/video/1/stream?download').status_code == 200
+    upload_id = start_upload(client, headers)
+    for path in (f'uploads/{upload_id}.part', 'videos/../uploads/x.part', '../secret'):
+        Video.query.filter_by(id=1).update({'file_path': path})
+        db.session.commit()
+        assert client.get('/video/1/stream?download').status_code == 404
+
+
+def finalize(client, headers, **fields):
+    chunk = b'x' * 10
+    upload_id = client.post('/uploads', headers=headers, json=dict(
+        {'size': len(chunk), 'title': 'upload', 'owner_id': 1, 'duration': 1.0}, **fields,
+    )).json['id']
+    chunk_headers = dict(headers, **{'Upload-Offset': '0', 'X-Chunk-SHA256': sha256(chunk).hexdigest()})
+    client.patch(f'/upload/{upload_id}', headers=chunk_headers, data=chunk, content_type='application/octet-stream')
+    return upload_id, client.post(f'/upload/{upload_id}/finalize', headers=headers)
+
+
+def test_upload_video_fields_are_checked_before_the_upload(client, headers):
+    body = {'size': 10, 'title': 'upload', 'owner_id': 404}
+    assert client.post('/uploads', headers=headers, json=body).json == {'error': 'owner not found'}
+    response = client.post('/uploads', headers=headers, json=dict(body, owner_id=1, episodes='two'))
+    assert response.json == {'error': 'invalid fields: episodes'}
+    assert Upload.query.count() == 0
+
+
+def test_finalize_keeps_uploads_of_invalid_videos(client, headers):
+    client.post('/franchises', headers=headers, json={'name': 'franchise'})
+    upload_id, response = finalize(client, headers, franchise_id=1, order_number=1)
+    assert response.status_code == 201
+
+    for fields in ({'franchise_id': 404}, {'franchise_id': 1, 'order_number': 1}):
+        upload_id, response = finalize(client, headers, **fields)
+        assert response.status_code == 400
+        assert os.path.getsize(upload_path(upload_id)) == 10
+        assert db.session.get(Upload, upload_id) is not None
+
+    # Stored before uploads were checked
+    db.session.get(Upload, upload_id).fields = json.dumps({'title': 'upload', 'owner_id': 1, 'duration': 1.0, 'episodes': 'two'})
+    db.session.commit()
+    response = client.post(f'/upload/{upload_id}/finalize', headers=headers)
+    assert response.json == {'error': 'invalid fields: episodes'}
+    assert Video.query.count() == 1
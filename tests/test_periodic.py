@@ -0,0 +1,28 @@
+import time
+
+from storehouse.periodic import PeriodicTask
+
+
+def test_calls_until_stopped_and_once_more_at_stop(app):
+    calls = []
+
+    def function():
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            raise RuntimeError('retried on the next call')
+
+    task = PeriodicTask('test', function, 'Could not run test task')
+    task.stop()
+    assert calls == []
+
+    task = PeriodicTask('test', function, 'Could not run test task')
+    task.start(app, 0.01)
+    task.start(app, 0.01)
+    deadline = time.monotonic() + 5
+    while len(calls) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    task.stop()
+    task._thread.join(1)
+    count = len(calls)
+    time.sleep(0.05)
+    assert count >= 3 and len(calls) == count
@@ -0,0 +1,29 @@
+from storehouse.models import User, WatchProgress
+from storehouse.progress import ProgressBuffer
+
+
+def test_flush_drops_reports_of_deleted_users(app, user, create_video):
+    video_id = create_video(owner_id=user.id)
+    buffer = ProgressBuffer()
+    buffer.init_app(app)
+    buffer.record(user.id, video_id, 1, 10.0)
+    buffer.record(user.id + 1, video_id, 1, 20.0)
+
+    assert buffer.flush() == 1
+    assert buffer.pending(user.id + 1) == {}
+    assert [row.user_id for row in WatchProgress.query] == [user.id]
+
+
+def test_flush_drops_rows_failing_the_foreign_keys(app, user, create_video, monkeypatch):
+    # The user is deleted between the existence check and the upsert
+    video_id = create_video(owner_id=user.id)
+    monkeypatch.setattr(User, 'existing_ids', classmethod(lambda cls, ids: set(ids)))
+    buffer = ProgressBuffer()
+    buffer.init_app(app)
+    buffer.record(user.id, video_id, 1, 10.0)
+    buffer.record(user.id + 1, video_id, 1, 20.0)
+
+    assert buffer.flush() == 1
+    buffer.record(user.id, video_id, 1, 30.0)
+    assert buffer.flush() == 1
+    assert [(row.user_id, row.position) for row in WatchProgress.query] == [(user.id, 30.0)]
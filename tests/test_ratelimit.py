@@ -0,0 +1,27 @@
+import pytest
+
+from storehouse import ratelimit
+from storehouse.endpoints import token_cache
+
+
+@pytest.fixture
+def config(config, tmp_path, monkeypatch):
+    # A limiter of its own, init_app configures the shared one
+    monkeypatch.setattr(ratelimit, 'limiter', ratelimit.RateLimiter())
+    return dict(config, RATE_LIMIT_ENABLED=True, RATE_LIMIT_DATABASE=str(tmp_path / 'ratelimit.db'),
+        RATE_LIMIT_IP_RATE=1.0, RATE_LIMIT_IP_BURST=6.0, RATE_LIMIT_USER_RATE=1.0, RATE_LIMIT_USER_BURST=3.0)
+
+
+def test_clients_over_their_limit_get_a_429(client, headers):
+    token_cache.discard(lambda token, user: True)
+    # Not cached yet, the first request with a token counts against the address
+    assert client.get('/videos', headers=headers).status_code == 200
+    assert client.get('/videos').status_code == 401
+    response = client.get('/videos')
+    assert response.status_code == 429
+    assert response.json == {'error': 'too many requests'}
+    assert response.headers['Retry-After'] == '3'
+
+    # Verified tokens have a bucket of their own
+    assert client.get('/videos', headers=headers).status_code == 200
+    assert client.get('/videos', headers=headers).status_code == 429
@@ -0,0 +1,95 @@
+import threading
+
+from storehouse import db
+from storehouse.models import ScoreBucket, Video, Watchlist
+
+
+def rate(client, headers, video_id, score):
+    body = {'user_id': 1, 'target_id': video_id, 'episodes': 1, 'score': score}
+    assert client.post('/watchlists', headers=headers, json=body).status_code == 201
+
+
+def aggregates(video_id):
+    db.session.expire_all()
+    video = Video.query.get(video_id)
+    buckets = {row.bucket: row.ratings for row in ScoreBucket.query.filter_by(video_id=video_id)}
+    return video.score, video.rating_count, video.rating_sum, buckets
+
+
+def test_ratings_follow_watchlist_writes(client, headers, create_video):
+    video_id = create_video()
+    rate(client, headers, video_id, 6)
+    rate(client, headers, video_id, 8)
+    assert aggregates(video_id) == (7, 2, 14, {6: 1, 8: 1})
+
+    assert client.patch('/watchlist/1', headers=headers, json={'score': 9}).status_code == 200
+    assert aggregates(video_id) == (8.5, 2, 17, {8: 1, 9: 1})
+
+    response = client.patch('/watchlists', headers=headers, json=[{'id': 1, 'score': 2}, {'id': 2, 'score': 4}])
+    assert response.status_code == 200
+    assert aggregates(video_id) == (3, 2, 6, {2: 1, 4: 1})
+
+    assert client.delete('/watchlist/1', headers=headers).status_code == 204
+    assert aggregates(video_id) == (4, 1, 4, {4: 1})
+
+
+def test_bulk_update_rejects_repeated_ids(client, headers, create_video):
+    video_id = create_video()
+    rate(client, headers, video_id, 5)
+
+    response = client.patch('/watchlists', headers=headers, json=[{'id': 1, 'score': 7}, {'id': 1, 'score': 9}])
+    assert response.status_code == 207
+    assert response.get_json() == {
+        'updated': 0, 'errors': [{'id': 1, 'error': 'duplicate id'}, {'id': 1, 'error': 'duplicate id'}],
+    }
+    assert aggregates(video_id) == (5, 1, 5, {5: 1})
+
+    assert client.delete('/watchlist/1', headers=headers).status_code == 204
+    assert aggregates(video_id) == (0, 0, 0, {})
+
+
+def test_aggregates_are_read_only(client, headers, create_video):
+    video_id = create_video()
+    body = {'title': 'video', 'owner_id': 1, 'duration': 1.0, 'score': 10}
+
+    assert client.post('/videos', headers=headers, json=body).status_code == 400
+    assert client.put(f'/video/{video_id}', headers=headers, json=body).status_code == 400
+    response = client.patch(f'/video/{video_id}', headers=headers, json={'rating_count': 3})
+    assert response.status_code == 400
+    assert response.get_json() == {'error': 'read-only fields: rating_count'}
+    response = client.patch('/videos', headers=headers, json=[{'id': video_id, 'rating_sum': 3}])
+    assert response.get_json()['errors'] == [{'id': video_id, 'error': 'read-only fields: rating_sum'}]
+    assert aggregates(video_id) == (0, 0, 0, {})
+
+
+def test_concurrent_updates_keep_aggregates_exact(app, client, headers, create_video, monkeypatch):
+    video_id = create_video()
+    rate(client, headers, video_id, 5)
+    snapshotted = [threading.Event(), threading.Event()]
+    changed = Watchlist.changed.__func__
+
+    def slow_changed(cls, changes):
+        # The first writer waits for the second to read the row it is about to change
+        first = not snapshotted[0].is_set()
+        snapshotted[0 if first else 1].set()
+        if first:
+            snapshotted[1].wait(0.5)
+        changed(cls, changes)
+
+    monkeypatch.setattr(Watchlist, 'changed', classmethod(slow_changed))
+
+    statuses = []
+
+    def patch(score):
+        statuses.append(app.test_client().patch('/watchlist/1', headers=headers, json={'score': score}).status_code)
+
+    first = threading.Thread(target=patch, args=(7,))
+    first.start()
+    snapshotted[0].wait(5)
+    second = threading.Thread(target=patch, args=(9,))
+    second.start()
+    first.join()
+    second.join()
+
+    assert statuses == [200, 200]
+    assert aggregates(video_id) == (9, 1, 9, {9: 1})
@@ -0,0 +1,18 @@
+from storehouse import db
+from storehouse.models import Video
+from storehouse.search import word_prefix
+
+
+def titles(term):
+    return sorted(video.title for video in Video.query.filter(word_prefix(Video.title, term)))
+
+
+def test_fallback_matches_word_prefixes_only(user):
+    db.session.execute(Video.__table__.insert(), [
+        {'title': title, 'owner_id': user.id, 'duration': 1.0, 'episodes': 1, 'is_series': False}
+        for title in ('Star Wars', 'Mustard', 'Lone star', 'top_gun', 'topxgun', '100% real', '1000 real')
+    ])
+    db.session.commit()
+    assert titles('star') == ['Lone star', 'Star Wars']
+    assert titles('top_') == ['top_gun']
+    assert titles('100%') == ['100% real']
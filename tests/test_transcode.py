@@ -0,0 +1,49 @@
+import pytest
+from datetime import datetime, timedelta
+from sqlalchemy import text
+
+from storehouse import db, transcode
+from storehouse.models import TranscodeJob
+
+
+def queue_job(client, headers):
+    client.post('/videos', headers=headers, json={'title': 'video', 'owner_id': 1, 'duration': 1.0})
+    transcode.enqueue(1)
+    db.session.commit()
+
+
+def test_job_of_a_deleted_video_does_not_stop_the_worker(app, client, headers, monkeypatch):
+    queue_job(client, headers)
+
+    def process(job):
+        # The video goes away in another transaction while it transcodes
+        with db.engine.begin() as connection:
+            connection.execute(text('DELETE FROM video WHERE id = 1'))
+        raise RuntimeError('source is gone')
+
+    monkeypatch.setattr(transcode, 'process', process)
+    transcode.run(transcode.claim('test'))
+    assert TranscodeJob.query.count() == 0
+
+
+def test_stale_jobs_are_requeued_while_polling(app, client, headers, monkeypatch):
+    queue_job(client, headers)
+    transcode.claim('dead')
+    clock = [0]
+
+    def sleep(seconds):
+        assert clock[0] < 600, 'stale job was not picked up'
+        # The other worker stops reporting while this one waits for jobs
+        db.session.query(TranscodeJob).update({'updated': datetime.utcnow() - timedelta(days=1)})
+        db.session.commit()
+        clock[0] += 60
+
+    def run(job):
+        raise StopIteration(job.id)
+
+    monkeypatch.setattr(transcode, 'sleep', sleep)
+    monkeypatch.setattr(transcode, 'monotonic', lambda: clock[0])
+    monkeypatch.setattr(transcode, 'run', run)
+    with pytest.raises(StopIteration) as stop:
+        transcode.work(0)
+    assert stop.value.value == 1
@@ -0,0 +1,23 @@
+from storehouse import db
+from storehouse.models import Video, Watchlist
+
+
+def test_put_replaces_the_whole_row(client, headers):
+    client.post('/franchises', headers=headers, json={'name': 'franchise'})
+    body = {'title': 'video', 'owner_id': 1, 'duration': 1.0, 'franchise_id': 1, 'order_number': 1, 'episodes': 3}
+    assert client.put('/video/1', headers=headers, json=body).status_code == 201
+    rating = {'user_id': 1, 'target_id': 1, 'episodes': 1, 'score': 8}
+    assert client.put('/watchlist/1', headers=headers, json=rating).status_code == 201
+
+    body = {'title': 'replaced', 'owner_id': 1, 'duration': 2.0}
+    assert client.put('/video/1', headers=headers, json=body).status_code == 201
+    db.session.expire_all()
+    video = db.session.get(Video, 1)
+    assert (video.title, video.franchise_id, video.order_number, video.episodes) == ('replaced', None, None, 1)
+    # Read-only columns keep their values
+    assert (video.rating_count, video.rating_sum) == (1, 8)
+
+    rating = {'user_id': 1, 'target_id': 1, 'episodes': 2}
+    assert client.put('/watchlist/1', headers=headers, json=rating).status_code == 201
+    db.session.expire_all()
+    assert (db.session.get(Watchlist, 1).score, db.session.get(Video, 1).rating_count) == (None, 0)